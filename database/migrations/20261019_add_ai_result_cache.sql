@@ -0,0 +1,19 @@
+-- 20261019_add_ai_result_cache.sql
+-- AI 分析结果缓存（server/ai_cache.py）：按图片内容寻址，同一张图重复分析不再调用模型
+-- 说明：
+--   - cache_key = sha256(种类 + 版本 + 模型 + 提示词哈希 + 图片 sha256 + 风格/检索词)
+--   - 只缓存成功的结果；过期行读取时视为未命中，写入时顺带批量清理
+--   - 不关联 images 表：上传前分析的临时文件同样可以命中；与用户无关，相同内容跨用户共享
+
+CREATE TABLE IF NOT EXISTS ai_result_cache (
+  cache_key    CHAR(64)     NOT NULL,
+  kind         VARCHAR(32)  NOT NULL,
+  model        VARCHAR(64)  NOT NULL,
+  image_sha256 CHAR(64)     NOT NULL,
+  payload      MEDIUMTEXT   NOT NULL,
+  created_at   TIMESTAMP    DEFAULT CURRENT_TIMESTAMP,
+  expires_at   DATETIME     NOT NULL,
+  PRIMARY KEY (cache_key),
+  KEY idx_ai_result_cache_expires (expires_at),
+  KEY idx_ai_result_cache_sha (image_sha256)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,21 @@
+-- 20261019_add_file_reclaim_queue.sql
+-- 图片删除后的文件回收队列（server/file_reclaim.py）
+-- 说明：
+--   - 删除图片记录时在同一事务里登记 原图/缩略图 相对路径
+--   - 后台线程用 SELECT ... FOR UPDATE SKIP LOCKED 认领（需要 MySQL 8.0+），
+--     按 sha256 确认文件不再被其他记录引用后再删除
+--   - 回收时按 sha256 查引用，这里顺带给 images.sha256 单独建索引（唯一索引以 owner_id 开头，用不上）
+
+CREATE TABLE IF NOT EXISTS file_reclaim_queue (
+  id          BIGINT AUTO_INCREMENT PRIMARY KEY,
+  owner_id    INT NOT NULL,
+  rel_path    VARCHAR(255) NOT NULL,
+  sha256      CHAR(64) NULL,
+  enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- ===== 条件加索引：images.sha256 =====
+SET @x := (SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS
+           WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND INDEX_NAME='idx_images_sha256');
+SET @sql := IF(@x=0, 'ALTER TABLE images ADD INDEX idx_images_sha256 (sha256);', 'SELECT 1');
+PREPARE s FROM @sql; EXECUTE s; DEALLOCATE PREPARE s;
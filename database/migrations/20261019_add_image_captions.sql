@@ -0,0 +1,20 @@
+-- 20261019_add_image_captions.sql
+-- AI 对图片内容的描述与标签（一次性离线生成），供本地内容检索索引（server/content_index.py）使用
+-- 说明：
+--   - 由 python -m server.tools.build_content_index --caption 批量生成，已有记录的图片不会重复请求模型
+--   - 与用户可编辑的 title/description/标签分开存放，不覆盖用户数据
+--   - 图片删除时级联删除
+
+CREATE TABLE IF NOT EXISTS image_captions (
+  image_id   INT          NOT NULL,
+  owner_id   INT          NOT NULL,
+  caption    TEXT         NULL,
+  tags       VARCHAR(255) NULL,                 -- 空格分隔
+  model      VARCHAR(64)  NULL,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (image_id),
+  KEY idx_image_captions_owner (owner_id),
+  CONSTRAINT fk_image_captions_image
+    FOREIGN KEY (image_id) REFERENCES images(id)
+    ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
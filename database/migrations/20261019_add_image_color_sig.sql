@@ -0,0 +1,12 @@
+-- 20261019_add_image_color_sig.sql
+-- 图片颜色签名（server/utils/color_signature.py），用于按颜色检索（server/color_index.py）
+-- 说明：
+--   - 85 字节：版本号 + 64 格 HSV 直方图（uint8）+ 5 个主色 (R,G,B,占比)
+--   - 上传与编辑导出时写入；旧图片用 python -m server.tools.backfill_image_features 补算
+--   - 检索在应用内存里做向量化计算，这里不需要索引
+
+-- ===== 条件加列：images.color_sig =====
+SET @x := (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+           WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME='color_sig');
+SET @sql := IF(@x=0, 'ALTER TABLE images ADD COLUMN color_sig VARBINARY(96) NULL;', 'SELECT 1');
+PREPARE s FROM @sql; EXECUTE s; DEALLOCATE PREPARE s;
@@ -0,0 +1,18 @@
+-- 20261019_add_image_phash.sql
+-- 图片感知哈希（server/utils/image_hash.py），用于近似重复提示与相似图片查询（server/similar_index.py）
+-- 说明：
+--   - phash / dhash 为 64 位哈希，按有符号 BIGINT 存放
+--   - 上传与编辑导出时写入；旧图片用 python -m server.tools.backfill_image_features 补算
+--   - 汉明距离查询在应用内存里做（多索引哈希），这里不需要额外索引
+
+-- ===== 条件加列：images.phash =====
+SET @x := (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+           WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME='phash');
+SET @sql := IF(@x=0, 'ALTER TABLE images ADD COLUMN phash BIGINT NULL;', 'SELECT 1');
+PREPARE s FROM @sql; EXECUTE s; DEALLOCATE PREPARE s;
+
+-- ===== 条件加列：images.dhash =====
+SET @x := (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+           WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME='dhash');
+SET @sql := IF(@x=0, 'ALTER TABLE images ADD COLUMN dhash BIGINT NULL;', 'SELECT 1');
+PREPARE s FROM @sql; EXECUTE s; DEALLOCATE PREPARE s;
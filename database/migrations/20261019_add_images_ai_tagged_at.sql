@@ -0,0 +1,18 @@
+-- 20261019_add_images_ai_tagged_at.sql
+-- 批量 AI 自动标签（server/ai_tagger.py）的进度标记
+-- 说明：
+--   - 处理完一张图片（包括模型没给出标签、文件缺失）写入时间；NULL 表示还没处理或上次失败
+--   - 批量任务按 (owner_id, ai_tagged_at IS NULL, id) 分批扫描，配合下面的索引
+--   - AI 生成的标签写入 tags.kind='system'，与用户手动添加的标签区分
+
+-- ===== 条件加列：images.ai_tagged_at =====
+SET @x := (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+           WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME='ai_tagged_at');
+SET @sql := IF(@x=0, 'ALTER TABLE images ADD COLUMN ai_tagged_at DATETIME NULL;', 'SELECT 1');
+PREPARE s FROM @sql; EXECUTE s; DEALLOCATE PREPARE s;
+
+-- ===== 条件加索引：images(owner_id, ai_tagged_at) =====
+SET @x := (SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS
+           WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND INDEX_NAME='idx_images_owner_ai_tagged');
+SET @sql := IF(@x=0, 'ALTER TABLE images ADD INDEX idx_images_owner_ai_tagged (owner_id, ai_tagged_at);', 'SELECT 1');
+PREPARE s FROM @sql; EXECUTE s; DEALLOCATE PREPARE s;
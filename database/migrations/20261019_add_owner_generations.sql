@@ -0,0 +1,15 @@
+-- 20261019_add_owner_generations.sql
+-- 每个用户一个数据版本号，供查询结果缓存（server/result_cache.py）判断是否失效
+-- 说明：
+--   - 所有写接口结束时 gen + 1（INSERT ... ON DUPLICATE KEY UPDATE）
+--   - 没有记录等价于 gen = 0；表不存在时后端直接绕过缓存
+
+CREATE TABLE IF NOT EXISTS owner_generations (
+  owner_id   INT NOT NULL,
+  gen        BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (owner_id),
+  CONSTRAINT fk_owner_generations_owner
+    FOREIGN KEY (owner_id) REFERENCES users(id)
+    ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+AI 分析结果缓存：同一张图片（按内容 sha256）在同一模型、同一提示词下的分析结果只请求一次。
+
+- 键：sha256(种类, AI_CACHE_VERSION, 模型, 提示词哈希, 图片 sha256, 风格/检索词)，
+  提示词改动会自动换键；需要整体作废时调大 AI_CACHE_VERSION
+- 两级：进程内 LRU（命中时无 IO）-> MySQL ai_result_cache 表（多个 worker 与重启后共享）
+- 只缓存成功的结果；表不可用时直接调用模型，不影响功能
+
+环境变量：
+  AI_CACHE_TTL_DAYS    结果保留天数（默认 30，0 表示关闭缓存）
+  AI_CACHE_MEM_ITEMS   进程内 LRU 条数（默认 2048）
+  AI_CACHE_VERSION     缓存版本号（默认 1）
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from server.db import execute, query
+from server.utils.env import env_float
+
+_PURGE_EVERY = 500
+
+
+def _sha256_text(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# 文件哈希按 (路径, 大小, mtime) 记忆，同一文件反复分析时不重复读盘
+_FILE_SHA: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_FILE_SHA_LOCK = threading.Lock()
+
+
+def file_sha256(path: str) -> str:
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _FILE_SHA_LOCK:
+        if key in _FILE_SHA:
+            _FILE_SHA.move_to_end(key)
+            return _FILE_SHA[key]
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _FILE_SHA_LOCK:
+        _FILE_SHA[key] = digest
+        while len(_FILE_SHA) > 4096:
+            _FILE_SHA.popitem(last=False)
+    return digest
+
+
+class AIResultCache:
+    def __init__(self, ttl_seconds: float, mem_items: int, version: str):
+        self.ttl = ttl_seconds
+        self.mem_items = mem_items
+        self.version = version
+        # key -> (过期时间, JSON 文本)；存文本，取出时反序列化即得到副本，调用方可以随意修改
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.stats = {"mem_hits": 0, "db_hits": 0, "misses": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def make_key(self, kind: str, model: str, prompt: str, image_sha256: str, variant: str = "") -> str:
+        return _sha256_text(kind, self.version, model, _sha256_text(prompt), image_sha256, variant)
+
+    def _mem_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._mem.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                self._mem.pop(key, None)
+                return None
+            self._mem.move_to_end(key)
+            return item[1]
+
+    def _mem_put(self, key: str, expires: float, text: str) -> None:
+        if self.mem_items <= 0:
+            return
+        with self._lock:
+            self._mem[key] = (expires, text)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.mem_items:
+                self._mem.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        text = self._mem_get(key)
+        if text is not None:
+            self.stats["mem_hits"] += 1
+            return json.loads(text)
+        try:
+            rows = query(
+                "SELECT payload, UNIX_TIMESTAMP(expires_at) AS exp FROM ai_result_cache "
+                "WHERE cache_key=%s AND expires_at > NOW()",
+                (key,),
+            )
+        except Exception:
+            rows = []
+        if not rows:
+            self.stats["misses"] += 1
+            return None
+        self.stats["db_hits"] += 1
+        text = rows[0]["payload"]
+        self._mem_put(key, float(rows[0]["exp"] or 0), text)
+        return json.loads(text)
+
+    def put(self, key: str, kind: str, model: str, image_sha256: str, value: Dict[str, Any]) -> None:
+        text = json.dumps(value, ensure_ascii=False)
+        self._mem_put(key, time.time() + self.ttl, text)
+        try:
+            execute(
+                "INSERT INTO ai_result_cache (cache_key, kind, model, image_sha256, payload, expires_at) "
+                "VALUES (%s,%s,%s,%s,%s, DATE_ADD(NOW(), INTERVAL %s SECOND)) "
+                "ON DUPLICATE KEY UPDATE payload=VALUES(payload), expires_at=VALUES(expires_at)",
+                (key, kind, model[:64], image_sha256, text, int(self.ttl)),
+            )
+            self._writes += 1
+            if self._writes % _PURGE_EVERY == 0:
+                execute("DELETE FROM ai_result_cache WHERE expires_at < NOW() LIMIT 1000")
+        except Exception as exc:
+            print(f"[ai_cache] write failed: {exc}")
+
+    def get_or_compute(
+        self,
+        kind: str,
+        image_path: str,
+        model: str,
+        prompt: str,
+        compute: Callable[[], Dict[str, Any]],
+        variant: str = "",
+        image_sha256: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        按图片内容取缓存结果，未命中时调用 compute()。
+        compute 抛出的异常原样向上传递，不会写入缓存。
+        """
+        if not self.enabled:
+            return compute()
+        try:
+            sha = image_sha256 or file_sha256(image_path)
+        except OSError:
+            return compute()
+        key = self.make_key(kind, model, prompt, sha, variant)
+        hit = self.get(key)
+        if hit is not None:
+            return hit
+        value = compute()
+        if isinstance(value, dict) and not value.get("error"):
+            self.put(key, kind, model, sha, value)
+        return value
+
+
+_CACHE: Optional[AIResultCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_ai_cache() -> AIResultCache:
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = AIResultCache(
+                    env_float("AI_CACHE_TTL_DAYS", 30) * 86400,
+                    int(env_float("AI_CACHE_MEM_ITEMS", 2048)),
+                    os.getenv("AI_CACHE_VERSION", "1"),
+                )
+    return _CACHE
+
+
+def ai_cache_stats() -> Dict[str, Any]:
+    return dict(get_ai_cache().stats)
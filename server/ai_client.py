@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+DashScope 多模态调用的统一入口，photo_analysis_agent 与 ai_search_agent 都经由这里请求模型。
+
+- 并发：每个进程最多 AI_MAX_CONCURRENCY 个调用同时进行，超出的排队（最多等 AI_TIMEOUT 秒）
+- 限流：令牌桶，平均 AI_RATE_PER_SEC 次/秒，允许 AI_RATE_BURST 次突发
+- 超时：每次 HTTP 请求 AI_TIMEOUT 秒；每个线程复用自己的 requests.Session（连接池）
+- 重试：超时、连接错误、429、5xx 最多重试 AI_MAX_RETRIES 次，指数退避 + 全抖动
+- 熔断：连续 AI_BREAKER_FAILURES 次可重试类失败后打开，AI_BREAKER_COOLDOWN 秒内直接失败，
+  冷却后放一个探测请求，成功则恢复
+- fan_out：多张图片的调用交给线程池并发执行，仍受上面的并发数与限流约束；
+  iter_fan_out 边完成边返回，调用方停止迭代后未开始的调用不再发出（流式接口客户端断开时省下剩余调用）
+
+离线调试：先启动 `python -m server.tools.dashscope_stub`，再设置
+DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:8089/api/v1（dashscope SDK 原生支持的环境变量）。
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from server.lazy_deps import dashscope_api_key, get_dashscope
+from server.utils.env import env_float
+
+DEFAULT_MODEL = os.getenv("DASHSCOPE_MODEL", "qwen-vl-plus")
+
+
+class AIError(RuntimeError):
+    """模型调用失败；retryable 表示属于超时/限流/服务端错误一类。"""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class AIUnavailable(AIError):
+    """熔断打开、排队超时或未配置 api key：没有真正发出请求。"""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        """取一个令牌，最多等 timeout 秒；rate<=0 表示不限流。"""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int, cooldown: float):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.probing:
+                self.probing = True  # 冷却后只放一个探测请求
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release_probe(self) -> None:
+        """探测名额没有用上（请求没有发出），交还给下一个请求。"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self) -> None:
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+def response_text(resp: Any) -> str:
+    """拼接多模态返回里第一个 choice 的全部文本片段。"""
+    contents = resp.output.choices[0]["message"]["content"]
+    parts = [c.get("text") for c in contents if isinstance(c, dict) and c.get("text")]
+    return "\n".join(filter(None, parts)).strip()
+
+
+def _is_retryable_exception(exc: Exception) -> bool:
+    try:
+        import requests
+    except ImportError:  # pragma: no cover - dashscope 依赖 requests
+        return False
+    return isinstance(exc, (requests.Timeout, requests.ConnectionError, TimeoutError, ConnectionError))
+
+
+class AIClient:
+    def __init__(self):
+        self.timeout = max(1.0, env_float("AI_TIMEOUT", 30))
+        self.max_retries = max(0, int(env_float("AI_MAX_RETRIES", 2)))
+        self.concurrency = max(1, int(env_float("AI_MAX_CONCURRENCY", 4)))
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.bucket = TokenBucket(env_float("AI_RATE_PER_SEC", 5), env_float("AI_RATE_BURST", 5))
+        self.breaker = CircuitBreaker(int(env_float("AI_BREAKER_FAILURES", 5)), env_float("AI_BREAKER_COOLDOWN", 30))
+        self._local = threading.local()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def call(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **params) -> Any:
+        """发起一次多模态调用（含排队、限流、重试与熔断），返回 status 为 200 的原始响应。"""
+        if not dashscope_api_key():
+            raise AIUnavailable("DASHSCOPE_API_KEY 未配置")
+        if not self.slots.acquire(timeout=self.timeout):
+            raise AIUnavailable("AI 服务繁忙，请稍后再试")
+        try:
+            attempt = 0
+            while True:
+                if not self.breaker.allow():
+                    raise AIUnavailable("AI 服务暂时不可用，请稍后再试")
+                if not self.bucket.acquire(self.timeout):
+                    self.breaker.release_probe()
+                    raise AIUnavailable("AI 调用过于频繁，请稍后再试")
+                try:
+                    resp = self._call_once(messages, model or DEFAULT_MODEL, params)
+                except AIUnavailable:
+                    self.breaker.release_probe()
+                    raise
+                except AIError as exc:
+                    if not exc.retryable:
+                        # 参数/鉴权类错误说明服务本身正常，不计入熔断
+                        self.breaker.record_success()
+                        raise
+                    self.breaker.record_failure()
+                    if attempt >= self.max_retries:
+                        raise
+                    attempt += 1
+                    # 全抖动退避：0 ~ 0.5 * 2^attempt 秒，避免多个请求同时重试
+                    time.sleep(random.uniform(0, min(8.0, 0.5 * (2 ** attempt))))
+                    continue
+                self.breaker.record_success()
+                return resp
+        finally:
+            self.slots.release()
+
+    def _call_once(self, messages, model: str, params: Dict[str, Any]) -> Any:
+        try:
+            resp = get_dashscope().MultiModalConversation.call(
+                model=model,
+                messages=messages,
+                request_timeout=self.timeout,
+                session=self._session(),
+                **params,
+            )
+        except ImportError as exc:
+            raise AIUnavailable(f"dashscope 未安装: {exc}") from exc
+        except Exception as exc:
+            raise AIError(f"调用多模态模型失败: {exc}", retryable=_is_retryable_exception(exc)) from exc
+        status = getattr(resp, "status_code", None)
+        if status != HTTPStatus.OK:
+            message = getattr(resp, "message", None) or str(getattr(resp, "code", "")) or "DashScope 返回错误"
+            retryable = status == HTTPStatus.TOO_MANY_REQUESTS or (isinstance(status, int) and status >= 500)
+            raise AIError(message, retryable=retryable)
+        return resp
+
+    def call_text(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **params) -> str:
+        return response_text(self.call(messages, model=model, **params))
+
+    def fan_out(self, func: Callable[[Any], Any], items: Iterable[Any]) -> List[Tuple[Any, Optional[Exception]]]:
+        """
+        并发执行 func(item)，按输入顺序返回 [(结果, 异常)]。
+        func 内部应通过 call/call_text 发请求，实际并发仍受 AI_MAX_CONCURRENCY 与限流约束。
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [self._safe(func, item) for item in items]
+        futures = [self._executor().submit(self._safe, func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def iter_fan_out(
+        self,
+        func: Callable[[Any], Any],
+        items: Iterable[Any],
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> Iterator[Tuple[int, Any, Optional[Exception]]]:
+        """
+        并发执行 func(item)，按完成顺序逐个产出 (下标, 结果, 异常)。
+        同时最多提交 AI_MAX_CONCURRENCY 个；should_stop() 为真或调用方关闭生成器后不再提交新的，
+        已排队未开始的直接取消，只有正在进行的几个会跑完。
+        """
+        items = list(items)
+        pool = self._executor()
+        pending: Dict[Any, int] = {}
+        next_index = 0
+        try:
+            while next_index < len(items) or pending:
+                while (
+                    next_index < len(items)
+                    and len(pending) < self.concurrency
+                    and not (should_stop and should_stop())
+                ):
+                    pending[pool.submit(self._safe, func, items[next_index])] = next_index
+                    next_index += 1
+                if not pending:
+                    break
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    result, exc = future.result()
+                    yield index, result, exc
+        finally:
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def _safe(func: Callable[[Any], Any], item: Any) -> Tuple[Any, Optional[Exception]]:
+        try:
+            return func(item), None
+        except Exception as exc:
+            return None, exc
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ai-call")
+        return self._pool
+
+    def stats(self) -> Dict[str, Any]:
+        return {"breaker": self.breaker.state, "concurrency": self.concurrency}
+
+
+_CLIENT: Optional[AIClient] = None
+_CLIENT_PID: Optional[int] = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_ai_client() -> AIClient:
+    """按进程创建（fork 出的 worker 不继承父进程的线程池与连接）。"""
+    global _CLIENT, _CLIENT_PID
+    pid = os.getpid()
+    if _CLIENT is None or _CLIENT_PID != pid:
+        with _CLIENT_LOCK:
+            if _CLIENT is None or _CLIENT_PID != pid:
+                _CLIENT = AIClient()
+                _CLIENT_PID = pid
+    return _CLIENT
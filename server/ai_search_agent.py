@@ -5,19 +5,18 @@ AI 检索助手：先走元数据检索，不足时对图片内容做兜底分
 
 import json
 import os
-import re
-from http import HTTPStatus
-from typing import Any, Dict, List, Set
+from contextlib import closing
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from dotenv import load_dotenv
-import dashscope
-from dashscope import MultiModalConversation
-import jieba
 
+from server.ai_cache import file_sha256, get_ai_cache
+from server.ai_client import AIError, get_ai_client
 from server.db import query
+from server.query_analysis import analyze_query
+from server.utils.ai_proxy import proxy_image_url
 
 load_dotenv()
-dashscope.api_key = os.getenv("DASHSCOPE_API_KEY") or dashscope.api_key
 
 DEFAULT_MODEL = os.getenv("DASHSCOPE_MODEL", "qwen-vl-plus")
 UPLOAD_DIR = os.path.abspath(os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "uploads")))
@@ -25,207 +24,21 @@ CONTENT_PROMPT = (
     "你现在是图片检索助手。"
     "用户的搜索意图是：{user_message}。"
     "给定这张图片，请你判断它是否与用户意图相关，并只输出一个 JSON："
-    '{"match_score": 0到1之间的数值, "suggested_tags": ["标签1","标签2","标签3"], "short_caption": "简短描述"} '
+    '{{"match_score": 0到1之间的数值, "suggested_tags": ["标签1","标签2","标签3"], "short_caption": "简短描述"}} '
     "严格输出 JSON，不要输出多余文字。"
 )
 
-_POLITE_PREFIXES = [
-    "请帮我找一下",
-    "请帮我找一份",
-    "请帮我找一张",
-    "请帮我找",
-    "帮我找一下",
-    "帮我找一份",
-    "帮我找一张",
-    "帮我找",
-    "帮我",
-    "我想找",
-    "我想要",
-    "我想搜",
-    "想找",
-    "想搜",
-    "找一下",
-    "帮忙找",
-    "给我找",
-    "麻烦帮忙找",
-]
-_TRAILING_PARTICLES_RE = re.compile(r"[吗嘛呢吧呀啊哦哇啦喽呗～~。！？!,，、\\s]+$")
-_KEYWORD_SPLIT_RE = re.compile(r"[\\s,，。；;、/]+")
-_QUOTE_RE = re.compile(r"[\"“”‘’']([^\"“”‘’']+)[\"“”‘’']")
-_DISPLAY_TRIM_RE = re.compile(r"(有关|相关|关于|图片|照片|图)+$")
 _DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes", "on", "debug")
-
-# 尝试加载自定义词典
-_CUSTOM_DICT = os.path.join(os.path.dirname(__file__), "kb", "custom_dict.txt")
-if os.path.exists(_CUSTOM_DICT):
-    try:
-        jieba.load_userdict(_CUSTOM_DICT)
-    except Exception as exc:  # pragma: no cover - 日志即可
-        print(f"[ai_search] load custom dict failed: {exc}")
-
-_STOPWORDS = {
-    "请",
-    "帮我",
-    "帮忙",
-    "一下",
-    "一个",
-    "一份",
-    "一些",
-    "找",
-    "一下",
-    "寻找",
-    "想要",
-    "想找",
-    "给我",
-    "有没有",
-    "图片",
-    "照片",
-    "图",
-    "的",
-    "与",
-    "关于",
-    "有关",
-    "相关的",
-    "下",
-    "呢",
-    "吗",
-    "了",
-    "和",
-    "是",
-    "你",
-    "这个",
-    "那个",
-    "相关",
-    "搜索",
-    "推荐",
-}
-_SYNONYM_MAP = {
-    "实习鉴定表": ["实习评价表", "实践鉴定表", "实习证明", "鉴定表", "实习考核表"],
-    "鉴定表": ["评价表", "考核表", "证明"],
-}
 MIN_SCORE = float(os.getenv("AI_SEARCH_MIN_SCORE", "2.5"))
-
-
-def _strip_polite_prefixes(text: str) -> str:
-    """
-    Remove common Chinese polite or helper phrases so metadata search uses the core noun.
-    Example: "请帮我找一份实习鉴定表" -> "实习鉴定表".
-    """
-    t = (text or "").strip()
-    if not t:
-        return ""
-    for prefix in _POLITE_PREFIXES:
-        if t.startswith(prefix):
-            t = t[len(prefix) :].lstrip()
-            break
-    for filler in ("一份", "一张", "一个", "一些", "一条"):
-        if t.startswith(filler):
-            t = t[len(filler) :].lstrip()
-            break
-    t = t.lstrip("的").strip()
-    t = _TRAILING_PARTICLES_RE.sub("", t).strip()
-    return t
-
-
-def _extract_quotes(text: str) -> List[str]:
-    """优先保留引号内的关键词短语"""
-    phrases = []
-    for m in _QUOTE_RE.finditer(text):
-        val = m.group(1).strip()
-        if val and val not in phrases:
-            phrases.append(val)
-    return phrases
-
-
-def normalize_query(q: str) -> str:
-    base = _strip_polite_prefixes(q or "")
-    base = re.sub(r'["“”‘’\'\[\]{}()（）]+', " ", base)
-    base = re.sub(r"[^0-9A-Za-z\u4e00-\u9fa5]+", " ", base)
-    return re.sub(r"\s+", " ", base).strip()
-
-
-def tokenize_zh(q: str) -> List[str]:
-    raw = (q or "").strip()
-    normalized = normalize_query(raw)
-    if not normalized:
-        return []
-    tokens: List[str] = []
-    for seg in jieba.cut(normalized, cut_all=False):
-        seg = seg.strip()
-        if seg:
-            tokens.append(seg)
-    # 引号内容作为强关键词优先加入
-    quotes = _extract_quotes(raw)
-    tokens = quotes + tokens
-    return tokens
-
-
-def filter_tokens(tokens: List[str]) -> List[str]:
-    filtered: List[str] = []
-    seen: Set[str] = set()
-    for tok in tokens:
-        t = (tok or "").strip()
-        if not t:
-            continue
-        if t in _STOPWORDS:
-            continue
-        # 丢弃绝大多数单字（保留数字/英文）
-        if len(t) == 1 and not re.match(r"[0-9A-Za-z]", t):
-            continue
-        if t in seen:
-            continue
-        seen.add(t)
-        filtered.append(t)
-    return filtered[:10]
-
-
-def pick_display_keyword(query_obj: Dict[str, Any]) -> str:
-    """Return a concise keyword for UI replies, avoiding full-sentence echoes."""
-    keywords = [k for k in (query_obj.get("keywords") or []) if k]
-    if keywords:
-        return "、".join(keywords[:3])
-    cleaned = (query_obj.get("cleaned_keyword") or "").strip()
-    if cleaned:
-        cleaned = re.sub(r"\s+", " ", cleaned).strip()
-        cleaned = _DISPLAY_TRIM_RE.sub("", cleaned).strip(" 的")
-        if cleaned:
-            return cleaned
-    return (query_obj.get("keyword") or "").strip()
-
-
-def _expand_keywords_with_synonyms(keywords: List[str], cleaned_keyword: str = "") -> List[str]:
-    """
-    Provide lightweight synonym/alias expansions for common nouns to improve recall without a model.
-    """
-    base = [k for k in keywords if k]
-    if cleaned_keyword:
-        base.append(cleaned_keyword)
-    expansions: List[str] = []
-    for kw in base:
-        for key, syns in _SYNONYM_MAP.items():
-            if key in kw or kw in key:
-                for s in syns:
-                    if s not in expansions and s not in base:
-                        expansions.append(s)
-    return expansions
+REMOTE_FALLBACK = os.getenv("AI_SEARCH_REMOTE_FALLBACK", "0").lower() in ("1", "true", "yes", "on")
 
 
 def ai_build_search_query(user_message: str) -> Dict[str, Any]:
-    """构造元数据检索条件（标题/描述/标签模糊匹配）。"""
-    raw_kw = (user_message or "").strip()
-    normalized = normalize_query(raw_kw)
-    tokens_raw = tokenize_zh(raw_kw)
-    keywords = filter_tokens(tokens_raw)
-    cleaned = normalized
+    """构造元数据检索条件（标题/描述/标签模糊匹配）；分析结果来自 query_analysis 的缓存。"""
+    query_obj = analyze_query(user_message).to_query_obj()
     if _DEBUG:
-        print(f"[chat-search] title_query={raw_kw} tokens={keywords}")
-    return {
-        "keyword": raw_kw,
-        "keywords": keywords,
-        "tokens": keywords,
-        "cleaned_keyword": cleaned,
-        "normalized": normalized,
-    }
+        print(f"[chat-search] title_query={query_obj['keyword']} tokens={query_obj['keywords']}")
+    return query_obj
 
 
 def _normalize_tags(tags_raw: Any) -> List[str]:
@@ -453,7 +266,8 @@ def _abs_path(rel_path: str) -> str:
 
 
 def _parse_match_json(text: str) -> Dict[str, Any]:
-    base = {"match_score": 0.0, "suggested_tags": [], "short_caption": ""}
+    # 空回复 / 无法解析时带上 error：按 0 分处理，但不写入 AI 结果缓存（否则这张图在该查询下会被长期当作不匹配）
+    base = {"match_score": 0.0, "suggested_tags": [], "short_caption": "", "error": "模型回复无法解析"}
     if not text:
         return base
     candidate = text.strip()
@@ -488,31 +302,30 @@ def _parse_match_json(text: str) -> Dict[str, Any]:
 
 def _call_match_model(abs_path: str, user_message: str) -> Dict[str, Any]:
     """调用通义千问做单张图片的相似度评估。"""
-    messages = [
-        {"role": "system", "content": [{"text": "你是一个图片检索助手"}]},
-        {
-            "role": "user",
-            "content": [
-                {"image": f"file://{abs_path}"},
-                {"text": CONTENT_PROMPT.format(user_message=user_message)},
-            ],
-        },
-    ]
-    try:
-        resp = MultiModalConversation.call(model=DEFAULT_MODEL, messages=messages)
-    except Exception as exc:  # 网络/鉴权等异常
-        print(f"[ai_search] call error: {exc}")
-        return {"match_score": 0.0, "suggested_tags": [], "short_caption": "", "error": str(exc)}
+    sha = file_sha256(abs_path)
 
-    if resp.status_code != HTTPStatus.OK:
-        print(f"[ai_search] invalid status: {resp.status_code}, message: {getattr(resp, 'message', None)}")
-        return {"match_score": 0.0, "suggested_tags": [], "short_caption": "", "error": getattr(resp, "message", None)}
-
-    contents = resp.output.choices[0]["message"]["content"]
-    text_parts = [c.get("text") for c in contents if isinstance(c, dict) and c.get("text")]
-    combined = "\n".join(filter(None, text_parts)).strip()
-    parsed = _parse_match_json(combined)
-    return parsed
+    def _compute() -> Dict[str, Any]:
+        messages = [
+            {"role": "system", "content": [{"text": "你是一个图片检索助手"}]},
+            {
+                "role": "user",
+                "content": [
+                    {"image": proxy_image_url(abs_path, sha)},
+                    {"text": CONTENT_PROMPT.format(user_message=user_message)},
+                ],
+            },
+        ]
+        try:
+            combined = get_ai_client().call_text(messages, model=DEFAULT_MODEL)
+        except AIError as exc:  # 网络/鉴权/熔断等异常
+            print(f"[ai_search] call error: {exc}")
+            return {"match_score": 0.0, "suggested_tags": [], "short_caption": "", "error": str(exc)}
+        return _parse_match_json(combined)
+
+    # 评分按 (图片内容, 检索意图) 缓存：同一句话重复兜底检索时不再逐张请求模型
+    return get_ai_cache().get_or_compute(
+        "match", abs_path, DEFAULT_MODEL, CONTENT_PROMPT, _compute, variant=(user_message or "").strip(), image_sha256=sha
+    )
 
 
 def _candidate_images(user_id: int, limit: int = 80) -> List[Dict[str, Any]]:
@@ -532,43 +345,137 @@ def _candidate_images(user_id: int, limit: int = 80) -> List[Dict[str, Any]]:
 
 def fallback_content_search(user_message: str, user_id: int, limit: int = 12, score_threshold: float = 0.6) -> List[Dict[str, Any]]:
     """
-    元数据不足时的兜底：对图片内容做相似度分析，返回包含推荐标签的结果。
+    元数据不足时的兜底：先查本地内容索引（全部图片，毫秒级，不调用模型）；
+    索引不可用，或索引没有结果且开启了 AI_SEARCH_REMOTE_FALLBACK 时，才对最近的图片逐张请求模型评估。
     """
-    candidates = _candidate_images(user_id, limit=80)
-    tags_map = _load_tags_map([c["id"] for c in candidates])
+    events = iter_fallback_content_search(user_message, user_id, limit, score_threshold)
+    results = [item for kind, item in events if kind == "hit"]
+    results.sort(key=lambda x: x.get("match_score") or 0, reverse=True)
+    return results[:limit]
+
+
+def iter_fallback_content_search(
+    user_message: str,
+    user_id: int,
+    limit: int = 12,
+    score_threshold: float = 0.6,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    fallback_content_search 的逐条版本（流式接口用），产出 ("hit", 结果) 与 ("progress", {"scored", "total"})：
+    本地索引的结果一次给出；逐张请求模型时每评完一张给一次进度，命中的立即给出（未排序、未截断）。
+    调用方停止迭代后剩余图片不再请求模型。
+    """
+    try:
+        results = _index_content_search(user_message, user_id, limit)
+    except Exception as exc:
+        print(f"[ai_search] content index unavailable: {exc}")
+        results = None
+    if results or (results is not None and not REMOTE_FALLBACK):
+        for item in results:
+            yield "hit", item
+        return
+    yield from _iter_remote_content_search(user_message, user_id, score_threshold, should_stop)
+
+
+def _index_content_search(user_message: str, user_id: int, limit: int) -> List[Dict[str, Any]]:
+    from server.content_index import load_captions, search_content  # numpy 按需加载
+
+    analysis = analyze_query(user_message)
+    text = " ".join([analysis.normalized or analysis.keyword, *analysis.expansions])
+    hits = search_content(user_id, text, k=limit)
+    if not hits:
+        return []
+    ids = [image_id for image_id, _ in hits]
+    placeholders = ",".join(["%s"] * len(ids))
+    rows = {
+        r["id"]: r
+        for r in query(
+            f"SELECT id, title, description, stored_path, path FROM images WHERE owner_id=%s AND id IN ({placeholders})",
+            [user_id, *ids],
+        )
+    }
+    tags_map = _load_tags_map(ids)
+    captions = load_captions(ids)
     results: List[Dict[str, Any]] = []
-    for cand in candidates:
-        rel_path = (cand.get("stored_path") or cand.get("path") or "").strip()
-        if not rel_path:
-            continue
-        abs_path = _abs_path(rel_path)
-        if not os.path.exists(abs_path):
+    for image_id, score in hits:
+        row = rows.get(image_id)
+        if row is None:  # 索引重建前已删除的图片
             continue
-        parsed = _call_match_model(abs_path, user_message)
-        score = parsed.get("match_score") or 0.0
-        try:
-            score_val = float(score)
-        except Exception:
-            score_val = 0.0
-        if score_val < score_threshold:
-            continue
-        url = f"/files/{rel_path}"
+        rel_path = (row.get("stored_path") or row.get("path") or "").strip()
+        url = f"/files/{rel_path}" if rel_path else ""
+        caption = captions.get(image_id) or {}
+        score_val = round(score, 4)
         results.append(
             {
-                "id": cand["id"],
-                "title": cand.get("title") or "未命名",
-                "description": cand.get("description") or "",
+                "id": image_id,
+                "title": row.get("title") or "未命名",
+                "description": row.get("description") or "",
                 "cover_url": url,
                 "thumb_url": url,
-                "tags": tags_map.get(cand["id"], []),
-                "suggested_tags": parsed.get("suggested_tags") or [],
-                "short_caption": parsed.get("short_caption") or "",
+                "tags": tags_map.get(image_id, []),
+                "suggested_tags": _normalize_tags((caption.get("tags") or "").split()),
+                "short_caption": caption.get("caption") or "",
                 "match_score": score_val,
                 "score": score_val,
                 "matched_fields": ["visual"],
-                "match_reason": "semantic_fallback",
-                "detail_url": f"/images/{cand['id']}",
+                "match_reason": "content_index",
+                "detail_url": f"/images/{image_id}",
             }
         )
-    results.sort(key=lambda x: x.get("match_score") or 0, reverse=True)
-    return results[:limit]
+    return results
+
+
+def _iter_remote_content_search(
+    user_message: str,
+    user_id: int,
+    score_threshold: float,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """逐张请求模型评估最近的 80 张图片（旧的兜底方式，成本高，仅作后备）。"""
+    candidates = _candidate_images(user_id, limit=80)
+    tags_map = _load_tags_map([c["id"] for c in candidates])
+    todo = []
+    for cand in candidates:
+        rel_path = (cand.get("stored_path") or cand.get("path") or "").strip()
+        if not rel_path:
+            continue
+        abs_path = _abs_path(rel_path)
+        if not os.path.exists(abs_path):
+            continue
+        todo.append((cand, rel_path, abs_path))
+
+    def _score(item) -> Dict[str, Any]:
+        if should_stop and should_stop():  # 已排队的任务开始时调用方已经停止，不再请求模型
+            return {}
+        return _call_match_model(item[2], user_message)
+
+    # 候选图片并发评估（并发数/限流/熔断见 ai_client），熔断打开后剩余的调用直接失败返回；
+    # 按完成顺序产出，调用方停止（should_stop 或关闭本生成器）后未开始的调用直接取消
+    with closing(get_ai_client().iter_fan_out(_score, todo, should_stop)) as outcomes:
+        for scored, (index, parsed, _exc) in enumerate(outcomes, 1):
+            cand, rel_path, _ = todo[index]
+            parsed = parsed or {}
+            score = parsed.get("match_score") or 0.0
+            try:
+                score_val = float(score)
+            except Exception:
+                score_val = 0.0
+            if score_val >= score_threshold:
+                url = f"/files/{rel_path}"
+                yield "hit", {
+                    "id": cand["id"],
+                    "title": cand.get("title") or "未命名",
+                    "description": cand.get("description") or "",
+                    "cover_url": url,
+                    "thumb_url": url,
+                    "tags": tags_map.get(cand["id"], []),
+                    "suggested_tags": parsed.get("suggested_tags") or [],
+                    "short_caption": parsed.get("short_caption") or "",
+                    "match_score": score_val,
+                    "score": score_val,
+                    "matched_fields": ["visual"],
+                    "match_reason": "semantic_fallback",
+                    "detail_url": f"/images/{cand['id']}",
+                }
+            yield "progress", {"scored": scored, "total": len(todo)}
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+批量 AI 自动标签：为已有图库里还没跑过 AI 标注的图片生成标签，写入 tags（kind='system'）/ image_tags。
+
+- 进度记在 images.ai_tagged_at：处理完（包括模型没给出标签、原图文件缺失）即写入时间，失败的保持 NULL；
+  按 id 递增分批，随时中断，重跑从剩下的图片继续
+- 发给模型的是缩小副本（utils/ai_proxy.py），结果按原图 sha256 缓存（ai_cache.py），
+  并发 / 限流 / 重试 / 熔断由 ai_client 控制；熔断时本轮直接停止，失败的图片不标记
+- 每批在一个事务里批量写标签、关联与进度，然后让该用户的缓存失效
+- 同一时刻只有一个进程在跑（MySQL GET_LOCK），命令行工具与各 worker 的后台线程不会重复处理
+
+命令行：python -m server.tools.ai_tag_images
+
+环境变量：
+  AI_TAGGER_INTERVAL   后台线程轮询间隔秒数（默认 0，不启动；只用命令行工具）
+  AI_TAGGER_BATCH      每批图片数（默认 32）
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from server.ai_cache import file_sha256, get_ai_cache
+from server.ai_client import AIUnavailable, get_ai_client
+from server.db import dict_cursor, get_conn, query
+from server.photo_analysis_agent import analyze_image
+from server.result_cache import bump_owner_generation
+from server.utils.ai_proxy import take_sent_bytes
+from server.utils.env import env_float
+
+_LOCK_NAME = "bs_ai_tagger"
+_HAS_COLUMN: Optional[bool] = None
+
+
+class TaggerStats:
+    def __init__(self):
+        self.started = time.time()
+        self.images = 0
+        self.tagged = 0
+        self.failed = 0
+        self.missing = 0
+        self.tags_added = 0
+        self.cache_hits = 0
+        self.bytes_original = 0
+        self.bytes_sent = 0
+        self.stopped_reason = ""
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.images / self.elapsed if self.elapsed > 0 else 0.0
+
+    def line(self) -> str:
+        return (
+            f"{self.images} 张（成功 {self.tagged}，失败 {self.failed}，缺文件 {self.missing}），"
+            f"{self.rate:.1f} 张/s，缓存命中 {self.cache_hits}，新增关联 {self.tags_added}，"
+            f"发送 {self.bytes_sent / 1048576:.1f}MB（原图 {self.bytes_original / 1048576:.1f}MB）"
+        )
+
+
+def has_progress_column() -> bool:
+    global _HAS_COLUMN
+    if _HAS_COLUMN is None:
+        try:
+            rows = query(
+                """
+                SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME='ai_tagged_at'
+                LIMIT 1
+                """
+            )
+            _HAS_COLUMN = bool(rows)
+        except Exception:
+            return False
+    return _HAS_COLUMN
+
+
+@contextmanager
+def run_lock():
+    """独占锁：拿到时 yield True；连接关闭即释放。"""
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT GET_LOCK(%s, 0) AS ok", (_LOCK_NAME,))
+            yield bool((cur.fetchone() or {}).get("ok"))
+    finally:
+        conn.close()
+
+
+def pending_owner_ids() -> List[int]:
+    return [r["owner_id"] for r in query("SELECT DISTINCT owner_id FROM images WHERE ai_tagged_at IS NULL")]
+
+
+def _analyze(item: Tuple[int, str, Optional[str]]) -> Tuple[Dict[str, Any], int, int]:
+    """返回 (结果, 原图字节, 实际发送字节)；命中 AI 结果缓存时没有上传，两个字节数都记 0。"""
+    _, abs_path, sha = item
+    sha = sha or file_sha256(abs_path)
+    take_sent_bytes()
+    result = analyze_image(abs_path, image_sha256=sha)  # 内部只发送缩小副本
+    sent = take_sent_bytes()
+    return result, os.path.getsize(abs_path) if sent else 0, sent
+
+
+def _write_batch(owner_id: Any, results: Dict[int, List[str]], done_ids: List[int]) -> int:
+    """一个事务内：补齐标签 -> 批量关联 -> 写进度。返回新增关联数。"""
+    names = sorted({n[:64] for tags in results.values() for n in tags})
+    added = 0
+    with dict_cursor() as (conn, cur):
+        conn.begin()
+        if names:
+            cur.executemany(
+                "INSERT IGNORE INTO tags (owner_id,name,kind) VALUES (%s,%s,'system')",
+                [(owner_id, n) for n in names],
+            )
+            cur.execute(
+                f"SELECT id, name FROM tags WHERE owner_id=%s AND name IN ({','.join(['%s'] * len(names))})",
+                [owner_id, *names],
+            )
+            tag_ids = {r["name"]: r["id"] for r in cur.fetchall()}
+            pairs = [
+                (image_id, tag_ids[n[:64]])
+                for image_id, tags in results.items()
+                for n in tags
+                if n[:64] in tag_ids
+            ]
+            if pairs:
+                added = cur.executemany("INSERT IGNORE INTO image_tags (image_id,tag_id) VALUES (%s,%s)", pairs) or 0
+        if done_ids:
+            cur.execute(
+                f"UPDATE images SET ai_tagged_at=NOW() WHERE owner_id=%s AND id IN ({','.join(['%s'] * len(done_ids))})",
+                [owner_id, *done_ids],
+            )
+    return added
+
+
+def tag_owner(
+    owner_id: Any,
+    upload_root: str,
+    limit: Optional[int] = None,
+    stats: Optional[TaggerStats] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    on_batch: Optional[Callable[[TaggerStats], None]] = None,
+) -> TaggerStats:
+    """处理该用户还没有 AI 标签的图片；limit 为本次最多处理的张数。"""
+    stats = stats or TaggerStats()
+    batch = max(1, int(env_float("AI_TAGGER_BATCH", 32)))
+    upload_root = os.path.abspath(upload_root)
+    cache = get_ai_cache()
+    last_id = 0
+    handled = 0
+    while limit is None or handled < limit:
+        if should_stop and should_stop():
+            stats.stopped_reason = "stopped"
+            break
+        size = batch if limit is None else min(batch, limit - handled)
+        rows = query(
+            "SELECT id, stored_path, path, sha256 FROM images "
+            "WHERE owner_id=%s AND ai_tagged_at IS NULL AND id>%s ORDER BY id LIMIT %s",
+            (owner_id, last_id, size),
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        handled += len(rows)
+
+        todo, done_ids = [], []
+        for r in rows:
+            rel = (r.get("stored_path") or r.get("path") or "").strip().lstrip("/\\")
+            abs_path = os.path.abspath(os.path.join(upload_root, rel))
+            if rel and abs_path.startswith(upload_root + os.sep) and os.path.exists(abs_path):
+                todo.append((r["id"], abs_path, r.get("sha256")))
+            else:
+                stats.missing += 1
+                done_ids.append(r["id"])
+
+        hits_before = cache.stats["mem_hits"] + cache.stats["db_hits"]
+        outcomes = get_ai_client().fan_out(_analyze, todo)
+        stats.cache_hits += cache.stats["mem_hits"] + cache.stats["db_hits"] - hits_before
+
+        results: Dict[int, List[str]] = {}
+        unavailable = False
+        for (image_id, _, _), (value, exc) in zip(todo, outcomes):
+            if exc is not None:
+                stats.failed += 1
+                unavailable = unavailable or isinstance(exc, AIUnavailable)
+                print(f"[ai_tagger] image {image_id} failed: {exc}")
+                continue
+            result, original_bytes, sent_bytes = value
+            stats.bytes_original += original_bytes
+            stats.bytes_sent += sent_bytes
+            stats.tagged += 1
+            results[image_id] = list(result.get("tags") or [])
+            done_ids.append(image_id)
+        stats.images += len(rows)
+
+        if done_ids:
+            stats.tags_added += _write_batch(owner_id, results, done_ids)
+            bump_owner_generation(owner_id)
+        if on_batch:
+            on_batch(stats)
+        if unavailable:
+            stats.stopped_reason = "ai_unavailable"
+            break
+    return stats
+
+
+def tag_all(
+    upload_root: str,
+    owner_ids: Optional[List[int]] = None,
+    limit: Optional[int] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    on_batch: Optional[Callable[[Any, TaggerStats], None]] = None,
+) -> Dict[Any, TaggerStats]:
+    out: Dict[Any, TaggerStats] = {}
+    for owner_id in owner_ids or pending_owner_ids():
+        callback = (lambda s, o=owner_id: on_batch(o, s)) if on_batch else None
+        stats = tag_owner(owner_id, upload_root, limit, should_stop=should_stop, on_batch=callback)
+        out[owner_id] = stats
+        if stats.stopped_reason:
+            break
+    return out
+
+
+# ===== 后台线程 =====
+
+_LAST_RUN: Dict[str, Any] = {}
+
+
+class _Worker:
+    def __init__(self):
+        self.pid: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def ensure(self, upload_root: str) -> None:
+        pid = os.getpid()
+        if self.pid == pid or env_float("AI_TAGGER_INTERVAL", 0) <= 0:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            # gunicorn fork 出的 worker 不继承父进程的线程，按 pid 各自启动；真正干活的只有拿到锁的那个
+            threading.Thread(target=self._loop, args=(upload_root,), name="ai-tagger", daemon=True).start()
+            self.pid = pid
+
+    def _loop(self, upload_root: str) -> None:
+        interval = max(10.0, env_float("AI_TAGGER_INTERVAL", 0))
+        while True:
+            time.sleep(interval)
+            try:
+                if not has_progress_column():
+                    continue
+                with run_lock() as ok:
+                    if not ok:
+                        continue
+                    t0 = time.time()
+                    results = tag_all(upload_root)
+                    if results:
+                        total = sum(s.images for s in results.values())
+                        _LAST_RUN.update(
+                            finished_at=time.time(),
+                            owners=len(results),
+                            images=total,
+                            seconds=round(time.time() - t0, 1),
+                            stopped_reason=next((s.stopped_reason for s in results.values() if s.stopped_reason), ""),
+                        )
+                        print(f"[ai_tagger] {len(results)} owners, {total} images in {time.time() - t0:.1f}s")
+            except Exception as exc:
+                print(f"[ai_tagger] run failed: {exc}")
+
+
+_WORKER = _Worker()
+
+
+def ensure_tagger(upload_root: str) -> None:
+    _WORKER.ensure(upload_root)
+
+
+def tagger_stats() -> Dict[str, Any]:
+    return dict(_LAST_RUN)
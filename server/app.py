@@ -208,7 +208,11 @@ def create_app() -> Flask:
 
     # CORS：仅放开 /api/*，前端本地开发会用到
     #CORS(app, resources={r"/api/*": {"origins": "*"}})
-    CORS(app, resources={   r"/api/*": {"origins": "*"},   r"/files/*": {"origins": "*"}})
+    CORS(
+        app,
+        resources={r"/api/*": {"origins": "*"}, r"/files/*": {"origins": "*"}},
+        expose_headers=["ETag", "X-Preview-Scale"],
+    )
 
     # 注册 JWT
     jwt = JWTManager(app)  # noqa: F841
@@ -252,6 +256,23 @@ def create_app() -> Flask:
     def health():
         return _ok({"status": "ok"})
 
+    @app.get("/api/health/stats")
+    @jwt_required()
+    def health_stats():
+        """各进程内缓存 / AI 调用的运行统计（需登录；探活请用 /api/health）。"""
+        from .ai_cache import ai_cache_stats
+        from .ai_tagger import tagger_stats
+        from .query_analysis import query_cache_stats
+        from .utils.ai_proxy import ai_proxy_stats
+        return _ok(
+            {
+                "query_cache": query_cache_stats(),
+                "ai_cache": ai_cache_stats(),
+                "ai_tagger": tagger_stats(),
+                "ai_proxy": ai_proxy_stats(),
+            }
+        )
+
     @app.post("/api/auth/register")
     def register():
         """
@@ -354,6 +375,10 @@ def create_app() -> Flask:
     app.register_blueprint(images_bp)
     app.register_blueprint(ai_bp)
 
+    # jieba/dashscope 改为按需加载；这里在后台线程里提前预热，不阻塞 worker 启动
+    from .lazy_deps import start_warmup
+    start_warmup()
+
     return app
 
 
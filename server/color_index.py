@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+按颜色检索（“蓝天”“大部分是红色”），不经过远程模型。
+
+- 存储：images.color_sig（server/utils/color_signature.py，85 字节），上传与编辑导出时计算；
+  旧图片用 `python -m server.tools.backfill_image_features` 补算
+- 索引：每个用户一份 (N, 64) float32 矩阵，构建时就乘好格间相似度矩阵；
+  查询时只取目标分布非零的几列与目标求直方图交集，全量向量化计算，几十万张图也在几十毫秒内
+- 失效：与相似图片索引相同（owner_index_cache.OwnerIndexCache，按用户数据版本号后台重建）
+
+环境变量：
+  COLOR_INDEX_MEM_OWNERS   进程内缓存的用户索引数（默认 8）
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from server.db import execute, query
+from server.owner_index_cache import OwnerIndexCache
+from server.result_cache import owner_generation
+from server.utils.color_signature import BIN_SIMILARITY, unpack_histograms, unpack_palette, valid_signature
+from server.utils.env import env_int
+
+_HAS_COLUMN: Optional[bool] = None
+
+
+class ColorIndex:
+    def __init__(self, ids: List[int], sigs: List[bytes], gen: Optional[int]):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.sigs = sigs
+        # 相似度矩阵是对称的，hist @ S 即每张图“借”到相邻格子后的分布
+        self.hist = unpack_histograms(sigs) @ BIN_SIMILARITY
+        self.gen = gen
+        self.built_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def scores(self, target: np.ndarray) -> np.ndarray:
+        cols = np.flatnonzero(target)
+        if not len(self) or not len(cols):
+            return np.zeros(len(self), dtype=np.float32)
+        return np.minimum(self.hist[:, cols], target[cols]).sum(axis=1)
+
+    def search(self, target: np.ndarray, limit: int = 50, min_score: float = 0.1) -> List[Dict[str, Any]]:
+        scores = self.scores(target)
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.lexsort((self.ids[top], -scores[top]))]
+        return [
+            {"image_id": int(self.ids[i]), "score": round(float(scores[i]), 4), "palette": unpack_palette(self.sigs[i])}
+            for i in top
+            if scores[i] >= min_score
+        ]
+
+
+def has_color_column() -> bool:
+    global _HAS_COLUMN
+    if _HAS_COLUMN is None:
+        try:
+            rows = query(
+                """
+                SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME='color_sig'
+                LIMIT 1
+                """
+            )
+            _HAS_COLUMN = bool(rows)
+        except Exception:
+            return False
+    return _HAS_COLUMN
+
+
+def build_color_index(owner_id: Any) -> ColorIndex:
+    gen = owner_generation(owner_id)
+    rows = query("SELECT id, color_sig FROM images WHERE owner_id=%s AND color_sig IS NOT NULL", (owner_id,))
+    rows = [r for r in rows if valid_signature(r["color_sig"])]
+    return ColorIndex([r["id"] for r in rows], [bytes(r["color_sig"]) for r in rows], gen)
+
+
+_CACHE = OwnerIndexCache("color_index", build_color_index, lambda: env_int("COLOR_INDEX_MEM_OWNERS", 8))
+
+
+def store_color_signature(image_id: int, sig: Optional[bytes]) -> None:
+    if not sig or not has_color_column():
+        return
+    try:
+        execute("UPDATE images SET color_sig=%s WHERE id=%s", (sig, image_id))
+    except Exception as exc:
+        print(f"[color_index] store signature failed: {exc}")
+
+
+def search_by_color(
+    owner_id: Any,
+    target: np.ndarray,
+    limit: int = 50,
+    min_score: float = 0.1,
+) -> List[Dict[str, Any]]:
+    if not has_color_column():
+        return []
+    return _CACHE.get(owner_id).search(target, limit=limit, min_score=min_score)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+本地内容检索索引：AI 兜底检索不再逐张把图片发给模型打分，而是在本地对全部图片做向量检索。
+
+- 文本：标题、描述、标签，加上一次性 AI 生成的内容描述（image_captions 表，
+  由 `python -m server.tools.build_content_index --caption` 生成）
+- 向量：中文按字的 1-gram + 2-gram、英文/数字按词，哈希成特征号后做 TF-IDF（对数词频）并按行 L2 归一化，
+  每个用户一份 CSR 稀疏矩阵（NumPy 数组），查询向量同样处理后取余弦 top-k
+- 检索路径：
+    扫描   对全部非零项做一次向量化计算，适合中小图库
+    倒排   图片数达到 CONTENT_INDEX_IVF_MIN 时按特征建倒排表，只累加查询特征对应的倒排项
+  两条路径结果完全一致（都是精确余弦），倒排只是少算了与查询无关的部分
+- 失效：索引记录构建时的用户数据版本号（result_cache.owner_generation），
+  版本变化后先继续用旧索引，同时后台重建（版本号表不可用时每 5 分钟重建）；
+  索引文件写到 CONTENT_INDEX_DIR，多个 worker 共享，重建时只有拿到文件锁的 worker 构建，其余读文件
+
+环境变量：
+  CONTENT_INDEX_DIR         索引文件目录（默认系统临时目录下 bs_content_index）
+  CONTENT_INDEX_IVF_MIN     启用倒排检索的图片数（默认 5000）
+  CONTENT_INDEX_MEM_OWNERS  进程内缓存的用户索引数（默认 8）
+"""
+
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from server.db import executemany, query
+from server.owner_index_cache import OwnerIndexCache
+from server.result_cache import bump_owner_generation, owner_generation
+from server.utils.env import env_int
+
+_FEATURE_SPACE = 1 << 22
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_TAG_WEIGHT = 2  # 标签比描述里的字更能代表内容
+_STALE_SECONDS = 300
+
+
+def _feature(token: str) -> int:
+    return zlib.crc32(token.encode("utf-8")) % _FEATURE_SPACE
+
+
+def text_features(text: str, weight: int = 1) -> Counter:
+    """文本 -> {特征号: 次数}。中文取单字与相邻两字，英文/数字取整词。"""
+    counts: Counter = Counter()
+    text = (text or "").lower()
+    for run in _CJK_RE.findall(text):
+        for i, ch in enumerate(run):
+            counts[_feature(ch)] += weight
+            if i + 1 < len(run):
+                counts[_feature(run[i:i + 2])] += weight
+    for word in _WORD_RE.findall(text):
+        counts[_feature(word)] += weight
+    return counts
+
+
+def _row_features(row: Dict[str, Any]) -> Counter:
+    counts = text_features(" ".join(filter(None, [row.get("title"), row.get("description"), row.get("caption")])))
+    counts.update(text_features(" ".join(filter(None, [row.get("tag_text"), row.get("caption_tags")])), _TAG_WEIGHT))
+    return counts
+
+
+class ContentIndex:
+    """一个用户的 TF-IDF 矩阵（CSR）与可选的倒排表。"""
+
+    def __init__(self, ids, indptr, indices, data, features, idf, gen: Optional[int] = None):
+        self.ids = ids          # (N,) 图片 id
+        self.indptr = indptr    # (N+1,) 每行在 indices/data 中的起止
+        self.indices = indices  # (nnz,) 特征号
+        self.data = data        # (nnz,) 已乘 idf 并归一化的权重
+        self.features = features  # 出现过的特征号（升序）
+        self.idf = idf            # 与 features 对齐
+        self.gen = gen
+        self.built_at = time.time()
+        self._rows = np.repeat(np.arange(len(ids), dtype=np.int32), np.diff(indptr))
+        self._postings: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, rows: Iterable[Dict[str, Any]], gen: Optional[int] = None) -> "ContentIndex":
+        ids: List[int] = []
+        per_row: List[Counter] = []
+        df: Counter = Counter()
+        for row in rows:
+            counts = _row_features(row)
+            ids.append(int(row["id"]))
+            per_row.append(counts)
+            df.update(counts.keys())
+        n = len(ids)
+        features = np.array(sorted(df), dtype=np.int32)
+        idf = np.array([math.log((1 + n) / (1 + df[f])) + 1.0 for f in features.tolist()], dtype=np.float32)
+        idf_map = dict(zip(features.tolist(), idf.tolist()))
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indices: List[int] = []
+        data: List[float] = []
+        for i, counts in enumerate(per_row):
+            items = sorted(counts.items())
+            weights = [(1.0 + math.log(tf)) * idf_map[f] for f, tf in items]
+            norm = math.sqrt(sum(w * w for w in weights)) or 1.0
+            indices.extend(f for f, _ in items)
+            data.extend(w / norm for w in weights)
+            indptr[i + 1] = len(indices)
+        return cls(
+            np.array(ids, dtype=np.int64),
+            indptr,
+            np.array(indices, dtype=np.int32),
+            np.array(data, dtype=np.float32),
+            features,
+            idf,
+            gen,
+        )
+
+    def query_vector(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """查询文本 -> (特征号, 权重)，只保留索引里出现过的特征，权重已归一化。"""
+        counts = text_features(text)
+        if not counts or not len(self.features):
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        feats = np.array(sorted(counts), dtype=np.int32)
+        pos = np.searchsorted(self.features, feats)
+        pos = np.minimum(pos, len(self.features) - 1)
+        known = self.features[pos] == feats
+        feats, pos = feats[known], pos[known]
+        tf = np.array([counts[f] for f in feats.tolist()], dtype=np.float32)
+        weights = (1.0 + np.log(tf)) * self.idf[pos] if len(feats) else tf
+        norm = float(np.linalg.norm(weights)) or 1.0
+        return feats, (weights / norm).astype(np.float32)
+
+    def scores_scan(self, feats: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """扫描全部非零项（向量化），返回每张图片的余弦分数。"""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        if not len(feats):
+            return scores
+        pos = np.searchsorted(feats, self.indices)
+        pos = np.minimum(pos, len(feats) - 1)
+        hit = feats[pos] == self.indices
+        contrib = self.data[hit] * weights[pos[hit]]
+        return np.bincount(self._rows[hit], weights=contrib, minlength=len(self.ids)).astype(np.float32)
+
+    def _build_postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with self._lock:
+            if self._postings is None:
+                order = np.argsort(self.indices, kind="stable")
+                sorted_feats = self.indices[order]
+                starts = np.searchsorted(sorted_feats, self.features, side="left")
+                ends = np.searchsorted(sorted_feats, self.features, side="right")
+                self._postings = (
+                    self._rows[order],
+                    self.data[order],
+                    np.stack([starts, ends], axis=1),
+                )
+        return self._postings
+
+    def scores_inverted(self, feats: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """倒排：只累加查询特征的倒排项，耗时与命中的倒排长度成正比。"""
+        if not len(feats):
+            return np.zeros(len(self.ids), dtype=np.float32)
+        rows, data, bounds = self._build_postings()
+        pos = np.searchsorted(self.features, feats)
+        parts_rows = []
+        parts_vals = []
+        for p, w in zip(pos.tolist(), weights.tolist()):
+            start, end = bounds[p]
+            parts_rows.append(rows[start:end])
+            parts_vals.append(data[start:end] * w)
+        return np.bincount(
+            np.concatenate(parts_rows), weights=np.concatenate(parts_vals), minlength=len(self.ids)
+        ).astype(np.float32)
+
+    def search(self, text: str, k: int = 12, min_score: float = 0.05, inverted: Optional[bool] = None) -> List[Tuple[int, float]]:
+        """返回 [(图片 id, 余弦分数)]，按分数降序，最多 k 条。"""
+        if not len(self.ids) or k <= 0:
+            return []
+        feats, weights = self.query_vector(text)
+        if inverted is None:
+            inverted = len(self.ids) >= env_int("CONTENT_INDEX_IVF_MIN", 5000)
+        scores = self.scores_inverted(feats, weights) if inverted else self.scores_scan(feats, weights)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self.ids[i]), float(scores[i])) for i in top if scores[i] >= min_score]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                ids=self.ids, indptr=self.indptr, indices=self.indices, data=self.data,
+                features=self.features, idf=self.idf,
+                gen=np.array([-1 if self.gen is None else self.gen], dtype=np.int64),
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ContentIndex":
+        with np.load(path) as z:
+            gen = int(z["gen"][0])
+            index = cls(z["ids"], z["indptr"], z["indices"], z["data"], z["features"], z["idf"], None if gen < 0 else gen)
+        index.built_at = os.path.getmtime(path)
+        return index
+
+
+_ROWS_SQL = """
+    SELECT i.id, i.title, i.description, {caption_cols}
+           GROUP_CONCAT(t.name SEPARATOR ' ') AS tag_text
+    FROM images i
+    {caption_join}
+    LEFT JOIN image_tags it ON it.image_id = i.id
+    LEFT JOIN tags t ON t.id = it.tag_id
+    WHERE i.owner_id=%s
+    GROUP BY i.id, i.title, i.description{caption_group}
+"""
+
+
+def _owner_rows(owner_id: Any) -> List[Dict[str, Any]]:
+    try:
+        return query(
+            _ROWS_SQL.format(
+                caption_cols="c.caption, c.tags AS caption_tags,",
+                caption_join="LEFT JOIN image_captions c ON c.image_id = i.id",
+                caption_group=", c.caption, c.tags",
+            ),
+            (owner_id,),
+        )
+    except Exception as exc:
+        # 还没执行 image_captions 迁移时只用标题/描述/标签
+        print(f"[content_index] captions unavailable: {exc}")
+        return query(_ROWS_SQL.format(caption_cols="", caption_join="", caption_group=""), (owner_id,))
+
+
+def _index_path(owner_id: Any) -> str:
+    root = os.getenv("CONTENT_INDEX_DIR") or os.path.join(tempfile.gettempdir(), "bs_content_index")
+    return os.path.join(root, f"owner-{owner_id}.npz")
+
+
+def build_owner_index(owner_id: Any) -> ContentIndex:
+    """从数据库重建该用户的索引并写盘。版本号在读数据之前取，构建期间的写入会让索引再次过期。"""
+    gen = owner_generation(owner_id)
+    index = ContentIndex.build(_owner_rows(owner_id), gen)
+    try:
+        index.save(_index_path(owner_id))
+    except OSError as exc:
+        print(f"[content_index] save index failed: {exc}")
+    return index
+
+
+def _load_owner_index(owner_id: Any) -> Optional[ContentIndex]:
+    path = _index_path(owner_id)
+    return ContentIndex.load(path) if os.path.exists(path) else None
+
+
+_CACHE = OwnerIndexCache(
+    "content_index",
+    build_owner_index,
+    lambda: env_int("CONTENT_INDEX_MEM_OWNERS", 8),
+    _STALE_SECONDS,
+    load=_load_owner_index,
+    lock_path=lambda owner_id: _index_path(owner_id) + ".lock",
+)
+
+
+def get_owner_index(owner_id: Any) -> ContentIndex:
+    """取该用户的索引：内存 -> 索引文件 -> 同步构建；数据版本变了时先返回旧索引，后台重建。"""
+    return _CACHE.get(owner_id)
+
+
+def search_content(owner_id: Any, text: str, k: int = 12, min_score: float = 0.05) -> List[Tuple[int, float]]:
+    return get_owner_index(owner_id).search(text, k=k, min_score=min_score)
+
+
+def load_captions(image_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    if not image_ids:
+        return {}
+    placeholders = ",".join(["%s"] * len(image_ids))
+    try:
+        rows = query(f"SELECT image_id, caption, tags FROM image_captions WHERE image_id IN ({placeholders})", image_ids)
+    except Exception:
+        return {}
+    return {r["image_id"]: r for r in rows}
+
+
+def caption_images(owner_id: Any, upload_root: str, limit: Optional[int] = None) -> int:
+    """
+    对还没有内容描述的图片调用一次 analyze_image，结果写入 image_captions，返回写入条数。
+    调用经由 ai_client（并发/限流/重试）与 ai_cache（按内容缓存），中断后重跑只处理剩下的图片。
+    """
+    from server.ai_client import get_ai_client
+    from server.photo_analysis_agent import DEFAULT_MODEL, analyze_image
+
+    sql = (
+        "SELECT i.id, i.stored_path, i.path FROM images i "
+        "LEFT JOIN image_captions c ON c.image_id = i.id "
+        "WHERE i.owner_id=%s AND c.image_id IS NULL ORDER BY i.id"
+    )
+    rows = query(sql + (" LIMIT %s" if limit else ""), (owner_id, limit) if limit else (owner_id,))
+    todo = []
+    for r in rows:
+        rel = (r.get("stored_path") or r.get("path") or "").strip().lstrip("/\\")
+        abs_path = os.path.abspath(os.path.join(upload_root, rel))
+        if rel and os.path.exists(abs_path):
+            todo.append((r["id"], abs_path))
+
+    written = 0
+    batch = 32
+    for start in range(0, len(todo), batch):
+        chunk = todo[start:start + batch]
+        outcomes = get_ai_client().fan_out(lambda item: analyze_image(item[1]), chunk)
+        values = []
+        for (image_id, _), (result, exc) in zip(chunk, outcomes):
+            if exc is not None or not result:
+                print(f"[content_index] caption image {image_id} failed: {exc}")
+                continue
+            caption = " ".join(filter(None, [result.get("title"), result.get("description")]))
+            values.append((image_id, owner_id, caption, " ".join(result.get("tags") or [])[:255], DEFAULT_MODEL))
+        if values:
+            executemany(
+                "INSERT INTO image_captions (image_id, owner_id, caption, tags, model) VALUES (%s,%s,%s,%s,%s) "
+                "ON DUPLICATE KEY UPDATE caption=VALUES(caption), tags=VALUES(tags), model=VALUES(model)",
+                values,
+            )
+            written += len(values)
+    if written:
+        bump_owner_generation(owner_id)  # 让索引与结果缓存都看到新的描述
+    return written
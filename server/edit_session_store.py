@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+图片编辑会话存储。
+
+- 内存注册表按 session_id 分片，每个分片一把锁，避免所有会话请求争用同一把全局锁
+- 磁盘上的 edit_sessions/<id>/session.json 即共享索引：内存未命中时按 id 直接读取，
+  不扫描目录；其他 worker 改写过 session.json（mtime/大小变化）时自动重新加载
+- 跨 worker / 跨主机（共享 uploads 卷）的修改：session.json 带递增的 rev，
+  修改前用 locked() 取得进程内锁 + 会话目录下的 flock，并把内存副本刷新到磁盘最新版本；
+  写回时按 rev 做比较交换，rev 不一致（文件锁不可用时的并发写）抛 EditSessionConflict
+- 写回采用 write-behind：apply/undo/redo 只追加一行紧凑 JSON 到 wal.log（无 fsync），
+  后台线程按间隔把 wal 合并进 session.json（临时文件 + rename），进程退出时全部合并；
+  读取时 session.json + wal.log 重放即为最新状态，崩溃后同样按此恢复
+- 过期清理与合并写回由同一个后台线程定时执行，不再放在请求路径或模块导入时
+
+环境变量：
+  EDIT_SESSION_TTL_MINUTES    会话闲置多久后清理（默认 60）
+  EDIT_SESSION_SWEEP_SECONDS  后台清理间隔（默认 300）
+  EDIT_SESSION_FLUSH_SECONDS  wal 合并进 session.json 的间隔（默认 2）
+  EDIT_SESSION_WRITE_BEHIND   设为 0 则每次修改同步写 session.json
+"""
+
+import atexit
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from server.utils.env import env_float, env_int
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发：只有进程内锁
+    fcntl = None
+
+_SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_SHARD_COUNT = 16
+
+
+class EditSessionConflict(Exception):
+    """会话已被其他 worker 修改（rev 不一致）。"""
+
+
+def _parse_dt(raw: str) -> datetime:
+    try:
+        return datetime.fromisoformat(raw)
+    except Exception:
+        return datetime.utcnow()
+
+
+@dataclass
+class EditSession:
+    session_id: str
+    owner_id: int
+    image_id: int
+    orig_abs_path: str
+    orig_rel_path: str
+    ext: str
+    versions: List[str]
+    idx: int
+    created_at: datetime
+    updated_at: datetime
+    # ops[i] 记录生成 versions[i] 的操作 {"op":..., "params":...}；ops[0] 为 None（原图）
+    ops: List[Optional[Dict]] = field(default_factory=list)
+    # 每次写回 session.json 加 1，用于跨 worker 的乐观并发控制
+    rev: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # 最近一次读写时的 (session.json mtime_ns, 大小, wal.log 大小)，用于发现其他 worker 的改动
+    stamp: Optional[Tuple[int, int, int]] = field(default=None, repr=False, compare=False)
+    # 已写入 session.json / wal.log 的 (version, op) 历史，追加 wal 记录时只写变化的尾部
+    logged_history: List[Tuple[str, Optional[Dict]]] = field(default_factory=list, repr=False, compare=False)
+
+    def history(self) -> List[Tuple[str, Optional[Dict]]]:
+        ops = self.ops if len(self.ops) == len(self.versions) else [None] * len(self.versions)
+        return list(zip(self.versions, ops))
+
+    def to_dict(self) -> Dict:
+        return {
+            "session_id": self.session_id,
+            "owner_id": self.owner_id,
+            "image_id": self.image_id,
+            "orig_rel_path": self.orig_rel_path,
+            "ext": self.ext,
+            "versions": self.versions,
+            "ops": self.ops,
+            "idx": self.idx,
+            "rev": self.rev,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+        }
+
+    @classmethod
+    def from_dict(cls, meta: Dict, upload_root: str, fallback_id: str = "") -> Optional["EditSession"]:
+        session_id = meta.get("session_id") or fallback_id
+        owner_id = int(meta.get("owner_id") or 0)
+        image_id = int(meta.get("image_id") or 0)
+        orig_rel = (meta.get("orig_rel_path") or "").strip()
+        ext = (meta.get("ext") or "").strip().lower()
+        versions = meta.get("versions") or []
+        ops = meta.get("ops") or []
+        idx = int(meta.get("idx") or 0)
+        if not session_id or not owner_id or not image_id or not orig_rel or not versions:
+            return None
+        if idx < 0 or idx >= len(versions):
+            idx = max(0, min(len(versions) - 1, idx))
+        return cls(
+            session_id=session_id,
+            owner_id=owner_id,
+            image_id=image_id,
+            orig_abs_path=os.path.join(upload_root, orig_rel),
+            orig_rel_path=orig_rel,
+            ext=ext,
+            versions=versions,
+            idx=idx,
+            created_at=_parse_dt(meta.get("created_at") or ""),
+            updated_at=_parse_dt(meta.get("updated_at") or ""),
+            ops=ops if len(ops) == len(versions) else [],
+            rev=int(meta.get("rev") or 0),
+        )
+
+    def refresh_from(self, other: "EditSession") -> None:
+        """用磁盘上更新的版本覆盖可变字段（保留锁对象）。"""
+        self.versions = other.versions
+        self.ops = other.ops
+        self.idx = other.idx
+        self.updated_at = other.updated_at
+        self.rev = other.rev
+        self.stamp = other.stamp
+        self.logged_history = other.logged_history
+
+
+class _Shard:
+    __slots__ = ("lock", "sessions")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, EditSession] = {}
+
+
+class EditSessionStore:
+    def __init__(self, upload_root: str):
+        self.upload_root = os.path.abspath(upload_root)
+        self.sessions_root = os.path.join(self.upload_root, "edit_sessions")
+        self._shards = [_Shard() for _ in range(_SHARD_COUNT)]
+        self._background: Optional[threading.Thread] = None
+        self._background_lock = threading.Lock()
+        self._dirty: set = set()
+        self._dirty_lock = threading.Lock()
+
+    # ----- 路径 -----
+
+    def session_dir(self, session_id: str) -> str:
+        return os.path.join(self.sessions_root, session_id)
+
+    def _meta_path(self, session_id: str) -> str:
+        return os.path.join(self.session_dir(session_id), "session.json")
+
+    def _shard(self, session_id: str) -> _Shard:
+        return self._shards[hash(session_id) % _SHARD_COUNT]
+
+    def _wal_path(self, session_id: str) -> str:
+        return os.path.join(self.session_dir(session_id), "wal.log")
+
+    def _stamp(self, session_id: str) -> Optional[Tuple[int, int, int]]:
+        """(session.json 的 mtime_ns, 大小, wal.log 大小)；session.json 不存在时为 None。"""
+        try:
+            st = os.stat(self._meta_path(session_id))
+        except OSError:
+            return None
+        try:
+            wal_size = os.stat(self._wal_path(session_id)).st_size
+        except OSError:
+            wal_size = 0
+        return st.st_mtime_ns, st.st_size, wal_size
+
+    # ----- 读写 -----
+
+    def _read(self, session_id: str) -> Optional[EditSession]:
+        """读取 session.json 并重放 wal.log 中 rev 更新的记录。"""
+        stamp = self._stamp(session_id)
+        if stamp is None:
+            return None
+        try:
+            with open(self._meta_path(session_id), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception:
+            return None
+        session = EditSession.from_dict(meta, self.upload_root, session_id)
+        if session is None:
+            return None
+        try:
+            with open(self._wal_path(session_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # 崩溃时写了一半的末行
+                    if int(record.get("r") or 0) > session.rev:
+                        _replay(session, record)
+        except OSError:
+            pass
+        session.stamp = stamp
+        session.logged_history = session.history()
+        return session
+
+    def get(self, session_id: str) -> Optional[EditSession]:
+        """内存命中且磁盘未被其他 worker 改写时直接返回，否则按 id 读取 session.json + wal.log。"""
+        if not _SESSION_ID_RE.match(session_id or ""):
+            return None
+        self.ensure_background()
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.get(session_id)
+        if session is not None:
+            stamp = self._stamp(session_id)
+            if stamp is None:
+                self._forget(session_id)
+                return None
+            if stamp == session.stamp:
+                return session
+        loaded = self._read(session_id)
+        with shard.lock:
+            if loaded is None:
+                shard.sessions.pop(session_id, None)
+                return None
+            current = shard.sessions.get(session_id)
+            if current is not None:
+                # 原地刷新，持有同一对象（及其锁）的请求都能看到新数据
+                if current.stamp != loaded.stamp:
+                    current.refresh_from(loaded)
+                return current
+            shard.sessions[session_id] = loaded
+            return loaded
+
+    def add(self, session: EditSession) -> None:
+        self.ensure_background()
+        self._write(session)
+        shard = self._shard(session.session_id)
+        with shard.lock:
+            shard.sessions[session.session_id] = session
+
+    @contextmanager
+    def _file_lock(self, session_id: str) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        lock_path = os.path.join(self.session_dir(session_id), ".lock")
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            # 会话目录已被删除：不加锁，后续读写自然失败
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    @contextmanager
+    def locked(self, session: EditSession) -> Iterator[EditSession]:
+        """
+        修改会话前调用：同一进程用 session.lock 互斥，跨进程用 flock 互斥，
+        磁盘状态有变化时把内存副本刷新到最新 rev。修改完成后在块内调用 persist()。
+        """
+        with session.lock:
+            with self._file_lock(session.session_id):
+                if self._stamp(session.session_id) != session.stamp:
+                    latest = self._read(session.session_id)
+                    if latest is not None and latest.rev != session.rev:
+                        session.refresh_from(latest)
+                yield session
+
+    def persist(self, session: EditSession) -> None:
+        """
+        在 locked() 块内调用：rev 加 1，并把本次变化追加到 wal.log（一行紧凑 JSON，不做 fsync）。
+        session.json 由后台线程合并写回。没有文件锁时先比较磁盘 rev，不一致抛 EditSessionConflict。
+        """
+        if fcntl is None:
+            on_disk = self._read(session.session_id)
+            if on_disk is not None and on_disk.rev != session.rev:
+                raise EditSessionConflict(session.session_id)
+        if not _write_behind_enabled():
+            session.rev += 1
+            self._write(session)
+            return
+        prefix = 0
+        for old, new in zip(session.logged_history, session.history()):
+            if old != new:
+                break
+            prefix += 1
+        session.rev += 1
+        record = {
+            "r": session.rev,
+            "i": session.idx,
+            "t": session.updated_at.isoformat(),
+            "n": prefix,
+            "v": session.versions[prefix:],
+            "o": session.ops[prefix:] if len(session.ops) == len(session.versions) else None,
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with open(self._wal_path(session.session_id), "a", encoding="utf-8") as f:
+            f.write(line)
+        session.logged_history = session.history()
+        session.stamp = self._stamp(session.session_id)
+        with self._dirty_lock:
+            self._dirty.add(session.session_id)
+
+    def _write(self, session: EditSession) -> None:
+        """原子写入紧凑的 session.json（临时文件 + rename），然后清空 wal.log。"""
+        session_dir = self.session_dir(session.session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        meta_path = self._meta_path(session.session_id)
+        tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(session.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, meta_path)
+        # 先替换 session.json 再截断 wal：中途崩溃时 wal 中的旧记录 rev 不大于 session.json，重放时会被跳过
+        wal_path = self._wal_path(session.session_id)
+        if os.path.exists(wal_path):
+            with open(wal_path, "w", encoding="utf-8"):
+                pass
+        session.logged_history = session.history()
+        session.stamp = self._stamp(session.session_id)
+
+    def flush(self, session_id: str) -> None:
+        """把 wal.log 合并进 session.json。"""
+        with self._dirty_lock:
+            self._dirty.discard(session_id)
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.get(session_id)
+        if session is None or not os.path.isdir(self.session_dir(session_id)):
+            return
+        with self.locked(session):
+            if os.path.isdir(self.session_dir(session_id)):
+                self._write(session)
+
+    def flush_all(self) -> None:
+        with self._dirty_lock:
+            pending = list(self._dirty)
+        for session_id in pending:
+            try:
+                self.flush(session_id)
+            except Exception:
+                pass
+
+    def _forget(self, session_id: str) -> Optional[EditSession]:
+        with self._dirty_lock:
+            self._dirty.discard(session_id)
+        shard = self._shard(session_id)
+        with shard.lock:
+            return shard.sessions.pop(session_id, None)
+
+    def discard(self, session_id: str) -> None:
+        if not _SESSION_ID_RE.match(session_id or ""):
+            return
+        self._forget(session_id)
+        shutil.rmtree(self.session_dir(session_id), ignore_errors=True)
+
+    # ----- 后台任务：合并写回 + 过期清理 -----
+
+    def sweep(self, ttl_minutes: Optional[int] = None) -> int:
+        """删除闲置超过 TTL 的会话目录（以 session.json / wal.log 的 mtime 为准，多 worker 一致），返回清理数量。"""
+        ttl_seconds = max(1, ttl_minutes or env_int("EDIT_SESSION_TTL_MINUTES", 60)) * 60
+        if not os.path.isdir(self.sessions_root):
+            return 0
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.sessions_root):
+            dir_path = os.path.join(self.sessions_root, name)
+            if not os.path.isdir(dir_path):
+                continue
+            mtimes = []
+            for path in (os.path.join(dir_path, "session.json"), os.path.join(dir_path, "wal.log"), dir_path):
+                try:
+                    mtimes.append(os.path.getmtime(path))
+                except OSError:
+                    continue
+            if not mtimes or now - max(mtimes) <= ttl_seconds:
+                continue
+            if _SESSION_ID_RE.match(name):
+                self.discard(name)
+            else:
+                shutil.rmtree(dir_path, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def ensure_background(self) -> None:
+        """启动后台线程（每个进程一个；gunicorn fork 后在 worker 内首次使用时启动）。"""
+        thread = self._background
+        if thread is not None and thread.is_alive():
+            return
+        with self._background_lock:
+            if self._background is not None and self._background.is_alive():
+                return
+            self._background = threading.Thread(
+                target=self._background_loop, name="edit-session-store", daemon=True
+            )
+            self._background.start()
+            _ACTIVE_STORES.add(self)
+
+    def _background_loop(self) -> None:
+        flush_interval = max(0.2, env_float("EDIT_SESSION_FLUSH_SECONDS", 2.0))
+        sweep_interval = max(10, env_int("EDIT_SESSION_SWEEP_SECONDS", 300))
+        next_sweep = 0.0
+        while True:
+            self.flush_all()
+            if time.monotonic() >= next_sweep:
+                try:
+                    self.sweep()
+                except Exception:
+                    pass
+                next_sweep = time.monotonic() + sweep_interval
+            time.sleep(flush_interval)
+
+
+def _replay(session: EditSession, record: Dict) -> None:
+    prefix = int(record.get("n") or 0)
+    session.versions = session.versions[:prefix] + list(record.get("v") or [])
+    ops = record.get("o")
+    if ops is not None and len(session.ops) >= prefix:
+        session.ops = session.ops[:prefix] + list(ops)
+    else:
+        session.ops = []
+    session.idx = max(0, min(len(session.versions) - 1, int(record.get("i") or 0)))
+    session.updated_at = _parse_dt(record.get("t") or "")
+    session.rev = int(record.get("r") or session.rev)
+
+
+def _write_behind_enabled() -> bool:
+    return os.getenv("EDIT_SESSION_WRITE_BEHIND", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+_ACTIVE_STORES: "weakref.WeakSet[EditSessionStore]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_on_exit() -> None:
+    for store in list(_ACTIVE_STORES):
+        try:
+            store.flush_all()
+        except Exception:
+            pass
+
+
+_STORES: Dict[str, EditSessionStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_session_store(upload_root: str) -> EditSessionStore:
+    root = os.path.abspath(upload_root)
+    store = _STORES.get(root)
+    if store is None:
+        with _STORES_LOCK:
+            store = _STORES.get(root)
+            if store is None:
+                store = _STORES[root] = EditSessionStore(root)
+    return store
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+异步导出任务：大批量下载（整个图库、某次搜索的全部结果）在后台线程里打包成临时 ZIP，
+请求线程只负责建任务、查进度和发送文件，下载中断后可以用 Range 续传。
+
+每个任务一个目录 EXPORT_DIR/<job_id>/：
+  job.json       任务状态（owner_id、status、进度、过期时间），原子替换写入，多个 worker 都能读到
+  archive.zip    打包完成的归档；打包过程中写 archive.zip.part，完成后再改名
+
+status：queued -> running -> done / failed；删除任务即取消。
+打包进程被杀（重启/OOM）后 job.json 不再更新，超过 _STALE_SECONDS 或本机进程已不存在时视为失败。
+完成的任务保留 EXPORT_TTL_HOURS 小时后由清理逻辑删除（建任务、查状态时顺带触发，按间隔节流）。
+
+环境变量：
+  EXPORT_DIR          任务目录（默认系统临时目录下 bs_exports）
+  EXPORT_WORKERS      每个进程的打包线程数（默认 1）
+  EXPORT_TTL_HOURS    归档保留时间（默认 24）
+  EXPORT_MAX_ACTIVE   每个用户同时进行中的任务数上限（默认 2）
+"""
+
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from server.utils.env import env_float
+from server.utils.zip_stream import ZipEntry, make_entry, stream_zip
+
+ACTIVE = ("queued", "running")
+
+_JOB_FILE = "job.json"
+_ARCHIVE = "archive.zip"
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_PROGRESS_INTERVAL = 1.0
+_STALE_SECONDS = 120
+_SWEEP_INTERVAL = 300
+
+
+class ExportLimitExceeded(Exception):
+    pass
+
+
+def export_root() -> str:
+    root = os.getenv("EXPORT_DIR") or os.path.join(tempfile.gettempdir(), "bs_exports")
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+def _job_dir(job_id: str) -> Optional[str]:
+    if not _JOB_ID_RE.match(job_id or ""):
+        return None
+    return os.path.join(export_root(), job_id)
+
+
+def archive_path(job_id: str) -> Optional[str]:
+    job_dir = _job_dir(job_id)
+    return os.path.join(job_dir, _ARCHIVE) if job_dir else None
+
+
+def _read(job_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(job_dir, _JOB_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(job_dir: str, job: Dict[str, Any]) -> None:
+    job["updated_at"] = time.time()
+    fd, tmp = tempfile.mkstemp(dir=job_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(job_dir, _JOB_FILE))
+
+
+def _process_gone(job: Dict[str, Any]) -> bool:
+    """建任务的进程在本机且已退出（排队中的任务没有心跳，靠这个判断）。"""
+    if job.get("host") != socket.gethostname():
+        return False
+    try:
+        os.kill(int(job.get("pid") or 0), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+
+def _is_stale(job: Dict[str, Any]) -> bool:
+    if job.get("status") not in ACTIVE:
+        return False
+    if job["status"] == "running" and time.time() - float(job.get("updated_at") or 0) > _STALE_SECONDS:
+        return True
+    return _process_gone(job)
+
+
+def get_job(job_id: str, owner_id: Any) -> Optional[Dict[str, Any]]:
+    """读取该用户的任务；不存在、不属于该用户或已过期时返回 None。"""
+    job_dir = _job_dir(job_id)
+    job = _read(job_dir) if job_dir else None
+    if not job or str(job.get("owner_id")) != str(owner_id):
+        return None
+    if job.get("expires_at") and job["expires_at"] < time.time():
+        return None
+    if _is_stale(job):
+        job["status"] = "failed"
+        job["error"] = "打包进程已中断，请重新创建导出任务"
+    return job
+
+
+def job_payload(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "total": job.get("total", 0),
+        "done": job.get("done", 0),
+        "bytes": job.get("bytes", 0),
+        "total_bytes": job.get("total_bytes", 0),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "expires_at": job.get("expires_at"),
+    }
+
+
+def _owner_jobs(owner_id: Any) -> List[Dict[str, Any]]:
+    jobs = []
+    root = export_root()
+    for name in os.listdir(root):
+        job = get_job(name, owner_id)
+        if job:
+            jobs.append(job)
+    return jobs
+
+
+def cancel_job(job_id: str, owner_id: Any) -> bool:
+    """删除任务目录；仍在打包的任务会在下一个文件处发现目录已删除并退出。"""
+    job_dir = _job_dir(job_id)
+    if not job_dir or get_job(job_id, owner_id) is None:
+        return False
+    shutil.rmtree(job_dir, ignore_errors=True)
+    return True
+
+
+def sweep_expired(force: bool = False) -> int:
+    """删除过期任务与中断残留的任务目录，返回删除数量。"""
+    global _LAST_SWEEP
+    now = time.time()
+    if not force and now - _LAST_SWEEP < _SWEEP_INTERVAL:
+        return 0
+    _LAST_SWEEP = now
+    ttl = env_float("EXPORT_TTL_HOURS", 24) * 3600
+    removed = 0
+    root = export_root()
+    for name in os.listdir(root):
+        job_dir = os.path.join(root, name)
+        if not os.path.isdir(job_dir):
+            continue
+        job = _read(job_dir)
+        if job is None:
+            # 没有 job.json（建任务时中断），按目录时间判断
+            try:
+                expired = now - os.path.getmtime(job_dir) > ttl
+            except OSError:
+                continue
+        elif job.get("expires_at"):
+            expired = job["expires_at"] < now
+        else:
+            # 进行中的任务每秒刷新 updated_at，超过保留时间仍未更新的必然已中断
+            expired = now - float(job.get("updated_at") or 0) > ttl
+        if expired:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+_LAST_SWEEP = 0.0
+
+
+class _Pool:
+    """打包线程池，按 pid 创建（gunicorn fork 出的 worker 不继承父进程的线程）。"""
+
+    def __init__(self):
+        self.pid: Optional[int] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
+
+    def get(self) -> ThreadPoolExecutor:
+        pid = os.getpid()
+        if self.pid != pid:
+            with self.lock:
+                if self.pid != pid:
+                    workers = max(1, int(env_float("EXPORT_WORKERS", 1)))
+                    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+                    self.pid = pid
+        return self.executor
+
+
+_POOL = _Pool()
+
+# 解析导出内容：返回 (绝对路径, 归档内文件名) 列表，在打包线程里调用
+Resolver = Callable[[], Iterable[Tuple[str, str]]]
+
+
+def submit_export(owner_id: Any, resolve: Resolver, description: str = "") -> Dict[str, Any]:
+    """创建任务并交给后台线程；同一用户进行中的任务超过上限时抛 ExportLimitExceeded。"""
+    sweep_expired()
+    limit = int(env_float("EXPORT_MAX_ACTIVE", 2))
+    if limit > 0 and sum(1 for j in _owner_jobs(owner_id) if j["status"] in ACTIVE) >= limit:
+        raise ExportLimitExceeded()
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(export_root(), job_id)
+    os.makedirs(job_dir)
+    job = {
+        "id": job_id,
+        "owner_id": owner_id,
+        "status": "queued",
+        "description": description,
+        "total": 0,
+        "done": 0,
+        "bytes": 0,
+        "total_bytes": 0,
+        "error": None,
+        "created_at": time.time(),
+        "expires_at": None,
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+    }
+    _write(job_dir, job)
+    _POOL.get().submit(_run, job_dir, resolve)
+    return job
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _run(job_dir: str, resolve: Resolver) -> None:
+    job = _read(job_dir)
+    if job is None:  # 排队期间已被取消
+        return
+    part = os.path.join(job_dir, _ARCHIVE + ".part")
+    try:
+        job["status"] = "running"
+        _write(job_dir, job)
+
+        last = [time.monotonic()]
+
+        def _progress(force: bool = False) -> None:
+            now = time.monotonic()
+            if not force and now - last[0] < _PROGRESS_INTERVAL:
+                return
+            last[0] = now
+            if not os.path.isdir(job_dir):
+                raise _Cancelled()
+            _write(job_dir, job)
+
+        # 解析与统计大小都可能耗时较长，循环里同样刷新心跳，免得被 _is_stale 判为失败
+        files = []
+        for item in resolve():
+            files.append(item)
+            _progress()
+        if not files:
+            raise ValueError("没有可导出的图片")
+        job["total"] = len(files)
+        sizes = []
+        for abs_path, _ in files:
+            try:
+                sizes.append(os.path.getsize(abs_path))
+            except OSError:
+                sizes.append(0)
+            _progress()
+        job["total_bytes"] = sum(sizes)
+        _progress(force=True)
+
+        def _entries() -> Iterator[ZipEntry]:
+            for i, (abs_path, arcname) in enumerate(files):
+                job["done"] = i
+                _progress()
+                # 逐个 stat：打包期间被删除的文件直接跳过
+                entry = make_entry(abs_path, arcname)
+                if entry is not None:
+                    yield entry
+
+        with open(part, "wb") as f:
+            for chunk in stream_zip(_entries()):
+                f.write(chunk)
+                job["bytes"] += len(chunk)
+                _progress()
+        job["done"] = job["total"]
+        job["bytes"] = os.path.getsize(part)
+        _progress(force=True)
+        os.replace(part, os.path.join(job_dir, _ARCHIVE))
+        job["status"] = "done"
+        job["expires_at"] = time.time() + env_float("EXPORT_TTL_HOURS", 24) * 3600
+        _write(job_dir, job)
+    except _Cancelled:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    except Exception as exc:
+        print(f"[export_jobs] job {job.get('id')} failed: {exc}")
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        if os.path.isdir(job_dir):
+            job["status"] = "failed"
+            job["error"] = str(exc)
+            # 失败的任务同样保留一段时间供前端查看原因，之后一并清理
+            job["expires_at"] = time.time() + env_float("EXPORT_TTL_HOURS", 24) * 3600
+            _write(job_dir, job)
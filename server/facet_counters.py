@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+按用户物化的聚合计数：相机品牌/型号、格式、设备、图片总数与每日新增数，
+存放在 owner_facet_counts 表里，聚合接口只按主键前缀读取，不再对 images 做 GROUP BY。
+
+- 写接口用 FacetTracker 记录受影响图片写入前后的取值，结束时按差值增量更新计数
+- 增量与整体重建都先拿该用户的 MySQL 命名锁（跨连接、跨 worker），重建读快照期间不会有写入
+  落在快照之后又被重建覆盖掉
+- 用户第一次读取时若还没有计数（迁移后的老数据），先从原表整体重建一次
+- 增量取快照或写入失败时删除该用户的 total 行，下次读取时自动整体重建
+- reconcile_owner / server.tools.reconcile_facets 可随时从原表重建，修正异常中断造成的偏差
+
+取值规则与原先的 SQL 聚合一致：品牌/型号取 exif 优先并去首尾空白，格式取文件名最后一个
+'.' 之后的部分转小写，设备由 classify_device 粗分。
+"""
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from server.db import dict_cursor, execute, executemany, get_conn, query
+from server.utils import classify_device
+
+FACETS = ("camera_make", "camera_model", "format", "device")
+_TOTAL = ("total", "")
+_VALUE_MAX = 191
+_CHUNK = 500
+_LOCK_TIMEOUT = 10
+
+_SNAPSHOT_SQL = """
+    SELECT i.id,
+           TRIM(COALESCE(e.camera_make, i.camera_make)) AS make,
+           TRIM(COALESCE(e.camera_model, i.camera_model)) AS model,
+           CASE WHEN COALESCE(i.stored_path, i.path) IS NULL THEN NULL
+                ELSE LOWER(SUBSTRING_INDEX(COALESCE(i.stored_path, i.path), '.', -1)) END AS fmt,
+           CAST(DATE(i.created_at) AS CHAR) AS day
+    FROM images i
+    LEFT JOIN exif e ON e.image_id = i.id
+    WHERE i.owner_id=%s
+"""
+
+_UPSERT_SQL = (
+    "INSERT INTO owner_facet_counts (owner_id, facet, value, cnt) VALUES (%s,%s,%s,%s) "
+    "ON DUPLICATE KEY UPDATE cnt = cnt + VALUES(cnt)"
+)
+
+
+def facet_values(row: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """一张图片贡献的 (facet, value) 列表。"""
+    make = (row.get("make") or "").strip()
+    model = (row.get("model") or "").strip()
+    values = [_TOTAL]
+    if row.get("day"):
+        values.append(("day", row["day"]))
+    if make:
+        values.append(("camera_make", make[:_VALUE_MAX]))
+    if model:
+        values.append(("camera_model", model[:_VALUE_MAX]))
+    if row.get("fmt"):
+        values.append(("format", row["fmt"][:_VALUE_MAX]))
+    device = classify_device(make, model)
+    if device:
+        values.append(("device", device))
+    return values
+
+
+def _snapshot(owner_id: Any, image_ids: Iterable[int]) -> Counter:
+    counts: Counter = Counter()
+    ids = list(dict.fromkeys(int(i) for i in image_ids if i))
+    for start in range(0, len(ids), _CHUNK):
+        chunk = ids[start:start + _CHUNK]
+        placeholders = ",".join(["%s"] * len(chunk))
+        for row in query(f"{_SNAPSHOT_SQL} AND i.id IN ({placeholders})", [owner_id, *chunk]):
+            counts.update(facet_values(row))
+    return counts
+
+
+def _initialized(owner_id: Any) -> bool:
+    rows = query(
+        "SELECT 1 FROM owner_facet_counts WHERE owner_id=%s AND facet='total' AND value='' LIMIT 1",
+        (owner_id,),
+    )
+    return bool(rows)
+
+
+def _invalidate(owner_id: Any) -> None:
+    """丢掉“已初始化”标记（total 行），下次读取时从原表整体重建。"""
+    try:
+        execute("DELETE FROM owner_facet_counts WHERE owner_id=%s AND facet='total' AND value=''", (owner_id,))
+    except Exception as exc:
+        print(f"[facet_counters] invalidate owner {owner_id} failed: {exc}")
+
+
+def _acquire(owner_id: Any):
+    """拿该用户的计数锁，返回持有锁的连接；超时或出错返回 None。"""
+    conn = None
+    try:
+        conn = get_conn()
+        with conn.cursor() as cur:
+            cur.execute("SELECT GET_LOCK(%s, %s) AS ok", (f"owner_facets:{owner_id}", _LOCK_TIMEOUT))
+            row = cur.fetchone()
+        if row and row["ok"] == 1:
+            return conn
+        print(f"[facet_counters] lock owner {owner_id} timed out")
+    except Exception as exc:
+        print(f"[facet_counters] lock owner {owner_id} failed: {exc}")
+    if conn is not None:
+        conn.close()
+    return None
+
+
+def _release(conn) -> None:
+    # 命名锁跟随连接，关闭连接即释放
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class FacetTracker:
+    """
+    记录一次写操作对计数的影响，写入前后都在该用户的计数锁内：
+        with FacetTracker(owner_id) as tracker:
+            tracker.before(ids)   # 修改/删除前
+            ...写 images / exif...
+            tracker.after(ids)    # 新增/修改后
+    退出时应用差值并释放锁；中途出错则让计数下次读取时重建。
+    """
+
+    def __init__(self, owner_id: Any):
+        self.owner_id = owner_id
+        self._delta: Counter = Counter()
+        self._failed = False
+        self._lock = None
+
+    def __enter__(self) -> "FacetTracker":
+        self._lock = _acquire(self.owner_id)
+        if self._lock is None:
+            self._failed = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is not None:
+                self._failed = True
+            self.apply()
+        finally:
+            _release(self._lock)
+            self._lock = None
+
+    def before(self, image_ids: Iterable[int]) -> None:
+        self._track(image_ids, -1)
+
+    def after(self, image_ids: Iterable[int]) -> None:
+        self._track(image_ids, 1)
+
+    def _track(self, image_ids: Iterable[int], sign: int) -> None:
+        # 计数只是派生数据：取快照失败时放弃本次增量（apply 时让计数重建），不影响写接口本身
+        if self._failed:
+            return
+        try:
+            snap = _snapshot(self.owner_id, image_ids)
+        except Exception as exc:
+            print(f"[facet_counters] snapshot failed: {exc}")
+            self._failed = True
+            return
+        if sign > 0:
+            self._delta.update(snap)
+        else:
+            self._delta.subtract(snap)
+
+    def apply(self) -> None:
+        rows = [(self.owner_id, facet, value, n) for (facet, value), n in self._delta.items() if n]
+        self._delta.clear()
+        if self._failed:
+            _invalidate(self.owner_id)
+            return
+        if not rows:
+            return
+        try:
+            # 还没建立计数的用户跳过增量，首次读取时会整体重建
+            if _initialized(self.owner_id):
+                executemany(_UPSERT_SQL, rows)
+        except Exception as exc:
+            print(f"[facet_counters] apply delta failed: {exc}")
+            _invalidate(self.owner_id)
+
+
+def reconcile_owner(owner_id: Any) -> int:
+    """从 images/exif 重建该用户的全部计数，返回图片数。"""
+    # 拿不到锁时照常重建（与不加锁时一致），偏差留给下一次重建修正
+    lock = _acquire(owner_id)
+    try:
+        return _rebuild(owner_id)
+    finally:
+        _release(lock)
+
+
+def _rebuild(owner_id: Any) -> int:
+    counts: Counter = Counter()
+    total = 0
+    for row in query(_SNAPSHOT_SQL, (owner_id,)):
+        counts.update(facet_values(row))
+        total += 1
+    counts[_TOTAL] += 0  # 没有图片的用户也写入 total 行，标记为已初始化
+    rows = [(owner_id, facet, value, n) for (facet, value), n in counts.items()]
+    with dict_cursor() as (conn, cur):
+        conn.begin()  # 连接默认 autocommit，这里显式开启事务，删除与重建一起生效
+        cur.execute("DELETE FROM owner_facet_counts WHERE owner_id=%s", (owner_id,))
+        for start in range(0, len(rows), _CHUNK):
+            cur.executemany(_UPSERT_SQL, rows[start:start + _CHUNK])
+    return total
+
+
+def _ensure_initialized(owner_id: Any) -> None:
+    if not _initialized(owner_id):
+        reconcile_owner(owner_id)
+
+
+def read_facets(owner_id: Any, limit: int = 50) -> Dict[str, List[Dict[str, Any]]]:
+    _ensure_initialized(owner_id)
+    placeholders = ",".join(["%s"] * len(FACETS))
+    rows = query(
+        f"""
+        SELECT facet, value, cnt FROM owner_facet_counts
+        WHERE owner_id=%s AND facet IN ({placeholders}) AND cnt > 0
+        """,
+        [owner_id, *FACETS],
+    )
+    grouped: Dict[str, List[Dict[str, Any]]] = {f: [] for f in FACETS}
+    for r in rows:
+        grouped[r["facet"]].append({"value": r["value"], "count": int(r["cnt"])})
+    for facet, items in grouped.items():
+        items.sort(key=lambda x: (-x["count"], x["value"]))
+        if facet != "device":  # 设备只有几类，原先也不截断
+            del items[limit:]
+    return grouped
+
+
+def read_stats(owner_id: Any) -> Tuple[int, int]:
+    """返回 (图片总数, 今日新增数)。"""
+    _ensure_initialized(owner_id)
+    rows = query(
+        """
+        SELECT facet, cnt FROM owner_facet_counts
+        WHERE owner_id=%s
+          AND ((facet='total' AND value='') OR (facet='day' AND value=CAST(CURDATE() AS CHAR)))
+        """,
+        (owner_id,),
+    )
+    total = today = 0
+    for r in rows:
+        if r["facet"] == "total":
+            total = int(r["cnt"])
+        else:
+            today = int(r["cnt"])
+    return max(0, total), max(0, today)
+
+
+def all_owner_ids() -> List[int]:
+    return [r["id"] for r in query("SELECT id FROM users ORDER BY id")]
+
+
+def reconcile_all(owner_ids: Optional[Iterable[int]] = None) -> Dict[int, int]:
+    return {oid: reconcile_owner(oid) for oid in (owner_ids or all_owner_ids())}
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+图片删除与文件回收。
+
+- delete_images：按块执行 DELETE ... WHERE owner_id=%s AND id IN (...)，同一事务里把被删记录
+  引用的文件（原图 path/stored_path、缩略图 thumb_path）写入 file_reclaim_queue
+- 后台回收线程按批认领队列（FOR UPDATE SKIP LOCKED，多个 worker 不会重复处理），
+  按 sha256 查还在使用的记录：同一文件仍被其他图片引用时只出队不删除，否则 unlink；
+  没有 sha256 的老记录只出队，不删文件
+- 请求线程只做几条 SQL，文件 IO 全部异步
+
+环境变量：
+  FILE_RECLAIM_INTERVAL   回收线程轮询间隔（秒，默认 5）
+"""
+
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from server.db import dict_cursor, query
+from server.utils.env import env_float
+
+_DELETE_CHUNK = 500
+_REAP_BATCH = 500
+
+
+def _row_paths(row: Dict[str, Any]) -> Set[str]:
+    paths = set()
+    for key in ("stored_path", "path", "thumb_path"):
+        rel = (row.get(key) or "").strip()
+        if rel:
+            paths.add(rel)
+    return paths
+
+
+def delete_images(owner_id: Any, image_ids: Iterable[int]) -> List[int]:
+    """删除该用户名下的图片并登记待回收文件，返回实际删除的 id。"""
+    ids = list(dict.fromkeys(int(i) for i in image_ids))
+    deleted: List[int] = []
+    for start in range(0, len(ids), _DELETE_CHUNK):
+        chunk = ids[start:start + _DELETE_CHUNK]
+        placeholders = ",".join(["%s"] * len(chunk))
+        with dict_cursor() as (conn, cur):
+            conn.begin()
+            cur.execute(
+                f"SELECT id, path, stored_path, thumb_path, sha256 FROM images "
+                f"WHERE owner_id=%s AND id IN ({placeholders}) FOR UPDATE",
+                [owner_id, *chunk],
+            )
+            rows = cur.fetchall()
+            if not rows:
+                continue
+            found = [r["id"] for r in rows]
+            found_ph = ",".join(["%s"] * len(found))
+            cur.execute(f"DELETE FROM images WHERE owner_id=%s AND id IN ({found_ph})", [owner_id, *found])
+            queued = [
+                (owner_id, rel, r.get("sha256"))
+                for r in rows
+                for rel in sorted(_row_paths(r))
+            ]
+            if queued:
+                cur.executemany(
+                    "INSERT INTO file_reclaim_queue (owner_id, rel_path, sha256) VALUES (%s,%s,%s)",
+                    queued,
+                )
+        deleted.extend(found)
+    if deleted:
+        wake_reaper()
+    return deleted
+
+
+def _live_paths(shas: Set[str], paths: Set[str]) -> Set[str]:
+    """
+    仍被 images 引用的路径：按 sha256 取出同内容的记录（走索引）。
+    文件名由内容哈希生成，引用同一文件的记录 sha256 必然相同，不再按路径列查询（无索引）。
+    """
+    live: Set[str] = set()
+    if shas:
+        ph = ",".join(["%s"] * len(shas))
+        for r in query(f"SELECT path, stored_path, thumb_path FROM images WHERE sha256 IN ({ph})", list(shas)):
+            live |= _row_paths(r)
+    return live & paths
+
+
+def _unlink(upload_root: str, rel_path: str) -> None:
+    abs_path = os.path.abspath(os.path.join(upload_root, rel_path))
+    # 只删上传目录内的文件
+    if not abs_path.startswith(upload_root + os.sep):
+        return
+    try:
+        os.remove(abs_path)
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        print(f"[file_reclaim] remove {rel_path} failed: {exc}")
+
+
+def reap_once(upload_root: str, batch: int = _REAP_BATCH) -> int:
+    """处理一批待回收文件，返回出队条数。"""
+    upload_root = os.path.abspath(upload_root)
+    with dict_cursor() as (conn, cur):
+        conn.begin()
+        cur.execute(
+            "SELECT id, rel_path, sha256 FROM file_reclaim_queue ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+            (batch,),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return 0
+        # 没有 sha256 的老记录无法确认引用情况，只出队不删文件
+        paths = {r["rel_path"] for r in rows if r.get("sha256")}
+        live = _live_paths({r["sha256"] for r in rows if r.get("sha256")}, paths)
+        for rel in sorted(paths - live):
+            _unlink(upload_root, rel)
+        ids = [r["id"] for r in rows]
+        cur.execute(
+            f"DELETE FROM file_reclaim_queue WHERE id IN ({','.join(['%s'] * len(ids))})",
+            ids,
+        )
+    return len(rows)
+
+
+class _Reaper:
+    def __init__(self):
+        self.upload_root: Optional[str] = None
+        self.pid: Optional[int] = None
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+
+    def ensure(self, upload_root: str) -> None:
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            # gunicorn fork 出的 worker 不继承父进程的线程，按 pid 各自启动
+            self.upload_root = upload_root
+            self.wake = threading.Event()
+            threading.Thread(target=self._loop, name="file-reaper", daemon=True).start()
+            self.pid = pid
+
+    def _loop(self) -> None:
+        interval = max(0.5, env_float("FILE_RECLAIM_INTERVAL", 5))
+        while True:
+            try:
+                while reap_once(self.upload_root) >= _REAP_BATCH:
+                    pass
+            except Exception as exc:
+                print(f"[file_reclaim] reap failed: {exc}")
+            self.wake.wait(interval)
+            self.wake.clear()
+
+
+_REAPER = _Reaper()
+
+
+def ensure_reaper(upload_root: str) -> None:
+    _REAPER.ensure(upload_root)
+
+
+def wake_reaper() -> None:
+    _REAPER.wake.set()
@@ -0,0 +1,25 @@
+"""
+gunicorn 配置：gunicorn -c server/gunicorn.conf.py "server.app:create_app()"
+
+- preload_app：应用在 master 里加载一次，jieba 词典等只读数据由 worker 按写时复制共享
+  （GUNICORN_PRELOAD=0 可关闭，改为每个 worker 各自加载）
+- pre_fork：fork 前同步完成预热并等待预热线程结束，避免子进程继承被持有的锁
+- gthread：每个 worker 用线程池处理请求，AI 检索的 SSE 长连接只占一个线程，不会阻塞整个应用；
+  gthread 的心跳由主线程负责，timeout 只在 worker 整体卡死时生效，不会在流式响应中途杀掉 worker
+"""
+
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1").lower() not in ("0", "false", "no", "off")
+
+
+def pre_fork(server, worker):
+    if preload_app:
+        from server.lazy_deps import warm_up
+
+        warm_up()
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+图片处理执行器：把 Pillow 的 CPU 密集操作（预览渲染、编辑、会话步骤、保存编码）
+放到独立的进程池里执行，绕开 GIL，避免并发编辑时阻塞其他 API 请求。
+
+- 进程池大小默认为 CPU 核数 / gunicorn worker 数（每个 worker 各有一个池，子进程各有一份解码缓存），
+  IMAGE_POOL_WORKERS 可覆盖，0 表示在请求线程内直接执行
+- 子进程只读取文件路径；编辑/提交结果直接写入调用方给定的文件，预览等较大的字节结果通过共享内存传回
+- 大图按内存预算切换策略（见 utils/large_image.py）
+- 每个任务带超时（IMAGE_JOB_TIMEOUT，秒）；同一 key 的新任务提交后，旧任务若还在排队会被取消，
+  已经在跑的旧任务结果会被丢弃（调用方收到 ImageJobCancelled）。
+  注意子进程里已经开始的任务无法中止：超时或被取代的任务仍会跑完并占用一个进程，
+  同一 worker 同时在跑的任务数始终以池大小为上限
+- 进程池损坏（子进程被杀）时重建一次并重新提交，仍失败则按超时返回，不会退回请求线程里执行
+- coalesce_image_job：同一 key 最多一个在跑 + 一个待跑，中间被覆盖的参数直接丢弃（用于预览）
+- 子进程使用 forkserver 启动，不继承 gunicorn worker 里的线程与锁
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from PIL import Image
+
+from server.utils.env import env_int
+from server.utils.image_ops import (
+    apply_adjust,
+    apply_crop,
+    apply_rotate,
+    apply_scale,
+    flatten_for_save,
+)
+from server.utils.large_image import (
+    apply_adjust_tiled,
+    check_pixels,
+    needs_tiling,
+    open_preview,
+    open_rgb,
+    render_edits,
+    scale_params,
+)
+from server.utils.session_codec import (
+    forget_session_version,
+    open_session_version,
+    save_session_version,
+    session_cache_budget,
+    set_session_cache_limit,
+)
+
+_SHM_MIN_BYTES = 256 * 1024
+
+
+class ImageJobCancelled(Exception):
+    """任务被同 key 的新任务取代。"""
+
+
+class ImageJobTimeout(Exception):
+    """任务在超时时间内没有完成。"""
+
+
+def pool_size() -> int:
+    workers = max(1, env_int("GUNICORN_WORKERS", 1))
+    return max(0, env_int("IMAGE_POOL_WORKERS", max(1, (os.cpu_count() or 1) // workers)))
+
+
+def default_timeout() -> float:
+    return float(max(1, env_int("IMAGE_JOB_TIMEOUT", 60)))
+
+
+# ---------------------------------------------------------------------------
+# 任务函数（在子进程里执行，参数只传路径与简单类型）
+# ---------------------------------------------------------------------------
+
+def preview_job(abs_in: str, params: dict, quality: int = 90) -> bytes:
+    # 超出内存预算的大图按比例缩小解码（JPEG 走 draft），裁剪框同步换算
+    img, scale = open_preview(abs_in)
+    edited = render_edits(img, scale_params(params, scale))
+    buf = BytesIO()
+    edited.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def edit_job(abs_in: str, params: dict, fmt: str, out_path: str) -> int:
+    """渲染编辑结果并直接编码写入 out_path，返回文件大小。"""
+    edited = render_edits(open_rgb(abs_in), params)
+    edited.save(out_path, format=fmt, quality=92)
+    return os.path.getsize(out_path)
+
+
+def session_step_job(abs_in: str, op: str, params: dict, session_dir: str, stem: str) -> str:
+    """执行一个会话编辑步骤并写出新版本，返回文件名。"""
+    img = open_session_version(abs_in)
+    if op == "crop":
+        img = apply_crop(img, params)
+    elif op == "scale":
+        img = apply_scale(img, params)
+    elif op == "rotate":
+        img = apply_rotate(img, params)
+    elif needs_tiling(img.width, img.height):
+        # 条带处理会原地修改位图，先从解码缓存里摘掉，避免其他步骤读到被改过的版本
+        forget_session_version(abs_in)
+        img = apply_adjust_tiled(img, params)
+    else:
+        img = apply_adjust(img, params)
+    return save_session_version(img, session_dir, stem)
+
+
+def encode_job(abs_in: str, fmt: str, out_path: str) -> int:
+    """会话提交：去透明通道后按目标格式直接编码写入 out_path，返回文件大小。"""
+    with Image.open(abs_in) as img:
+        check_pixels(*img.size)
+        img = flatten_for_save(img)
+        if fmt == "JPEG":
+            img.save(out_path, format=fmt, quality=92)
+        else:
+            img.save(out_path, format=fmt)
+    return os.path.getsize(out_path)
+
+
+# ---------------------------------------------------------------------------
+# 共享内存结果传递
+# ---------------------------------------------------------------------------
+
+def _pack(result: Any) -> tuple:
+    if isinstance(result, bytes) and len(result) >= _SHM_MIN_BYTES:
+        shm = shared_memory.SharedMemory(create=True, size=len(result))
+        shm.buf[: len(result)] = result
+        name = shm.name
+        # 由父进程负责 unlink，这里从子进程的 resource_tracker 注销，避免被重复清理
+        try:
+            resource_tracker.unregister(getattr(shm, "_name", name), "shared_memory")
+        except Exception:
+            pass
+        shm.close()
+        return ("shm", name, len(result))
+    return ("value", result)
+
+
+def _unpack(packed: tuple) -> Any:
+    if packed[0] != "shm":
+        return packed[1]
+    _, name, size = packed
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _drop_packed(fut: Future) -> None:
+    """调用方已放弃（超时/被取代）时，释放子进程留下的共享内存。"""
+    if fut.cancelled():
+        return
+    try:
+        _unpack(fut.result())
+    except Exception:
+        pass
+
+
+def _invoke(fn: Callable, args: tuple, kwargs: dict) -> tuple:
+    return _pack(fn(*args, **kwargs))
+
+
+# ---------------------------------------------------------------------------
+# 进程池管理
+# ---------------------------------------------------------------------------
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_PID: Optional[int] = None
+_POOL_LOCK = threading.Lock()
+
+_LATEST: Dict[Hashable, object] = {}
+_LATEST_LOCK = threading.Lock()
+
+
+def _mp_context():
+    methods = multiprocessing.get_all_start_methods()
+    if "forkserver" in methods:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["server.image_executor"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _POOL, _POOL_PID
+    size = pool_size()
+    if size <= 0:
+        return None
+    pid = os.getpid()
+    if _POOL is not None and _POOL_PID == pid:
+        return _POOL
+    with _POOL_LOCK:
+        # gunicorn fork 出的 worker 不能复用父进程的池，按 pid 重新创建
+        if _POOL is None or _POOL_PID != pid:
+            # 解码缓存在子进程里，各子进程平分本 worker 的总预算
+            _POOL = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=_mp_context(),
+                initializer=set_session_cache_limit,
+                initargs=(session_cache_budget() // size,),
+            )
+            _POOL_PID = pid
+        return _POOL
+
+
+def _reset_pool(broken: ProcessPoolExecutor) -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is broken:
+            _POOL = None
+    try:
+        broken.shutdown(wait=False, cancel_futures=True)
+    except Exception:
+        pass
+
+
+def shutdown_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None and _POOL_PID == os.getpid():
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown_pool)
+
+
+def _claim(key: Optional[Hashable], token: object, fut: Optional[Future]) -> None:
+    if key is None:
+        return
+    with _LATEST_LOCK:
+        prev = _LATEST.get(key)
+        _LATEST[key] = token
+    if isinstance(prev, Future) and prev is not fut:
+        prev.cancel()
+
+
+def _is_latest(key: Optional[Hashable], token: object) -> bool:
+    if key is None:
+        return True
+    with _LATEST_LOCK:
+        return _LATEST.get(key) is token
+
+
+def _release(key: Optional[Hashable], token: object) -> None:
+    if key is None:
+        return
+    with _LATEST_LOCK:
+        if _LATEST.get(key) is token:
+            _LATEST.pop(key, None)
+
+
+def run_image_job(
+    fn: Callable,
+    *args,
+    timeout: Optional[float] = None,
+    key: Optional[Hashable] = None,
+    **kwargs,
+) -> Any:
+    """
+    提交任务并等待结果。
+    - timeout：秒，默认 IMAGE_JOB_TIMEOUT；超时抛 ImageJobTimeout
+    - key：同 key 只保留最新任务（如同一用户同一图片的预览），旧任务抛 ImageJobCancelled
+    """
+    timeout = timeout or default_timeout()
+    pool = _get_pool()
+    if pool is None:
+        token = object()
+        _claim(key, token, None)
+        try:
+            result = fn(*args, **kwargs)
+            if not _is_latest(key, token):
+                raise ImageJobCancelled()
+            return result
+        finally:
+            _release(key, token)
+
+    try:
+        fut = pool.submit(_invoke, fn, args, kwargs)
+    except BrokenProcessPool:
+        # 子进程异常退出后池不可再用：重建一次再提交
+        _reset_pool(pool)
+        pool = _get_pool()
+        try:
+            fut = pool.submit(_invoke, fn, args, kwargs)
+        except BrokenProcessPool:
+            _reset_pool(pool)
+            raise ImageJobTimeout()
+    _claim(key, fut, fut)
+    try:
+        packed = fut.result(timeout=timeout)
+        stale = not _is_latest(key, fut)
+    except CancelledError:
+        raise ImageJobCancelled()
+    except FutureTimeoutError:
+        if not fut.cancel():
+            fut.add_done_callback(_drop_packed)
+        raise ImageJobTimeout()
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        raise
+    finally:
+        _release(key, fut)
+    result = _unpack(packed)
+    if stale:
+        raise ImageJobCancelled()
+    return result
+
+
+class _CoalesceSlot:
+    __slots__ = ("cond", "seq", "pending", "running", "refs")
+
+    def __init__(self, lock: threading.Lock):
+        self.cond = threading.Condition(lock)
+        self.seq = 0
+        self.pending: Optional[int] = None
+        self.running = False
+        self.refs = 0
+
+
+_COALESCE_LOCK = threading.Lock()
+_COALESCE_SLOTS: Dict[Hashable, _CoalesceSlot] = {}
+
+
+def coalesce_image_job(key: Hashable, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+    """
+    按 key 合并任务：同一时刻最多一个在跑、一个排队。
+    - 排队中的请求被更新的请求覆盖时立即抛 ImageJobCancelled，不再渲染
+    - 在跑的任务完成时若已有更新的请求，同样抛 ImageJobCancelled（结果已过期）
+    - 超时（含排队时间）抛 ImageJobTimeout
+    """
+    timeout = timeout or default_timeout()
+    deadline = time.monotonic() + timeout
+    with _COALESCE_LOCK:
+        slot = _COALESCE_SLOTS.get(key)
+        if slot is None:
+            slot = _COALESCE_SLOTS[key] = _CoalesceSlot(_COALESCE_LOCK)
+        slot.seq += 1
+        my_seq = slot.seq
+        slot.pending = my_seq
+        slot.refs += 1
+        slot.cond.notify_all()
+        try:
+            while True:
+                if slot.pending != my_seq:
+                    raise ImageJobCancelled()
+                if not slot.running:
+                    slot.running = True
+                    slot.pending = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    slot.pending = None
+                    raise ImageJobTimeout()
+                slot.cond.wait(remaining)
+        except BaseException:
+            _leave_slot(key, slot)
+            raise
+
+    try:
+        result = run_image_job(fn, *args, timeout=max(1.0, deadline - time.monotonic()), **kwargs)
+    finally:
+        with _COALESCE_LOCK:
+            slot.running = False
+            stale = slot.seq != my_seq
+            _leave_slot(key, slot)
+            slot.cond.notify_all()
+    if stale:
+        raise ImageJobCancelled()
+    return result
+
+
+def _leave_slot(key: Hashable, slot: _CoalesceSlot) -> None:
+    # 调用方需持有 _COALESCE_LOCK
+    slot.refs -= 1
+    if slot.refs <= 0 and _COALESCE_SLOTS.get(key) is slot:
+        _COALESCE_SLOTS.pop(key, None)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+重量级依赖的延迟加载：jieba（词典构建约 1 秒）与 dashscope 不在 import 阶段加载，
+首次使用时再初始化，或由 create_app 启动的后台预热线程提前加载。
+worker 启动后可以立即响应 /api/health 等轻量请求。
+
+jieba 前缀词典（默认词典 + kb/custom_dict.txt）构建一次后写入磁盘缓存，多个 worker
+直接读取；缓存文件名包含 jieba 版本、默认词典与自定义词典的指纹，词典变更后自动失效。
+Docker 镜像构建时已预先生成（见 server/Dockerfile）。
+
+环境变量：
+  APP_WARMUP          是否在启动后用后台线程预热（默认 1，设为 0 则完全按需加载）
+  JIEBA_CACHE_DIR     前缀词典缓存目录（默认 server/kb/.cache）
+  JIEBA_TOKEN_CACHE   分词结果 LRU 条数（默认 4096，0 表示关闭）
+"""
+
+import hashlib
+import marshal
+import os
+import re
+import tempfile
+import threading
+from functools import lru_cache
+from typing import Any, Optional, Tuple
+
+from server.utils.env import env_int
+
+_KB_DIR = os.path.join(os.path.dirname(__file__), "kb")
+_CUSTOM_DICT = os.path.join(_KB_DIR, "custom_dict.txt")
+
+_JIEBA: Optional[Any] = None
+_JIEBA_FAILED = False
+_JIEBA_LOCK = threading.Lock()
+
+_DASHSCOPE: Optional[Any] = None
+_DASHSCOPE_LOCK = threading.Lock()
+
+_WARMUP_THREAD: Optional[threading.Thread] = None
+_WARMUP_LOCK = threading.Lock()
+
+
+def jieba_cache_path(jieba) -> str:
+    """合并词典缓存路径：文件名带上所有输入的指纹，任一变化都会换一个新文件。"""
+    digest = hashlib.sha1(str(getattr(jieba, "__version__", "")).encode())
+    default_dict = os.path.join(os.path.dirname(jieba.__file__), "dict.txt")
+    if os.path.exists(default_dict):
+        st = os.stat(default_dict)
+        digest.update(f"{st.st_size}:{int(st.st_mtime)}".encode())
+    if os.path.exists(_CUSTOM_DICT):
+        with open(_CUSTOM_DICT, "rb") as f:
+            digest.update(f.read())
+    cache_dir = os.getenv("JIEBA_CACHE_DIR") or os.path.join(_KB_DIR, ".cache")
+    return os.path.join(cache_dir, f"jieba-{digest.hexdigest()[:16]}.cache")
+
+
+def _load_jieba_dict(jieba) -> None:
+    """优先读取合并词典缓存；没有缓存时构建一次（默认词典 + 自定义词典）并原子写出。"""
+    tk = jieba.dt
+    path = jieba_cache_path(jieba)
+    try:
+        with open(path, "rb") as f:
+            freq, total, tags = marshal.load(f)
+        with tk.lock:
+            tk.FREQ, tk.total = freq, total
+            tk.user_word_tag_tab.update(tags)
+            tk.initialized = True
+        return
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+    tk.initialize()
+    if os.path.exists(_CUSTOM_DICT):
+        tk.load_userdict(_CUSTOM_DICT)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump((tk.FREQ, tk.total, dict(tk.user_word_tag_tab)), f)
+        os.replace(tmp, path)
+    except OSError as exc:
+        print(f"[lazy_deps] write jieba cache failed: {exc}")
+
+
+def get_jieba():
+    """返回已加载自定义词典并完成初始化的 jieba 模块；未安装时返回 None。"""
+    global _JIEBA, _JIEBA_FAILED
+    if _JIEBA is not None or _JIEBA_FAILED:
+        return _JIEBA
+    with _JIEBA_LOCK:
+        if _JIEBA is not None or _JIEBA_FAILED:
+            return _JIEBA
+        try:
+            import jieba
+        except Exception:
+            _JIEBA_FAILED = True
+            return None
+        try:
+            _load_jieba_dict(jieba)
+        except Exception as exc:  # pragma: no cover - 日志即可
+            print(f"[lazy_deps] load jieba dict failed: {exc}")
+        _JIEBA = jieba
+        return _JIEBA
+
+
+@lru_cache(maxsize=max(0, env_int("JIEBA_TOKEN_CACHE", 4096)))
+def cut_words(text: str) -> Tuple[str, ...]:
+    """精确模式分词（结果按文本缓存，重复的查询不再分词）；jieba 不可用时按空白/逗号切分。"""
+    jieba = get_jieba()
+    if jieba is None:
+        return tuple(p for p in re.split(r"[\s,，]+", text) if p)
+    return tuple(jieba.cut(text, cut_all=False))
+
+
+def get_dashscope():
+    """返回已设置 api_key 的 dashscope 模块（未安装时抛 ImportError，由调用方按调用失败处理）。"""
+    global _DASHSCOPE
+    if _DASHSCOPE is not None:
+        return _DASHSCOPE
+    with _DASHSCOPE_LOCK:
+        if _DASHSCOPE is None:
+            import dashscope
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            dashscope.api_key = os.getenv("DASHSCOPE_API_KEY") or dashscope.api_key
+            _DASHSCOPE = dashscope
+    return _DASHSCOPE
+
+
+def dashscope_api_key() -> Optional[str]:
+    try:
+        return get_dashscope().api_key
+    except ImportError:
+        return None
+
+
+def _warmup() -> None:
+    if get_jieba() is not None:
+        cut_words.__wrapped__("图片检索预热")  # 触发 HMM 等首次分词才加载的模型
+    try:
+        get_dashscope()
+    except Exception:
+        pass
+
+
+def _is_warm() -> bool:
+    return (_JIEBA is not None or _JIEBA_FAILED) and _DASHSCOPE is not None
+
+
+def start_warmup() -> None:
+    """启动后台预热线程（每个进程只启动一次）。"""
+    global _WARMUP_THREAD
+    if os.getenv("APP_WARMUP", "1").lower() in ("0", "false", "no", "off") or _is_warm():
+        return
+    with _WARMUP_LOCK:
+        if _WARMUP_THREAD is None:
+            _WARMUP_THREAD = threading.Thread(target=_warmup, name="lazy-deps-warmup", daemon=True)
+            _WARMUP_THREAD.start()
+
+
+def warm_up() -> None:
+    """
+    同步预热并等待后台预热线程结束。
+    gunicorn preload_app 时在 master fork 前调用（见 server/gunicorn.conf.py）：
+    词典只在 master 里加载一次，worker 按写时复制共享，fork 时也不会有线程持有锁。
+    """
+    with _WARMUP_LOCK:
+        thread = _WARMUP_THREAD
+    if thread is not None:
+        thread.join()
+    if not _is_warm():
+        _warmup()
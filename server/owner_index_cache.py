@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+每个用户一份的进程内索引缓存（内容检索、相似图片、颜色检索共用）：LRU + 用户数据版本号。
+
+- 取索引：内存 -> load(owner_id)（可选，例如读索引文件）-> build(owner_id) 同步构建
+- 已有索引但数据版本变了（result_cache.owner_generation）时先返回旧索引，后台重建；
+  版本号表不可用时每 stale_seconds 秒重建
+- 重建去抖：距上次构建不足 INDEX_REBUILD_MIN_SECONDS 秒时推迟到期满再建，连续写入只重建一次
+- 给出 lock_path 时（索引有磁盘文件，多个 worker 共享）构建在文件锁内进行：拿到锁后先 load，
+  文件已是最新版本就直接用，只有第一个拿到锁的 worker 真正重建
+- build / load 返回的对象需带 gen（构建时的版本号）与 built_at 属性
+
+环境变量：
+  INDEX_REBUILD_MIN_SECONDS   两次重建的最小间隔（秒，默认 30）
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from server.result_cache import owner_generation
+from server.utils.env import env_float
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发：各 worker 各自重建
+    fcntl = None
+
+
+class OwnerIndexCache:
+    def __init__(
+        self,
+        name: str,
+        build: Callable[[Any], Any],
+        max_owners: Callable[[], int],
+        stale_seconds: float = 300,
+        load: Optional[Callable[[Any], Any]] = None,
+        lock_path: Optional[Callable[[Any], str]] = None,
+    ):
+        self.name = name
+        self.build = build
+        self.load = load
+        self.lock_path = lock_path
+        self.max_owners = max_owners
+        self.stale_seconds = stale_seconds
+        self.items: "OrderedDict[Any, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.rebuilding: set = set()
+
+    def _put(self, owner_id: Any, index: Any) -> None:
+        with self.lock:
+            self.items[owner_id] = index
+            self.items.move_to_end(owner_id)
+            while len(self.items) > max(1, self.max_owners()):
+                self.items.popitem(last=False)
+
+    def _fresh(self, index: Any, gen: Optional[int]) -> bool:
+        if index is None:
+            return False
+        if gen is not None:
+            return index.gen == gen
+        return time.time() - index.built_at <= self.stale_seconds
+
+    @contextmanager
+    def _file_lock(self, owner_id: Any) -> Iterator[None]:
+        path = self.lock_path(owner_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    def _build(self, owner_id: Any) -> Any:
+        if self.lock_path is None or fcntl is None:
+            return self.build(owner_id)
+        with self._file_lock(owner_id):
+            # 等锁期间其他 worker 可能已经建好并写盘
+            index = self._load(owner_id)
+            if self._fresh(index, owner_generation(owner_id)):
+                return index
+            return self.build(owner_id)
+
+    def _rebuild_async(self, owner_id: Any, delay: float = 0) -> None:
+        with self.lock:
+            if owner_id in self.rebuilding:
+                return
+            self.rebuilding.add(owner_id)
+
+        def _run():
+            try:
+                if delay > 0:
+                    time.sleep(delay)
+                self._put(owner_id, self._build(owner_id))
+            except Exception as exc:
+                print(f"[{self.name}] rebuild failed for owner {owner_id}: {exc}")
+            finally:
+                with self.lock:
+                    self.rebuilding.discard(owner_id)
+
+        threading.Thread(target=_run, name=f"{self.name}-rebuild", daemon=True).start()
+
+    def _load(self, owner_id: Any) -> Any:
+        if self.load is None:
+            return None
+        try:
+            return self.load(owner_id)
+        except Exception as exc:
+            print(f"[{self.name}] load index failed for owner {owner_id}: {exc}")
+            return None
+
+    def get(self, owner_id: Any) -> Any:
+        gen = owner_generation(owner_id)
+        with self.lock:
+            index = self.items.get(owner_id)
+            if index is not None:
+                self.items.move_to_end(owner_id)
+        if index is None:
+            index = self._load(owner_id)
+            if index is None:
+                index = self._build(owner_id)
+                self._put(owner_id, index)
+                return index
+            self._put(owner_id, index)
+        if not self._fresh(index, gen):
+            age = time.time() - index.built_at
+            self._rebuild_async(owner_id, max(0.0, env_float("INDEX_REBUILD_MIN_SECONDS", 30) - age))
+        return index
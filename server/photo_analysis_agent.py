@@ -6,16 +6,18 @@ AI 图片自动分析封装：调用 DashScope 多模态模型，返回描述与
 import json
 import os
 import re
-from http import HTTPStatus
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
-import dashscope
-from dashscope import MultiModalConversation
+
+from server.ai_cache import file_sha256, get_ai_cache
+from server.ai_client import get_ai_client
+from server.lazy_deps import dashscope_api_key
+from server.utils.ai_proxy import proxy_image_url
 
 # 兼容 app.py 已经 load_dotenv 的情况；重复调用也安全
+# dashscope 在首次调用时才导入并设置 api_key（见 server/lazy_deps.py）
 load_dotenv()
-dashscope.api_key = os.getenv("DASHSCOPE_API_KEY") or dashscope.api_key
 
 DEFAULT_MODEL = os.getenv("DASHSCOPE_MODEL", "qwen-vl-plus")
 PROMPT_TEXT = (
@@ -118,44 +120,42 @@ def _extract_explain_json(text: str) -> Dict[str, Any]:
     return {"title": title, "explanation": explanation, "highlights": highlights, "tags": tags}
 
 
-def analyze_image(image_path: str) -> Dict[str, Any]:
+def analyze_image(image_path: str, image_sha256: Optional[str] = None) -> Dict[str, Any]:
     """
     调用通义千问多模态模型，对图片进行理解，返回描述与标签。
-    - image_path: 服务器本地图片路径
+    - image_path: 服务器本地图片路径（可以是缩小副本）
+    - image_sha256: 原图内容哈希；传入时结果按原图缓存，与副本无关
     - 返回: {"description": "...", "tags": ["标签1", ...]}
     - 出错时抛出异常，由上层捕获并转换为 HTTP 错误响应
     """
     if not os.path.exists(image_path):
         raise FileNotFoundError("待分析的图片不存在")
-    if not dashscope.api_key:
+    if not dashscope_api_key():
         raise RuntimeError("DASHSCOPE_API_KEY 未配置")
 
     abs_path = os.path.abspath(image_path)
-    messages = [
-        {"role": "system", "content": [{"text": "你是一个图片标注助手"}]},
-        {
-            "role": "user",
-            "content": [
-                {"image": f"file://{abs_path}"},
-                {"text": PROMPT_TEXT},
-            ],
-        },
-    ]
-
-    try:
-        response = MultiModalConversation.call(model=DEFAULT_MODEL, messages=messages)
-    except Exception as exc:
-        # 网络/鉴权等异常
-        raise RuntimeError(f"调用多模态模型失败: {exc}") from exc
-
-    if response.status_code != HTTPStatus.OK:
-        err_msg = getattr(response, "message", None) or str(getattr(response, "code", "")) or "DashScope 返回错误"
-        raise RuntimeError(err_msg)
-
-    contents = response.output.choices[0]["message"]["content"]
-    text_parts = [c.get("text") for c in contents if isinstance(c, dict) and c.get("text")]
-    combined_text = "\n".join(filter(None, text_parts)).strip()
-
+    sha = image_sha256 or file_sha256(abs_path)
+
+    def _compute() -> Dict[str, Any]:
+        # 只发送缩小副本（utils/ai_proxy.py），缓存命中时连副本都不用生成
+        messages = [
+            {"role": "system", "content": [{"text": "你是一个图片标注助手"}]},
+            {
+                "role": "user",
+                "content": [
+                    {"image": proxy_image_url(abs_path, sha)},
+                    {"text": PROMPT_TEXT},
+                ],
+            },
+        ]
+        return _finish_analysis(get_ai_client().call_text(messages, model=DEFAULT_MODEL))
+
+    # 并发/限流/超时/重试/熔断由 ai_client 统一处理，失败时抛 AIError（RuntimeError 子类）；
+    # 同一图片内容 + 模型 + 提示词的结果由 ai_cache 缓存，重复分析不再请求模型
+    return get_ai_cache().get_or_compute("analyze", abs_path, DEFAULT_MODEL, PROMPT_TEXT, _compute, image_sha256=sha)
+
+
+def _finish_analysis(combined_text: str) -> Dict[str, Any]:
     parsed = _extract_json(combined_text)
     # 兜底：确保字段存在
     parsed.setdefault("title", "")
@@ -166,44 +166,49 @@ def analyze_image(image_path: str) -> Dict[str, Any]:
     return parsed
 
 
-def analyze_image_explain(image_path: str, style: str = "friendly") -> Dict[str, Any]:
+def analyze_image_explain(
+    image_path: str, style: str = "friendly", image_sha256: Optional[str] = None
+) -> Dict[str, Any]:
     """
     调用多模态模型，输出自然中文讲解与要点。
     - style: 讲解风格提示（当前用于扩展）
     """
     if not os.path.exists(image_path):
         raise FileNotFoundError("待分析的图片不存在")
-    if not dashscope.api_key:
+    if not dashscope_api_key():
         raise RuntimeError("DASHSCOPE_API_KEY 未配置")
 
     abs_path = os.path.abspath(image_path)
     system_prompt = "你是图片内容讲解助手，擅长用自然中文描述画面。"
     if style and style != "friendly":
         system_prompt = f"{system_prompt} 请使用{style}风格表达。"
-    messages = [
-        {"role": "system", "content": [{"text": system_prompt}]},
-        {
-            "role": "user",
-            "content": [
-                {"image": f"file://{abs_path}"},
-                {"text": EXPLAIN_PROMPT_TEXT},
-            ],
-        },
-    ]
-
-    try:
-        response = MultiModalConversation.call(model=DEFAULT_MODEL, messages=messages, temperature=0.3)
-    except Exception as exc:
-        raise RuntimeError(f"调用多模态模型失败: {exc}") from exc
-
-    if response.status_code != HTTPStatus.OK:
-        err_msg = getattr(response, "message", None) or str(getattr(response, "code", "")) or "DashScope 返回错误"
-        raise RuntimeError(err_msg)
-
-    contents = response.output.choices[0]["message"]["content"]
-    text_parts = [c.get("text") for c in contents if isinstance(c, dict) and c.get("text")]
-    combined_text = "\n".join(filter(None, text_parts)).strip()
-
+    sha = image_sha256 or file_sha256(abs_path)
+
+    def _compute() -> Dict[str, Any]:
+        messages = [
+            {"role": "system", "content": [{"text": system_prompt}]},
+            {
+                "role": "user",
+                "content": [
+                    {"image": proxy_image_url(abs_path, sha)},
+                    {"text": EXPLAIN_PROMPT_TEXT},
+                ],
+            },
+        ]
+        return _finish_explanation(get_ai_client().call_text(messages, model=DEFAULT_MODEL, temperature=0.3))
+
+    return get_ai_cache().get_or_compute(
+        "explain",
+        abs_path,
+        DEFAULT_MODEL,
+        system_prompt + EXPLAIN_PROMPT_TEXT,
+        _compute,
+        variant=style or "",
+        image_sha256=sha,
+    )
+
+
+def _finish_explanation(combined_text: str) -> Dict[str, Any]:
     parsed = _extract_explain_json(combined_text)
     parsed.setdefault("title", "")
     parsed.setdefault("explanation", "")
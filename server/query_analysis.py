@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+检索词分析：/api/images/search 与 /api/ai/chat-search 共用的查询归一化、分词、过滤与同义词扩展。
+
+analyze_query() 的结果按原始查询文本做 LRU 缓存（不可变，可在线程间共享），
+热门查询直接命中缓存，不再分词；命中率通过 query_cache_stats() 查看（/api/health/stats 也会带上）。
+
+环境变量：
+  QUERY_CACHE_SIZE   缓存的查询条数（默认 2048，0 表示关闭）
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Set, Tuple
+
+from server.lazy_deps import cut_words
+from server.utils.env import env_int
+
+_POLITE_PREFIXES = [
+    "请帮我找一下",
+    "请帮我找一份",
+    "请帮我找一张",
+    "请帮我找",
+    "帮我找一下",
+    "帮我找一份",
+    "帮我找一张",
+    "帮我找",
+    "帮我",
+    "我想找",
+    "我想要",
+    "我想搜",
+    "想找",
+    "想搜",
+    "找一下",
+    "帮忙找",
+    "给我找",
+    "麻烦帮忙找",
+]
+_TRAILING_PARTICLES_RE = re.compile(r"[吗嘛呢吧呀啊哦哇啦喽呗～~。！？!,，、\\s]+$")
+_KEYWORD_SPLIT_RE = re.compile(r"[\\s,，。；;、/]+")
+_QUOTE_RE = re.compile(r"[\"“”‘’']([^\"“”‘’']+)[\"“”‘’']")
+_DISPLAY_TRIM_RE = re.compile(r"(有关|相关|关于|图片|照片|图)+$")
+
+_STOPWORDS = {
+    "请",
+    "帮我",
+    "帮忙",
+    "一下",
+    "一个",
+    "一份",
+    "一些",
+    "找",
+    "一下",
+    "寻找",
+    "想要",
+    "想找",
+    "给我",
+    "有没有",
+    "图片",
+    "照片",
+    "图",
+    "的",
+    "与",
+    "关于",
+    "有关",
+    "相关的",
+    "下",
+    "呢",
+    "吗",
+    "了",
+    "和",
+    "是",
+    "你",
+    "这个",
+    "那个",
+    "相关",
+    "搜索",
+    "推荐",
+}
+_SYNONYM_MAP = {
+    "实习鉴定表": ["实习评价表", "实践鉴定表", "实习证明", "鉴定表", "实习考核表"],
+    "鉴定表": ["评价表", "考核表", "证明"],
+}
+
+
+def _strip_polite_prefixes(text: str) -> str:
+    """
+    Remove common Chinese polite or helper phrases so metadata search uses the core noun.
+    Example: "请帮我找一份实习鉴定表" -> "实习鉴定表".
+    """
+    t = (text or "").strip()
+    if not t:
+        return ""
+    for prefix in _POLITE_PREFIXES:
+        if t.startswith(prefix):
+            t = t[len(prefix) :].lstrip()
+            break
+    for filler in ("一份", "一张", "一个", "一些", "一条"):
+        if t.startswith(filler):
+            t = t[len(filler) :].lstrip()
+            break
+    t = t.lstrip("的").strip()
+    t = _TRAILING_PARTICLES_RE.sub("", t).strip()
+    return t
+
+
+def _extract_quotes(text: str) -> List[str]:
+    """优先保留引号内的关键词短语"""
+    phrases = []
+    for m in _QUOTE_RE.finditer(text):
+        val = m.group(1).strip()
+        if val and val not in phrases:
+            phrases.append(val)
+    return phrases
+
+
+def normalize_query(q: str) -> str:
+    base = _strip_polite_prefixes(q or "")
+    base = re.sub(r'["“”‘’\'\[\]{}()（）]+', " ", base)
+    base = re.sub(r"[^0-9A-Za-z\u4e00-\u9fa5]+", " ", base)
+    return re.sub(r"\s+", " ", base).strip()
+
+
+def tokenize_zh(q: str) -> List[str]:
+    raw = (q or "").strip()
+    normalized = normalize_query(raw)
+    if not normalized:
+        return []
+    # jieba 与自定义词典首次使用时才加载，分词结果按文本缓存（见 server/lazy_deps.py）
+    tokens: List[str] = []
+    for seg in cut_words(normalized):
+        seg = seg.strip()
+        if seg:
+            tokens.append(seg)
+    # 引号内容作为强关键词优先加入
+    quotes = _extract_quotes(raw)
+    tokens = quotes + tokens
+    return tokens
+
+
+def filter_tokens(tokens: List[str]) -> List[str]:
+    filtered: List[str] = []
+    seen: Set[str] = set()
+    for tok in tokens:
+        t = (tok or "").strip()
+        if not t:
+            continue
+        if t in _STOPWORDS:
+            continue
+        # 丢弃绝大多数单字（保留数字/英文）
+        if len(t) == 1 and not re.match(r"[0-9A-Za-z]", t):
+            continue
+        if t in seen:
+            continue
+        seen.add(t)
+        filtered.append(t)
+    return filtered[:10]
+
+
+def pick_display_keyword(query_obj: Dict[str, Any]) -> str:
+    """Return a concise keyword for UI replies, avoiding full-sentence echoes."""
+    keywords = [k for k in (query_obj.get("keywords") or []) if k]
+    if keywords:
+        return "、".join(keywords[:3])
+    cleaned = (query_obj.get("cleaned_keyword") or "").strip()
+    if cleaned:
+        cleaned = re.sub(r"\s+", " ", cleaned).strip()
+        cleaned = _DISPLAY_TRIM_RE.sub("", cleaned).strip(" 的")
+        if cleaned:
+            return cleaned
+    return (query_obj.get("keyword") or "").strip()
+
+
+def _expand_keywords_with_synonyms(keywords: List[str], cleaned_keyword: str = "") -> List[str]:
+    """
+    Provide lightweight synonym/alias expansions for common nouns to improve recall without a model.
+    """
+    base = [k for k in keywords if k]
+    if cleaned_keyword:
+        base.append(cleaned_keyword)
+    expansions: List[str] = []
+    for kw in base:
+        for key, syns in _SYNONYM_MAP.items():
+            if key in kw or kw in key:
+                for s in syns:
+                    if s not in expansions and s not in base:
+                        expansions.append(s)
+    return expansions
+
+
+def segment_query_tokens(query: str) -> Tuple[List[str], List[str]]:
+    """Split Chinese query into tokens; single-char tokens are treated as weak."""
+    raw = re.sub(r"\s+", " ", (query or "").strip())
+    if not raw:
+        return [], []
+    parts = cut_words(raw)
+    tokens = []
+    for part in parts:
+        token = (part or "").strip()
+        if not token:
+            continue
+        if not re.search(r"[A-Za-z0-9\u4e00-\u9fff]", token):
+            continue
+        tokens.append(token)
+    strong, weak = [], []
+    for token in tokens:
+        if len(token) <= 1:
+            weak.append(token)
+        else:
+            strong.append(token)
+    strong = list(dict.fromkeys(strong))
+    weak = list(dict.fromkeys(weak))
+    return strong, weak
+
+
+@dataclass(frozen=True)
+class QueryAnalysis:
+    """一条查询的全部分析结果；字段均为不可变类型，调用方需要修改时自行复制。"""
+
+    keyword: str                # 原始查询（去首尾空白）
+    normalized: str             # 去礼貌前缀/标点后的核心短语
+    keywords: Tuple[str, ...]   # 聊天检索用：分词 + 停用词过滤
+    expansions: Tuple[str, ...]  # 同义词扩展（不含 keywords 本身）
+    display_keyword: str
+    phrase: str                 # 高级检索用：整句短语
+    strong_tokens: Tuple[str, ...]
+    weak_tokens: Tuple[str, ...]
+    search_terms: Tuple[Tuple[str, int], ...]  # 高级检索的 (词, 权重)，短语优先
+
+    def to_query_obj(self) -> Dict[str, Any]:
+        """ai_search_agent 使用的检索条件 dict（每次返回新对象）。"""
+        return {
+            "keyword": self.keyword,
+            "keywords": list(self.keywords),
+            "tokens": list(self.keywords),
+            "cleaned_keyword": self.normalized,
+            "normalized": self.normalized,
+            "expanded_keywords": list(self.expansions),
+            "display_keyword": self.display_keyword,
+        }
+
+
+def _analyze(text: str) -> QueryAnalysis:
+    raw = (text or "").strip()
+    normalized = normalize_query(raw)
+    keywords = filter_tokens(tokenize_zh(raw))
+    query_obj = {"keyword": raw, "keywords": keywords, "cleaned_keyword": normalized}
+
+    phrase = raw
+    strong, weak = segment_query_tokens(phrase)
+    terms: List[Tuple[str, int]] = [(phrase, 10)] if phrase else []
+    for token in strong or weak:
+        if not token or token == phrase:
+            continue
+        terms.append((token, 4 if len(token) > 1 else 1))
+
+    return QueryAnalysis(
+        keyword=raw,
+        normalized=normalized,
+        keywords=tuple(keywords),
+        expansions=tuple(_expand_keywords_with_synonyms(keywords, normalized)),
+        display_keyword=pick_display_keyword(query_obj),
+        phrase=phrase,
+        strong_tokens=tuple(strong),
+        weak_tokens=tuple(weak),
+        search_terms=tuple(terms),
+    )
+
+
+_CACHE_SIZE = max(0, env_int("QUERY_CACHE_SIZE", 2048))
+_CACHE: "OrderedDict[str, QueryAnalysis]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+_STATS = {"hits": 0, "misses": 0}
+
+
+def analyze_query(text: str) -> QueryAnalysis:
+    key = (text or "").strip()
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            _CACHE.move_to_end(key)
+            _STATS["hits"] += 1
+            return cached
+        _STATS["misses"] += 1
+    result = _analyze(key)
+    if _CACHE_SIZE:
+        with _CACHE_LOCK:
+            _CACHE[key] = result
+            _CACHE.move_to_end(key)
+            while len(_CACHE) > _CACHE_SIZE:
+                _CACHE.popitem(last=False)
+    return result
+
+
+def query_cache_stats() -> Dict[str, Any]:
+    with _CACHE_LOCK:
+        hits, misses = _STATS["hits"], _STATS["misses"]
+        size = len(_CACHE)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+        "size": size,
+        "capacity": _CACHE_SIZE,
+    }
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+按用户隔离的查询结果缓存：搜索、聚合、热门标签、统计与 AI 对话检索的结果按
+(接口, 用户, 归一化参数, 用户数据版本号) 缓存在进程内存里（LRU + TTL，按字节限流）。
+
+失效方式：owner_generations 表里每个用户一个版本号，所有写接口（上传、删除、批量操作、
+采纳标签、修改信息、编辑保存）结束时 +1。读缓存前先查一次当前版本号（主键点查），
+版本号不同的旧条目自然不再命中，多个 gunicorn worker 之间也能立即看到别人的写入。
+版本号表不可用时直接跳过缓存。
+
+环境变量：
+  RESULT_CACHE_MB    缓存上限（默认 32MB，0 表示关闭）
+  RESULT_CACHE_TTL   单条结果最长保留秒数（默认 300），兜底库外直接改数据的情况
+"""
+
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from flask import current_app, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from server.db import execute, query
+from server.utils.env import env_float
+
+
+def owner_generation(owner_id: Any) -> Optional[int]:
+    """当前数据版本号；没有记录时为 0，查询失败返回 None（调用方应绕过缓存）。"""
+    try:
+        rows = query("SELECT gen FROM owner_generations WHERE owner_id=%s", (owner_id,))
+    except Exception:
+        return None
+    return int(rows[0]["gen"]) if rows else 0
+
+
+def bump_owner_generation(owner_id: Any) -> None:
+    if owner_id is None:
+        return
+    try:
+        execute(
+            "INSERT INTO owner_generations (owner_id, gen) VALUES (%s, 1) "
+            "ON DUPLICATE KEY UPDATE gen = gen + 1",
+            (owner_id,),
+        )
+    except Exception as exc:
+        print(f"[result_cache] bump generation failed: {exc}")
+    get_result_cache().drop_owner(owner_id)
+
+
+class ResultCache:
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (过期时间, 数据, 字节数)
+        self._items: "OrderedDict[Tuple, Tuple[float, Any, int]]" = OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._pop(key)
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key: Tuple, value: Any, size: int) -> None:
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._items[key] = (time.monotonic() + self.ttl, value, size)
+            self._used += size
+            while self._used > self.max_bytes and self._items:
+                _, (_, _, dropped) = self._items.popitem(last=False)
+                self._used -= dropped
+
+    def drop_owner(self, owner_id: Any) -> None:
+        """本进程内的写入：顺手清掉该用户的旧条目，尽早释放内存（其他进程靠版本号失效）。"""
+        with self._lock:
+            for key in [k for k in self._items if k[1] == owner_id]:
+                self._pop(key)
+
+    def _pop(self, key: Tuple) -> None:
+        # 调用方需持有 _lock
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._used -= item[2]
+
+
+_CACHE: Optional[ResultCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = ResultCache(
+                    int(env_float("RESULT_CACHE_MB", 32) * 1024 * 1024),
+                    env_float("RESULT_CACHE_TTL", 300),
+                )
+    return _CACHE
+
+
+def cached_for_owner(namespace: str, owner_id: Any, params: Hashable, compute: Callable[[], Any]) -> Any:
+    """
+    取缓存结果，未命中时调用 compute() 计算并写入。
+    结果需可 JSON 序列化（用来估算大小）；命中时返回的是同一个对象，调用方不要修改。
+    """
+    key, value = peek_owner_cache(namespace, owner_id, params)
+    if value is None:
+        value = compute()
+        fill_owner_cache(key, value)
+    return value
+
+
+def peek_owner_cache(namespace: str, owner_id: Any, params: Hashable) -> Tuple[Optional[Tuple], Any]:
+    """
+    cached_for_owner 拆开的两步（流式接口边算边输出，算完再写入）：返回 (key, 命中值)。
+    key 带着查询时的版本号，计算期间有写入时结果写到旧版本下，不会被读到；key 为 None 表示缓存不可用。
+    """
+    cache = get_result_cache()
+    gen = owner_generation(owner_id) if cache.enabled else None
+    if gen is None:
+        return None, None
+    key = (namespace, owner_id, gen, params)
+    return key, cache.get(key)
+
+
+def fill_owner_cache(key: Optional[Tuple], value: Any) -> None:
+    if key is None:
+        return
+    try:
+        size = len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+    except (TypeError, ValueError):
+        return
+    get_result_cache().put(key, value, size)
+
+
+def _jwt_owner_id() -> Any:
+    uid = get_jwt_identity()
+    if isinstance(uid, dict):
+        return uid.get("user_id") or uid.get("id")
+    if isinstance(uid, str) and uid.isdigit():
+        return int(uid)
+    return uid
+
+
+def request_args_key() -> Tuple:
+    """归一化查询参数：同名多值保持顺序，参数之间按名称排序。"""
+    return tuple(sorted((k, tuple(v)) for k, v in request.args.lists()))
+
+
+def cache_owner_response(namespace: str):
+    """
+    GET 接口的响应缓存（放在 @jwt_required() 下面）：按用户 + 路径 + 查询参数缓存 200 响应体。
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = get_result_cache()
+            owner_id = _jwt_owner_id()
+            gen = owner_generation(owner_id) if cache.enabled else None
+            if gen is None:
+                return view(*args, **kwargs)
+            key = (namespace, owner_id, gen, (request.path, request_args_key()))
+            hit = cache.get(key)
+            if hit is not None:
+                body, mimetype = hit
+                return current_app.response_class(body, status=200, mimetype=mimetype)
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code == 200 and not resp.direct_passthrough:
+                body = resp.get_data()
+                cache.put(key, (body, resp.mimetype), len(body))
+            return resp
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates_owner_cache(view):
+    """写接口（放在 @jwt_required() 下面）：无论成功与否，结束后都让该用户的缓存失效。"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        finally:
+            bump_owner_generation(_jwt_owner_id())
+
+    return wrapper
@@ -1,27 +1,31 @@
 # -*- coding: utf-8 -*-
 """
 AI 工作台路由：聊天检索 + 兜底内容分析。
+/api/ai/chat-search/stream 与 /api/ai/message/stream 以 SSE 逐步返回结果，客户端断开即取消剩余的模型调用。
 """
 
 import json
 import os
 import re
+import threading
 from collections import Counter
+from contextlib import closing
 from typing import Dict, List
 
-from flask import Blueprint, Response, request, g, current_app
+from flask import Blueprint, Response, request, g, current_app, stream_with_context
 from flask_jwt_extended import get_jwt_identity, jwt_required
 
+from server.ai_client import get_ai_client
+from server.ai_tagger import ensure_tagger
 from server.ai_search_agent import (
     ai_build_search_query,
     search_images_with_query,
-    fallback_content_search,
     find_images_by_tag_exact,
-    _expand_keywords_with_synonyms,
-    pick_display_keyword,
+    iter_fallback_content_search,
 )
 from server.db import query
 from server.photo_analysis_agent import analyze_image_explain
+from server.result_cache import cached_for_owner, fill_owner_cache, peek_owner_cache
 
 bp = Blueprint("ai", __name__)
 
@@ -51,6 +55,12 @@ _GREETINGS = ("你好", "您好", "在吗", "hi", "hello", "嗨", "哈喽", "早
 _THANKS = ("谢谢", "多谢", "辛苦了", "感谢", "谢啦", "thx", "thanks")
 
 
+@bp.before_app_request
+def _ensure_ai_tagger():
+    # AI_TAGGER_INTERVAL > 0 时每个 worker 启动批量标注线程（见 ai_tagger.py），否则什么也不做
+    ensure_tagger(_get_upload_root())
+
+
 def _json_response(payload: Dict, status: int = 200) -> Response:
     """Return JSON with explicit UTF-8 charset to avoid mojibake in clients."""
     body = json.dumps(payload, ensure_ascii=False)
@@ -124,12 +134,41 @@ def _build_search_reply(display_keyword: str, results: List[Dict]) -> str:
     return f"我暂时没在图库里找到与「{keyword}」有关的图片。你可以换个更具体的关键词试试。"
 
 
-def _run_search(message: str, user_id: int, limit: int) -> Dict:
-    """Shared search workflow for unified and legacy endpoints."""
+def _merge_hit(base: Dict, item: Dict) -> None:
+    """同一张图被多路命中时合并：取最高分，字段取并集，补齐推荐标签与描述。"""
+    base["score"] = max(base.get("score") or 0, item.get("score") or 0)
+    if item.get("matched_fields"):
+        base["matched_fields"] = sorted(set(base.get("matched_fields") or []) | set(item.get("matched_fields") or []))
+    if not base.get("match_reason"):
+        base["match_reason"] = item.get("match_reason") or "text_match"
+    if item.get("short_caption") and not base.get("short_caption"):
+        base["short_caption"] = item.get("short_caption")
+    if not base.get("suggested_tags"):
+        base["suggested_tags"] = item.get("suggested_tags") or []
+
+
+def _strongly_related(item: Dict) -> bool:
+    """强相关过滤：需要有命中的字段；文本匹配时若无标签/标题命中且分低则丢弃。"""
+    fields = set(item.get("matched_fields") or [])
+    if not fields:
+        return False
+    reason = item.get("match_reason") or ""
+    return not (reason in ("", "text_match") and not ({"tags", "title"} & fields) and (item.get("score") or 0) < 3.0)
+
+
+def _search_events(message: str, user_id: int, limit: int, should_stop=None):
+    """
+    检索流程，按阶段产出 (事件名, 数据)：
+      metadata   标签精确 + 文本检索的命中
+      expansion  同义词扩展后新增的命中
+      fallback   兜底内容检索每命中一张给一次；progress 为逐张请求模型时的评估进度
+      done       最终结果（与非流式接口的返回完全相同，前面的事件只是提前展示）
+    调用方停止迭代（流式接口客户端断开）后，剩余的模型调用不再发出。
+    """
     query_obj = ai_build_search_query(message)
-    display_keyword = pick_display_keyword(query_obj) or message
+    display_keyword = query_obj.get("display_keyword") or message
     if not (query_obj.get("keywords") or []):
-        return {
+        yield "done", {
             "reply": "关键词过少或过于宽泛，请提供更具体的描述再试试～",
             "results": [],
             "images": [],
@@ -138,6 +177,7 @@ def _run_search(message: str, user_id: int, limit: int) -> Dict:
             "expandedKeywords": [],
             "displayKeyword": display_keyword,
         }
+        return
 
     expansion_threshold = 5
     fallback_threshold = 5
@@ -145,31 +185,21 @@ def _run_search(message: str, user_id: int, limit: int) -> Dict:
     if len(query_obj.get("keywords") or []) == 1:
         tag_exact_hits = find_images_by_tag_exact(query_obj["keywords"][0], user_id=user_id, limit=limit)
 
-    results_meta = list(tag_exact_hits)
-    if len(results_meta) < limit:
-        text_meta = search_images_with_query(query_obj, user_id=user_id, limit=limit)
-        # 合并，tag 精准命中优先
-        exist_map = {it["id"]: it for it in results_meta}
-        for item in text_meta:
-            if item["id"] in exist_map:
-                base = exist_map[item["id"]]
-                base["score"] = max(base.get("score") or 0, item.get("score") or 0)
-                if item.get("matched_fields"):
-                    base["matched_fields"] = sorted(
-                        set(base.get("matched_fields") or []) | set(item.get("matched_fields") or [])
-                    )
-                if not base.get("match_reason"):
-                    base["match_reason"] = item.get("match_reason") or "text_match"
+    # tag 精准命中优先
+    merged: Dict = {it["id"]: it for it in tag_exact_hits}
+    if len(merged) < limit:
+        for item in search_images_with_query(query_obj, user_id=user_id, limit=limit):
+            if item["id"] in merged:
+                _merge_hit(merged[item["id"]], item)
             else:
-                exist_map[item["id"]] = item
-        results_meta = list(exist_map.values())
+                merged[item["id"]] = item
+    sent = {i for i, it in merged.items() if _strongly_related(it)}
+    yield "metadata", {"results": [_to_camel(it) for it in merged.values() if it["id"] in sent]}
 
     used_expansion = False
     expanded_keywords = []
-    if len(results_meta) < expansion_threshold:
-        expanded_keywords = _expand_keywords_with_synonyms(
-            query_obj.get("keywords") or [], query_obj.get("cleaned_keyword") or ""
-        )
+    if len(merged) < expansion_threshold:
+        expanded_keywords = list(query_obj.get("expanded_keywords") or [])
         if expanded_keywords:
             print(f"[ai chat-search] expanded keywords: {expanded_keywords}")
             new_keywords = list(dict.fromkeys((query_obj.get("keywords") or []) + expanded_keywords))
@@ -177,68 +207,46 @@ def _run_search(message: str, user_id: int, limit: int) -> Dict:
             more_meta = search_images_with_query(expanded_query, user_id=user_id, limit=limit)
             if more_meta:
                 used_expansion = True
-                # merge new results into meta list while keeping highest score/suggestions
-                exist_map = {it["id"]: it for it in results_meta}
+                fresh = []
                 for item in more_meta:
-                    if item["id"] in exist_map:
-                        base = exist_map[item["id"]]
-                        base["score"] = max(base.get("score") or 0, item.get("score") or 0)
-                        if item.get("matched_fields"):
-                            base["matched_fields"] = sorted(
-                                set(base.get("matched_fields") or []) | set(item.get("matched_fields") or [])
-                            )
-                        if item.get("short_caption") and not base.get("short_caption"):
-                            base["short_caption"] = item.get("short_caption")
-                        if not base.get("suggested_tags"):
-                            base["suggested_tags"] = item.get("suggested_tags") or []
+                    if item["id"] in merged:
+                        _merge_hit(merged[item["id"]], item)
                     else:
-                        exist_map[item["id"]] = item
-                results_meta = list(exist_map.values())
-
-    results_fallback = []
-    fallback_called = len(results_meta) < fallback_threshold
-    used_fallback = False
-    if fallback_called:
-        results_fallback = fallback_content_search(message, user_id=user_id, limit=limit)
-        used_fallback = True
-
-    merged = {}
-    for item in results_meta:
-        merged[item["id"]] = item
-    for item in results_fallback:
-        if item["id"] in merged:
-            base = merged[item["id"]]
-            base["score"] = max(base.get("score") or 0, item.get("score") or 0)
-            if item.get("matched_fields"):
-                base["matched_fields"] = sorted(
-                    set(base.get("matched_fields") or []) | set(item.get("matched_fields") or [])
-                )
-            if not base.get("suggested_tags"):
-                base["suggested_tags"] = item.get("suggested_tags") or []
-            if item.get("short_caption") and not base.get("short_caption"):
-                base["short_caption"] = item.get("short_caption")
-        else:
-            merged[item["id"]] = item
-
-    final_list = []
-    for item in merged.values():
-        fields = set(item.get("matched_fields") or [])
-        score = item.get("score") or 0
-        reason = item.get("match_reason") or ""
-        # 强相关过滤：需要有命中的字段；文本匹配时若无标签/标题命中且分低则丢弃
-        if not fields:
-            continue
-        if reason in ("", "text_match") and (not ({"tags", "title"} & fields)) and score < 3.0:
-            continue
-        final_list.append(item)
+                        merged[item["id"]] = item
+                    if item["id"] not in sent and _strongly_related(merged[item["id"]]):
+                        sent.add(item["id"])
+                        fresh.append(_to_camel(merged[item["id"]]))
+                yield "expansion", {"results": fresh, "expandedKeywords": expanded_keywords}
+
+    used_fallback = len(merged) < fallback_threshold
+    if used_fallback:
+        fallback_hits = []
+        fallback = iter_fallback_content_search(message, user_id=user_id, limit=limit, should_stop=should_stop)
+        with closing(fallback):  # 本生成器被关闭时同步关闭兜底检索，取消未开始的模型调用
+            for kind, data in fallback:
+                if kind == "progress":
+                    yield "progress", data
+                    continue
+                fallback_hits.append(data)
+                if data["id"] not in sent and _strongly_related(data):
+                    sent.add(data["id"])
+                    yield "fallback", {"result": _to_camel(data)}
+        # 与非流式一致：兜底结果按分数取前 limit 张再合并
+        fallback_hits.sort(key=lambda x: x.get("match_score") or 0, reverse=True)
+        for item in fallback_hits[:limit]:
+            if item["id"] in merged:
+                _merge_hit(merged[item["id"]], item)
+            else:
+                merged[item["id"]] = item
 
+    final_list = [item for item in merged.values() if _strongly_related(item)]
     final_list.sort(key=lambda x: (-(x.get("score") or 0), x.get("title") or ""))
     if len(final_list) > limit:
         final_list = final_list[:limit]
     reply = _build_search_reply(display_keyword, final_list)
     results = [_to_camel(it) for it in final_list]
 
-    return {
+    yield "done", {
         "reply": reply,
         "results": results,
         "images": results,
@@ -249,6 +257,19 @@ def _run_search(message: str, user_id: int, limit: int) -> Dict:
     }
 
 
+def _run_search(message: str, user_id: int, limit: int) -> Dict:
+    """Shared search workflow for unified and legacy endpoints."""
+    for event, data in _search_events(message, user_id, limit):
+        if event == "done":
+            return data
+    return {}
+
+
+def _cached_search(message: str, user_id: int, limit: int) -> Dict:
+    """同一用户重复的检索直接取缓存（含兜底内容分析的结果），写操作后自动失效；返回值只读。"""
+    return cached_for_owner("chat-search", user_id, (message, limit), lambda: _run_search(message, user_id, limit))
+
+
 def _to_camel(item: Dict) -> Dict:
     return {
         "id": item.get("id"),
@@ -325,7 +346,7 @@ def chat_search():
 
         limit = int(data.get("limit") or 12)
         limit = max(1, min(limit, 30))
-        payload = _run_search(message, g.user_id, limit)
+        payload = dict(_cached_search(message, g.user_id, limit))
         payload["ok"] = True
         return _json_response(payload)
     except Exception as exc:
@@ -349,7 +370,7 @@ def ai_message():
         if intent == "unknown":
             intent = "chat"
         if intent == "search":
-            payload = _run_search(message, g.user_id, limit)
+            payload = dict(_cached_search(message, g.user_id, limit))
             payload.update({"ok": True, "intent": "search"})
             return _json_response(payload)
 
@@ -359,6 +380,82 @@ def ai_message():
         return _json_response({"ok": False, "error": "AI 服务异常", "detail": str(exc)}, 500)
 
 
+# ===== 流式（Server-Sent Events）=====
+# 事件依次为 metadata / expansion / progress / fallback / done（见 _search_events），出错时为 error。
+# 浏览器 EventSource 不能带 Authorization 头，前端用 fetch + ReadableStream 读取（POST，与非流式接口同样的参数）。
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _stream_request_args():
+    data = request.get_json(silent=True) or {}
+    message = (data.get("message") or data.get("q") or request.args.get("message") or request.args.get("q") or "").strip()
+    try:
+        limit = int(data.get("limit") or request.args.get("limit") or 12)
+    except (TypeError, ValueError):
+        limit = 12
+    return message, max(1, min(limit, 30))
+
+
+def _sse_response(events) -> Response:
+    return Response(
+        stream_with_context(events),  # 生成器里仍能读取 current_app.config（上传目录）
+        content_type="text/event-stream; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # 关闭 nginx 缓冲，事件立即送达
+    )
+
+
+def _stream_search(message: str, user_id: int, limit: int, extra: Dict):
+    key, cached = peek_owner_cache("chat-search", user_id, (message, limit))
+    yield ": stream\n\n"  # 先把响应头送出去
+    if cached is not None:
+        yield _sse("done", {**cached, **extra, "ok": True})
+        return
+    stop = threading.Event()
+    events = _search_events(message, user_id, limit, should_stop=stop.is_set)
+    try:
+        for event, data in events:
+            if event == "done":
+                fill_owner_cache(key, data)
+                data = {**data, **extra, "ok": True}
+            yield _sse(event, data)
+    except Exception as exc:
+        yield _sse("error", {"ok": False, "error": "数据库或检索异常", "detail": str(exc)})
+    finally:
+        # 客户端断开时服务器在下一次写入失败后关闭本生成器：先置停止标记，已排队的模型调用开始时直接跳过，
+        # 再关闭检索生成器，未提交的调用随之取消（见 ai_client.iter_fan_out）
+        stop.set()
+        events.close()
+
+
+@bp.route("/api/ai/chat-search/stream", methods=["GET", "POST"])
+@jwt_required()
+def chat_search_stream():
+    """AI 对话检索（流式）：元数据命中立即返回，兜底内容分析逐张返回，最后是与非流式接口相同的 done。"""
+    g.user_id = _current_user_id_from_jwt()
+    message, limit = _stream_request_args()
+    if not message:
+        return _json_response({"ok": False, "error": "缺少搜索内容"}, 400)
+    return _sse_response(_stream_search(message, g.user_id, limit, {}))
+
+
+@bp.route("/api/ai/message/stream", methods=["GET", "POST"])
+@jwt_required()
+def ai_message_stream():
+    """统一对话入口（流式）：检索意图走 chat-search 的事件流，闲聊直接返回一个 done。"""
+    g.user_id = _current_user_id_from_jwt()
+    message, limit = _stream_request_args()
+    if not message:
+        return _json_response({"ok": False, "error": "缺少对话内容"}, 400)
+    intent = _rule_intent(message)
+    if intent == "search":
+        return _sse_response(_stream_search(message, g.user_id, limit, {"intent": "search"}))
+    payload = {"ok": True, "intent": "chat", "reply": _chat_reply(message), "images": [], "results": []}
+    return _sse_response(iter([_sse("done", payload)]))
+
+
 @bp.post("/api/ai/explain-images")
 @jwt_required()
 def explain_images():
@@ -396,6 +493,7 @@ def explain_images():
         row_map = {r["id"]: r for r in rows}
 
         items = []
+        pending = []  # (items 下标, 行, 绝对路径)
         for image_id in ids:
             row = row_map.get(image_id)
             if not row:
@@ -420,26 +518,27 @@ def explain_images():
                     }
                 )
                 continue
-            try:
-                result = analyze_image_explain(abs_path, style=style)
-                items.append(
-                    {
-                        "imageId": image_id,
-                        "title": result.get("title") or row.get("title") or "",
-                        "explanation": result.get("explanation") or "",
-                        "highlights": result.get("highlights") or [],
-                        "tags": result.get("tags") or [],
-                    }
-                )
-            except Exception as exc:
-                items.append(
-                    {
-                        "imageId": image_id,
-                        "title": row.get("title") or "",
-                        "explanation": f"分析失败：{exc}",
-                        "highlights": [],
-                    }
-                )
+            pending.append((len(items), row, abs_path))
+            items.append(None)
+
+        # 多张图片并发讲解，结果按原顺序填回
+        outcomes = get_ai_client().fan_out(lambda p: analyze_image_explain(p[2], style=style), pending)
+        for (idx, row, _), (result, exc) in zip(pending, outcomes):
+            if exc is not None:
+                items[idx] = {
+                    "imageId": row["id"],
+                    "title": row.get("title") or "",
+                    "explanation": f"分析失败：{exc}",
+                    "highlights": [],
+                }
+                continue
+            items[idx] = {
+                "imageId": row["id"],
+                "title": result.get("title") or row.get("title") or "",
+                "explanation": result.get("explanation") or "",
+                "highlights": result.get("highlights") or [],
+                "tags": result.get("tags") or [],
+            }
 
         return _json_response({"ok": True, "items": items})
     except Exception as exc:
@@ -4,30 +4,55 @@ import json
 import os
 import re
 import shutil
-import threading
 import time
 import uuid
-from dataclasses import dataclass, field
 from datetime import datetime
+from functools import partial
 from io import BytesIO
-import zipfile  # #advise 批量打包下载
 import tempfile
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from flask import Blueprint, current_app, g, jsonify, request, send_file, send_from_directory
+from flask import Blueprint, Response, current_app, g, jsonify, request, send_file, send_from_directory
 from flask_jwt_extended import get_jwt_identity, jwt_required
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps  # 简单图像处理
-try:
-    import jieba
-    _JIEBA_AVAILABLE = True
-except Exception:
-    jieba = None
-    _JIEBA_AVAILABLE = False
 
 from server.db import execute, executemany, query
+from server.edit_session_store import EditSession, EditSessionConflict, EditSessionStore, get_session_store
+from server.export_jobs import (
+    ExportLimitExceeded,
+    archive_path,
+    cancel_job,
+    get_job,
+    job_payload,
+    submit_export,
+    sweep_expired,
+)
+from server.facet_counters import FacetTracker, read_facets, read_stats
+from server.file_reclaim import delete_images, ensure_reaper
+from server.image_executor import (
+    ImageJobCancelled,
+    ImageJobTimeout,
+    coalesce_image_job,
+    edit_job,
+    encode_job,
+    preview_job,
+    run_image_job,
+    session_step_job,
+)
 from server.photo_analysis_agent import analyze_image
+from server.query_analysis import analyze_query
+from server.result_cache import cache_owner_response, invalidates_owner_cache
 from server.util_exif import extract_exif
-from server.utils import classify_device
+from server.utils import (
+    JPEG_EXTS,
+    classify_device,
+    lossless_jpeg_transform,
+)
+from server.utils.image_ops import edit_params_hash, geometry_only_ops, history_geometry_ops
+from server.utils.large_image import ImageTooLarge, preview_header_scale, probe_preview_scale
+from server.utils.preview_cache import get_preview_cache, preview_cache_key
+from server.utils.zip_stream import archive_size, make_entry, stream_zip
+
+from werkzeug.datastructures import MultiDict
 
 import jwt
 
@@ -42,55 +67,13 @@ ALLOWED_MIMES = {
     "image/heic",
     "image/heif",
 }
+PREVIEW_QUALITY = 90
 TMP_AI_DIR = os.path.join(tempfile.gettempdir(), "bs_ai_tmp")
 os.makedirs(TMP_AI_DIR, exist_ok=True)
 TMP_EXIF_DIR = os.path.join(tempfile.gettempdir(), "bs_exif_tmp")
 os.makedirs(TMP_EXIF_DIR, exist_ok=True)
 
 
-def _facet_from_sql(field_expr: str, owner_id: int, limit: int = 50):
-    sql = f"""
-        SELECT val AS value, COUNT(*) AS cnt FROM (
-            SELECT TRIM({field_expr}) AS val
-            FROM images i
-            LEFT JOIN exif e ON e.image_id = i.id
-            WHERE i.owner_id=%s AND {field_expr} IS NOT NULL AND TRIM({field_expr})!=''
-        ) t
-        GROUP BY val
-        ORDER BY cnt DESC, val ASC
-        LIMIT %s
-    """
-    rows = query(sql, (owner_id, limit))
-    return [{"value": r["value"], "count": r["cnt"]} for r in rows]
-
-
-def _segment_query_tokens(query: str) -> Tuple[List[str], List[str]]:
-    """Split Chinese query into tokens; single-char tokens are treated as weak."""
-    raw = re.sub(r"\s+", " ", (query or "").strip())
-    if not raw:
-        return [], []
-    if _JIEBA_AVAILABLE:
-        parts = list(jieba.cut(raw, cut_all=False))
-    else:
-        parts = re.split(r"[\s,，]+", raw)
-    tokens = []
-    for part in parts:
-        token = (part or "").strip()
-        if not token:
-            continue
-        if not re.search(r"[A-Za-z0-9\u4e00-\u9fff]", token):
-            continue
-        tokens.append(token)
-    strong, weak = [], []
-    for token in tokens:
-        if len(token) <= 1:
-            weak.append(token)
-        else:
-            strong.append(token)
-    strong = list(dict.fromkeys(strong))
-    weak = list(dict.fromkeys(weak))
-    return strong, weak
-
 # ===== 简易鉴权（沿用当前 JWT 配置）=====
 '''
 def current_user_id():
@@ -158,37 +141,6 @@ def _has_visibility_column() -> bool:
 DEFAULT_UPLOAD_DIR = os.path.abspath(
     os.path.join(os.path.dirname(__file__), os.getenv("UPLOAD_DIR", "uploads"))
 )
-EDIT_SESSIONS: Dict[str, "EditSession"] = {}
-EDIT_SESSIONS_LOCK = threading.Lock()
-EDIT_SESSIONS_BOOTSTRAPPED = False
-
-
-@dataclass
-class EditSession:
-    session_id: str
-    owner_id: int
-    image_id: int
-    orig_abs_path: str
-    orig_rel_path: str
-    ext: str
-    versions: List[str]
-    idx: int
-    created_at: datetime
-    updated_at: datetime
-    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
-
-    def to_dict(self) -> Dict:
-        return {
-            "session_id": self.session_id,
-            "owner_id": self.owner_id,
-            "image_id": self.image_id,
-            "orig_rel_path": self.orig_rel_path,
-            "ext": self.ext,
-            "versions": self.versions,
-            "idx": self.idx,
-            "created_at": self.created_at.isoformat(),
-            "updated_at": self.updated_at.isoformat(),
-        }
 
 
 def _get_upload_root() -> str:
@@ -214,114 +166,16 @@ def _session_abs_path(rel_path: str, upload_root: Optional[str] = None) -> str:
     return os.path.join(root, rel_path)
 
 
-def _persist_session(session: EditSession, upload_root: Optional[str] = None) -> None:
-    root = upload_root or _get_upload_root()
-    session_dir = os.path.join(root, "edit_sessions", session.session_id)
-    os.makedirs(session_dir, exist_ok=True)
-    meta_path = os.path.join(session_dir, "session.json")
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(session.to_dict(), f, ensure_ascii=False, indent=2)
-
-
-def _parse_dt(raw: str) -> datetime:
-    try:
-        return datetime.fromisoformat(raw)
-    except Exception:
-        return datetime.utcnow()
-
-
-def _load_sessions_from_disk(upload_root: Optional[str] = None) -> None:
-    root = os.path.join(upload_root or DEFAULT_UPLOAD_DIR, "edit_sessions")
-    if not os.path.isdir(root):
-        return
-    for name in os.listdir(root):
-        session_dir = os.path.join(root, name)
-        if not os.path.isdir(session_dir):
-            continue
-        meta_path = os.path.join(session_dir, "session.json")
-        if not os.path.exists(meta_path):
-            continue
-        try:
-            with open(meta_path, "r", encoding="utf-8") as f:
-                meta = json.load(f)
-        except Exception:
-            continue
-        session_id = meta.get("session_id") or name
-        owner_id = int(meta.get("owner_id") or 0)
-        image_id = int(meta.get("image_id") or 0)
-        orig_rel = (meta.get("orig_rel_path") or "").strip()
-        ext = (meta.get("ext") or "").strip().lower()
-        versions = meta.get("versions") or []
-        idx = int(meta.get("idx") or 0)
-        if not session_id or not owner_id or not image_id or not orig_rel or not versions:
-            continue
-        if idx < 0 or idx >= len(versions):
-            idx = max(0, min(len(versions) - 1, idx))
-        created_at = _parse_dt(meta.get("created_at") or "")
-        updated_at = _parse_dt(meta.get("updated_at") or "")
-        upload_root = upload_root or DEFAULT_UPLOAD_DIR
-        orig_abs = os.path.join(upload_root, orig_rel)
-        session = EditSession(
-            session_id=session_id,
-            owner_id=owner_id,
-            image_id=image_id,
-            orig_abs_path=orig_abs,
-            orig_rel_path=orig_rel,
-            ext=ext,
-            versions=versions,
-            idx=idx,
-            created_at=created_at,
-            updated_at=updated_at,
-        )
-        EDIT_SESSIONS[session_id] = session
-
-
-def cleanup_old_sessions(ttl_minutes: int = 60, upload_root: Optional[str] = None) -> None:
-    root = upload_root or _get_upload_root()
-    sessions_root = os.path.join(root, "edit_sessions")
-    if not os.path.isdir(sessions_root):
-        return
-    now = datetime.utcnow()
-    ttl_seconds = max(1, ttl_minutes) * 60
-    expired_ids = []
-    with EDIT_SESSIONS_LOCK:
-        for sid, sess in EDIT_SESSIONS.items():
-            if (now - sess.updated_at).total_seconds() > ttl_seconds:
-                expired_ids.append(sid)
-    for sid in expired_ids:
-        _discard_session(sid, root)
-    # 清理未注册在内存中的残留目录
-    for name in os.listdir(sessions_root):
-        dir_path = os.path.join(sessions_root, name)
-        if not os.path.isdir(dir_path):
-            continue
-        if name in EDIT_SESSIONS:
-            continue
-        try:
-            mtime = os.path.getmtime(dir_path)
-        except Exception:
-            continue
-        if (now - datetime.utcfromtimestamp(mtime)).total_seconds() > ttl_seconds:
-            shutil.rmtree(dir_path, ignore_errors=True)
+def _session_store() -> EditSessionStore:
+    return get_session_store(_get_upload_root())
 
 
-def _bootstrap_edit_sessions() -> None:
-    global EDIT_SESSIONS_BOOTSTRAPPED
-    if EDIT_SESSIONS_BOOTSTRAPPED:
-        return
-    with EDIT_SESSIONS_LOCK:
-        if EDIT_SESSIONS_BOOTSTRAPPED:
-            return
-        upload_root = _get_upload_root()
-        os.makedirs(os.path.join(upload_root, "edit_sessions"), exist_ok=True)
-        _load_sessions_from_disk(upload_root)
-        cleanup_old_sessions(upload_root=upload_root)
-        EDIT_SESSIONS_BOOTSTRAPPED = True
+def _persist_session(session: EditSession, upload_root: Optional[str] = None) -> None:
+    get_session_store(upload_root or _get_upload_root()).persist(session)
 
 
 def _get_session(session_id: str, owner_id: int) -> Optional[EditSession]:
-    _bootstrap_edit_sessions()
-    session = EDIT_SESSIONS.get(session_id)
+    session = _session_store().get(session_id)
     if not session or session.owner_id != owner_id:
         return None
     return session
@@ -341,23 +195,19 @@ def _session_payload(session: EditSession) -> Dict:
 
 
 def _discard_session(session_id: str, upload_root: Optional[str] = None) -> None:
-    root = upload_root or _get_upload_root()
-    session = None
-    with EDIT_SESSIONS_LOCK:
-        session = EDIT_SESSIONS.pop(session_id, None)
-    if not session:
-        return
-    with session.lock:
-        pass
-    dir_path = os.path.join(root, "edit_sessions", session_id)
-    shutil.rmtree(dir_path, ignore_errors=True)
+    get_session_store(upload_root or _get_upload_root()).discard(session_id)
 
 
-# 模块加载时做一次过期清理，避免重启后残留堆积
-try:
-    cleanup_old_sessions(upload_root=DEFAULT_UPLOAD_DIR)
-except Exception:
-    pass
+@bp.before_app_request
+def _ensure_file_reaper():
+    # 每个 worker 进程首次处理请求时启动回收线程，重启前未处理完的队列也会继续回收
+    ensure_reaper(_get_upload_root())
+
+
+@bp.errorhandler(EditSessionConflict)
+def _edit_session_conflict(_exc):
+    # 其他 worker 在本次修改期间写入了更新的版本（文件锁不可用的部署下才会出现）
+    return jsonify({"error": "会话已在其他窗口更新，请刷新后重试"}), 409
 
 
 # ===== 静态文件回显（/files/<path>）=====
@@ -438,47 +288,12 @@ def _format_exif_preview(payload: Dict) -> Dict:
 
 @bp.get("/api/images/facets")
 @jwt_required()
+@cache_owner_response("facets")
 def image_facets():
-    """聚合建议：相机品牌/型号/格式/设备"""
+    """聚合建议：相机品牌/型号/格式/设备（读物化计数，见 facet_counters.py）"""
     g.user_id = _current_user_id_from_jwt()
     try:
-        facets = {
-            "camera_make": _facet_from_sql("COALESCE(e.camera_make, i.camera_make)", g.user_id),
-            "camera_model": _facet_from_sql("COALESCE(e.camera_model, i.camera_model)", g.user_id),
-        }
-
-        # 格式：从 stored_path/path/mime 取扩展名
-        fmt_rows = query(
-            """
-            SELECT LOWER(SUBSTRING_INDEX(COALESCE(i.stored_path,i.path),'.',-1)) AS fmt, COUNT(*) AS cnt
-            FROM images i
-            WHERE i.owner_id=%s AND COALESCE(i.stored_path,i.path) IS NOT NULL
-            GROUP BY fmt
-            HAVING fmt IS NOT NULL AND fmt!=''
-            ORDER BY cnt DESC, fmt ASC
-            LIMIT 50
-            """,
-            (g.user_id,),
-        )
-        facets["format"] = [{"value": r["fmt"], "count": r["cnt"]} for r in fmt_rows if r.get("fmt")]
-
-        # 设备：根据品牌/型号粗分
-        dev_rows = query(
-            """
-            SELECT COALESCE(e.camera_make, i.camera_make) AS make, COALESCE(e.camera_model, i.camera_model) AS model
-            FROM images i
-            LEFT JOIN exif e ON e.image_id = i.id
-            WHERE i.owner_id=%s
-            """,
-            (g.user_id,),
-        )
-        device_count = {}
-        for r in dev_rows:
-            dev = classify_device(r.get("make"), r.get("model"))
-            if dev:
-                device_count[dev] = device_count.get(dev, 0) + 1
-        facets["device"] = [{"value": k, "count": v} for k, v in sorted(device_count.items(), key=lambda x: x[1], reverse=True)]
-
+        facets = read_facets(g.user_id)
         return jsonify(facets)
     except Exception as exc:
         return jsonify({"ok": False, "error": "聚合失败", "detail": str(exc)}), 500
@@ -561,10 +376,29 @@ def ai_analyze_image():
                 pass
 
 
+# 以下特征相关模块依赖 numpy，都在用到时才导入，不拖慢应用启动
+
+def _file_features(abs_path: str) -> Dict:
+    from server.utils.image_features import file_features
+
+    return file_features(abs_path)
+
+
+def _store_features(image_id: int, features: Dict) -> None:
+    from server.color_index import store_color_signature
+    from server.similar_index import store_hashes
+
+    store_hashes(image_id, features["phash"], features["dhash"])
+    store_color_signature(image_id, features["color_sig"])
+
+
 # ===== 上传 =====
 @bp.post("/api/upload")
 @jwt_required()
+@invalidates_owner_cache
 def upload():
+    from server.similar_index import near_duplicates
+
     title = request.form.get("title") or None
     g.user_id = _current_user_id_from_jwt()
     files = request.files.getlist("files")
@@ -581,6 +415,7 @@ def upload():
         return jsonify({"error": "请选择要上传的文件"}), 400
 
     max_mb = int(os.getenv("MAX_UPLOAD_MB", "10"))
+    check_similar = (request.form.get("check_similar") or "1") not in ("0", "false")
     saved = []
 
     for fs in files:
@@ -612,47 +447,50 @@ def upload():
             if not exif_row and rel_path:
                 abs_path_existing = os.path.join(current_app.config["UPLOAD_DIR"], rel_path)
                 meta_dup = extract_exif(abs_path_existing)
+                with FacetTracker(g.user_id) as facets_dup:
+                    facets_dup.before([row["id"]])
 
-                extra_json_dup = None
-                if meta_dup.get("extra") is not None:
-                    try:
-                        extra_json_dup = json.dumps(meta_dup["extra"], ensure_ascii=False)
-                    except TypeError:
-                        extra_json_dup = json.dumps(str(meta_dup["extra"]), ensure_ascii=False)
+                    extra_json_dup = None
+                    if meta_dup.get("extra") is not None:
+                        try:
+                            extra_json_dup = json.dumps(meta_dup["extra"], ensure_ascii=False)
+                        except TypeError:
+                            extra_json_dup = json.dumps(str(meta_dup["extra"]), ensure_ascii=False)
 
-                execute(
-                    """
-                    INSERT INTO exif
-                      (image_id, camera_make, camera_model,
-                       f_number, exposure_time, iso, focal_length,
-                       taken_at, gps_lat, gps_lng, extra)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    ON DUPLICATE KEY UPDATE
-                      camera_make=VALUES(camera_make),
-                      camera_model=VALUES(camera_model),
-                      f_number=VALUES(f_number),
-                      exposure_time=VALUES(exposure_time),
-                      iso=VALUES(iso),
-                      focal_length=VALUES(focal_length),
-                      taken_at=VALUES(taken_at),
-                      gps_lat=VALUES(gps_lat),
-                      gps_lng=VALUES(gps_lng),
-                      extra=VALUES(extra)
-                """,
-                    (
-                        row["id"],
-                        meta_dup.get("camera_make"),
-                        meta_dup.get("camera_model"),
-                        meta_dup.get("f_number"),
-                        meta_dup.get("exposure_time"),
-                        meta_dup.get("iso"),
-                        meta_dup.get("focal_length"),
-                        meta_dup.get("taken_at"),
-                        meta_dup.get("gps_lat"),
-                        meta_dup.get("gps_lng"),
-                        extra_json_dup,
-                    ),
-                )
+                    execute(
+                        """
+                        INSERT INTO exif
+                          (image_id, camera_make, camera_model,
+                           f_number, exposure_time, iso, focal_length,
+                           taken_at, gps_lat, gps_lng, extra)
+                        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        ON DUPLICATE KEY UPDATE
+                          camera_make=VALUES(camera_make),
+                          camera_model=VALUES(camera_model),
+                          f_number=VALUES(f_number),
+                          exposure_time=VALUES(exposure_time),
+                          iso=VALUES(iso),
+                          focal_length=VALUES(focal_length),
+                          taken_at=VALUES(taken_at),
+                          gps_lat=VALUES(gps_lat),
+                          gps_lng=VALUES(gps_lng),
+                          extra=VALUES(extra)
+                    """,
+                        (
+                            row["id"],
+                            meta_dup.get("camera_make"),
+                            meta_dup.get("camera_model"),
+                            meta_dup.get("f_number"),
+                            meta_dup.get("exposure_time"),
+                            meta_dup.get("iso"),
+                            meta_dup.get("focal_length"),
+                            meta_dup.get("taken_at"),
+                            meta_dup.get("gps_lat"),
+                            meta_dup.get("gps_lng"),
+                            extra_json_dup,
+                        ),
+                    )
+                    facets_dup.after([row["id"]])
 
             saved.append({"duplicated": True, "image_id": row["id"]})
             continue
@@ -668,75 +506,83 @@ def upload():
 
         # 提取 EXIF（尺寸、拍摄时间、设备、GPS 等）+ 自动标签
         meta = extract_exif(abs_path)
+        # 感知哈希 + 颜色签名（同一次解码）；内容几乎一样（重新编码、缩放、导出副本）的图片给出提示，不拦截
+        features = _file_features(abs_path)
+        similar = near_duplicates(g.user_id, features["phash"], features["dhash"]) if check_similar else []
 
-        # 入库 images，同时写入 path / stored_path
-        image_id = execute(
-            """
-            INSERT INTO images
-            (owner_id, path, stored_path, mime_type, size_bytes, width, height, sha256,
-             camera_make, camera_model, gps_lat, gps_lng, taken_at, title, description, created_at)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,NOW())
-        """,
-            (
-                g.user_id,
-                rel_path,
-                rel_path,
-                fs.mimetype,
-                size,
-                meta["width"],
-                meta["height"],
-                sha256,
-                meta["camera_make"],
-                meta["camera_model"],
-                meta["gps_lat"],
-                meta["gps_lng"],
-                meta["taken_at"].strftime("%Y-%m-%d %H:%M:%S") if meta["taken_at"] else None,
-                title,
-                desc,
-            ),
-        )
+        with FacetTracker(g.user_id) as facets:
+            # 入库 images，同时写入 path / stored_path
+            image_id = execute(
+                """
+                INSERT INTO images
+                (owner_id, path, stored_path, mime_type, size_bytes, width, height, sha256,
+                 camera_make, camera_model, gps_lat, gps_lng, taken_at, title, description, created_at)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,NOW())
+            """,
+                (
+                    g.user_id,
+                    rel_path,
+                    rel_path,
+                    fs.mimetype,
+                    size,
+                    meta["width"],
+                    meta["height"],
+                    sha256,
+                    meta["camera_make"],
+                    meta["camera_model"],
+                    meta["gps_lat"],
+                    meta["gps_lng"],
+                    meta["taken_at"].strftime("%Y-%m-%d %H:%M:%S") if meta["taken_at"] else None,
+                    title,
+                    desc,
+                ),
+            )
 
-        # 写入 / 更新 exif 表（image_id 维度，一图一条）
-        extra_json = None
-        if meta.get("extra") is not None:
-            try:
-                extra_json = json.dumps(meta["extra"], ensure_ascii=False)
-            except TypeError:
-                extra_json = json.dumps(str(meta["extra"]), ensure_ascii=False)
+            # 写入 / 更新 exif 表（image_id 维度，一图一条）
+            extra_json = None
+            if meta.get("extra") is not None:
+                try:
+                    extra_json = json.dumps(meta["extra"], ensure_ascii=False)
+                except TypeError:
+                    extra_json = json.dumps(str(meta["extra"]), ensure_ascii=False)
 
-        execute(
-            """
-            INSERT INTO exif
-              (image_id, camera_make, camera_model,
-               f_number, exposure_time, iso, focal_length,
-               taken_at, gps_lat, gps_lng, extra)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-            ON DUPLICATE KEY UPDATE
-              camera_make=VALUES(camera_make),
-              camera_model=VALUES(camera_model),
-              f_number=VALUES(f_number),
-              exposure_time=VALUES(exposure_time),
-              iso=VALUES(iso),
-              focal_length=VALUES(focal_length),
-              taken_at=VALUES(taken_at),
-              gps_lat=VALUES(gps_lat),
-              gps_lng=VALUES(gps_lng),
-              extra=VALUES(extra)
-        """,
-            (
-                image_id,
-                meta.get("camera_make"),
-                meta.get("camera_model"),
-                meta.get("f_number"),
-                meta.get("exposure_time"),
-                meta.get("iso"),
-                meta.get("focal_length"),
-                meta.get("taken_at"),
-                meta.get("gps_lat"),
-                meta.get("gps_lng"),
-                extra_json,
-            ),
-        )
+            execute(
+                """
+                INSERT INTO exif
+                  (image_id, camera_make, camera_model,
+                   f_number, exposure_time, iso, focal_length,
+                   taken_at, gps_lat, gps_lng, extra)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                ON DUPLICATE KEY UPDATE
+                  camera_make=VALUES(camera_make),
+                  camera_model=VALUES(camera_model),
+                  f_number=VALUES(f_number),
+                  exposure_time=VALUES(exposure_time),
+                  iso=VALUES(iso),
+                  focal_length=VALUES(focal_length),
+                  taken_at=VALUES(taken_at),
+                  gps_lat=VALUES(gps_lat),
+                  gps_lng=VALUES(gps_lng),
+                  extra=VALUES(extra)
+            """,
+                (
+                    image_id,
+                    meta.get("camera_make"),
+                    meta.get("camera_model"),
+                    meta.get("f_number"),
+                    meta.get("exposure_time"),
+                    meta.get("iso"),
+                    meta.get("focal_length"),
+                    meta.get("taken_at"),
+                    meta.get("gps_lat"),
+                    meta.get("gps_lng"),
+                    extra_json,
+                ),
+            )
+
+            _store_features(image_id, features)
+
+            facets.after([image_id])
 
         # 处理标签（用户标签 + 自动标签），写入 tags / image_tags
         all_names = list(dict.fromkeys([*(user_tags or []), *meta["auto_tags"]]))  # 去重保序
@@ -759,7 +605,10 @@ def upload():
                 [(image_id, tid) for tid in tag_ids],
             )
 
-        saved.append({"image_id": image_id, "url": f"/files/{rel_path}"})
+        item = {"image_id": image_id, "url": f"/files/{rel_path}"}
+        if similar:
+            item["near_duplicates"] = similar
+        saved.append(item)
 
     return jsonify({"ok": True, "saved": saved})
 
@@ -834,37 +683,22 @@ def list_images():
 
 @bp.get("/api/images/stats")
 @jwt_required()
+@cache_owner_response("stats")
 def image_stats():
     g.user_id = _current_user_id_from_jwt()
     try:
-        rows = query(
-            """
-            SELECT COUNT(*) AS total,
-                   SUM(CASE WHEN DATE(created_at)=CURDATE() THEN 1 ELSE 0 END) AS today
-            FROM images
-            WHERE owner_id=%s
-            """,
-            (g.user_id,),
-        )
-        row = rows[0] if rows else {}
-        total = int(row.get("total") or 0)
-        today = int(row.get("today") or 0)
+        total, today = read_stats(g.user_id)
         return jsonify({"total": total, "today": today})
     except Exception as exc:
         return jsonify({"error": "统计失败", "detail": str(exc)}), 500
 
 
-@bp.get("/api/images/search")
-@jwt_required()
-def search_images():
-    """高阶搜索：名称/描述模糊 + EXIF + 文件大小 + 多标签交集"""
-    g.user_id = _current_user_id_from_jwt()
-    args = request.args
-    limit = int(args.get("limit", 50))
-    offset = int(args.get("offset", 0))
-    if limit > 200:
-        limit = 200
-
+def _search_sql(args, owner_id) -> Tuple[str, List, List[str]]:
+    """
+    按搜索参数拼出 SELECT（不含 LIMIT），返回 (sql, params, device 过滤值)。
+    device 由 classify_device 在 Python 侧判断，需要调用方对结果再过滤。
+    搜索接口与按筛选条件导出共用这一份逻辑。
+    """
     q = (args.get("q") or "").strip()
     date_start = (args.get("date_start") or "").strip()
     date_end = (args.get("date_end") or "").strip()
@@ -889,7 +723,7 @@ def search_images():
     tag_params = [t for t in tag_params if t]
 
     conditions = ["i.owner_id=%s"]
-    params = [g.user_id]
+    params = [owner_id]
     score_expr = "0"
     score_params: List = []
     joins = ["LEFT JOIN exif e ON e.image_id = i.id"]
@@ -898,9 +732,8 @@ def search_images():
 
     # 名称 / 描述模糊：短语优先，其次分词，单字仅在无更好词时参与
     if q:
-        phrase = q.strip()
-        strong_tokens, weak_tokens = _segment_query_tokens(phrase)
-        token_terms = strong_tokens if strong_tokens else weak_tokens
+        # 分词与权重来自 query_analysis 的缓存，热门查询不再重复分词
+        analysis = analyze_query(q)
         q_terms = []
         q_params: List = []
         score_parts = []
@@ -917,19 +750,14 @@ def search_images():
         def _add_term(term_value: str, weight: int):
             term_sql = _text_match_sql()
             like = f"%{term_value}%"
-            term_params = [like, like, g.user_id, like]
+            term_params = [like, like, owner_id, like]
             q_terms.append(term_sql)
             q_params.extend(term_params)
             score_parts.append(f"CASE WHEN {term_sql} THEN {weight} ELSE 0 END")
             score_params.extend(term_params)
 
-        if phrase:
-            _add_term(phrase, 10)
-        for token in token_terms:
-            if not token or token == phrase:
-                continue
-            weight = 4 if len(token) > 1 else 1
-            _add_term(token, weight)
+        for term_value, weight in analysis.search_terms:
+            _add_term(term_value, weight)
 
         if q_terms:
             conditions.append("(" + " OR ".join(q_terms) + ")")
@@ -1002,7 +830,7 @@ def search_images():
         joins.append("JOIN image_tags it ON it.image_id = i.id")
         joins.append("JOIN tags t ON t.id = it.tag_id")
         conditions.append("t.owner_id=%s")
-        params.append(g.user_id)
+        params.append(owner_id)
         placeholders = ",".join(["%s"] * len(tag_params))
         conditions.append(f"t.name IN ({placeholders})")
         params.extend(tag_params)
@@ -1031,11 +859,24 @@ def search_images():
         {group_by}
         {having}
         ORDER BY score DESC, sort_time DESC
-        LIMIT %s OFFSET %s
     """
-    params.extend([limit, offset])
+    return sql, score_params + params, device_params
+
+
+@bp.get("/api/images/search")
+@jwt_required()
+@cache_owner_response("search")
+def search_images():
+    """高阶搜索：名称/描述模糊 + EXIF + 文件大小 + 多标签交集"""
+    g.user_id = _current_user_id_from_jwt()
+    args = request.args
+    limit = int(args.get("limit", 50))
+    offset = int(args.get("offset", 0))
+    if limit > 200:
+        limit = 200
 
-    rows = query(sql, score_params + params)
+    sql, params, device_params = _search_sql(args, g.user_id)
+    rows = query(sql + " LIMIT %s OFFSET %s", [*params, limit, offset])
     if not rows:
         return jsonify({"items": []})
 
@@ -1083,6 +924,7 @@ def search_images():
 # ===== #advise 热门标签（含标签名/图片标题模糊）=====
 @bp.get("/api/tags/popular")
 @jwt_required()
+@cache_owner_response("popular_tags")
 def popular_tags():
     g.user_id = _current_user_id_from_jwt()
     kw = (request.args.get("q") or "").strip()
@@ -1110,6 +952,7 @@ def popular_tags():
 # ===== AI 推荐标签采纳 =====
 @bp.post("/api/images/<int:image_id>/tags/accept_suggestions")
 @jwt_required()
+@invalidates_owner_cache
 def accept_suggested_tags(image_id: int):
     """将 AI 推荐标签写入现有 tags / image_tags 表。"""
     g.user_id = _current_user_id_from_jwt()
@@ -1150,6 +993,7 @@ def accept_suggested_tags(image_id: int):
 # ===== #advise 批量删除与批量加标签（仅操作数据，不改表结构）=====
 @bp.post("/api/images/batch/delete")
 @jwt_required()
+@invalidates_owner_cache
 def batch_delete_images():
     g.user_id = _current_user_id_from_jwt()
     data = request.get_json(silent=True) or {}
@@ -1161,23 +1005,16 @@ def batch_delete_images():
     if not ids:
         return jsonify({"error": "缺少 image_ids"}), 400
 
-    placeholders = ",".join(["%s"] * len(ids))
-    valid_rows = query(
-        f"SELECT id FROM images WHERE owner_id=%s AND id IN ({placeholders})",
-        [g.user_id, *ids],
-    )
-    if not valid_rows:
-        return jsonify({"ok": True, "deleted": 0})
-
-    deleted = 0
-    for r in valid_rows:
-        execute("DELETE FROM images WHERE owner_id=%s AND id=%s", (g.user_id, r["id"]))
-        deleted += 1
-    return jsonify({"ok": True, "deleted": deleted})
+    # 按块整批删除；文件登记到回收队列，由后台线程按引用情况删除
+    with FacetTracker(g.user_id) as facets:
+        facets.before(ids)
+        deleted = delete_images(g.user_id, ids)
+    return jsonify({"ok": True, "deleted": len(deleted)})
 
 
 @bp.post("/api/images/batch/add_tags")
 @jwt_required()
+@invalidates_owner_cache
 def batch_add_tags():
     g.user_id = _current_user_id_from_jwt()
     data = request.get_json(silent=True) or {}
@@ -1221,26 +1058,58 @@ def batch_add_tags():
 # ===== #advise 单图删除与批量下载 =====
 @bp.delete("/api/images/<int:image_id>")
 @jwt_required()
+@invalidates_owner_cache
 def delete_image(image_id: int):
     g.user_id = _current_user_id_from_jwt()
-    rows = query("SELECT id, stored_path, path FROM images WHERE id=%s AND owner_id=%s LIMIT 1", (image_id, g.user_id))
-    if not rows:
-        return jsonify({"error": "图片不存在或无权限"}), 404
-    rel_path = (rows[0].get("stored_path") or rows[0].get("path") or "").strip()
+    with FacetTracker(g.user_id) as facets:
+        facets.before([image_id])
+        # 物理文件由后台回收线程删除，不阻塞请求
+        if not delete_images(g.user_id, [image_id]):
+            return jsonify({"error": "图片不存在或无权限"}), 404
 
-    execute("DELETE FROM images WHERE id=%s AND owner_id=%s", (image_id, g.user_id))
+    return jsonify({"ok": True, "deleted": image_id})
 
-    # 删除物理文件（存在则删除，不阻塞主流程）
-    if rel_path:
-        abs_root = os.path.abspath(current_app.config["UPLOAD_DIR"])
-        abs_path = os.path.join(abs_root, rel_path)
-        try:
-            if os.path.exists(abs_path):
-                os.remove(abs_path)
-        except Exception:
-            pass
 
-    return jsonify({"ok": True, "deleted": image_id})
+def _archive_files(rows, root: str) -> List[Tuple[str, str]]:
+    """图片记录 -> (绝对路径, 归档内文件名)；文件名加 id 前缀避免重名。"""
+    files = []
+    for r in rows:
+        rel = (r.get("stored_path") or r.get("path") or "").strip()
+        if not rel:
+            continue
+        base = os.path.basename(rel) or f"image_{r['id']}"
+        files.append((os.path.join(root, rel), f"{r['id']}_{base}"))
+    return files
+
+
+def _download_files(owner_id, ids: List[int], root: str) -> Iterator[Tuple[str, str]]:
+    # 按块查询、逐块产出，导出任务在块之间刷新心跳
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ",".join(["%s"] * len(chunk))
+        rows = query(
+            f"""
+            SELECT id, title, stored_path, path
+            FROM images
+            WHERE owner_id=%s AND id IN ({placeholders})
+            """,
+            [owner_id, *chunk],
+        )
+        yield from _archive_files(rows, root)
+
+
+def _filter_files(owner_id, filters: Dict, root: str) -> List[Tuple[str, str]]:
+    """按搜索条件（与 /api/images/search 的参数相同）取全部匹配图片，不分页。"""
+    args = MultiDict()
+    for key, value in (filters or {}).items():
+        for v in value if isinstance(value, (list, tuple)) else [value]:
+            if v is not None and str(v) != "":
+                args.add(key, str(v))
+    sql, params, device_params = _search_sql(args, owner_id)
+    rows = query(sql, params)
+    if device_params:
+        rows = [r for r in rows if classify_device(r.get("camera_make"), r.get("camera_model")) in device_params]
+    return _archive_files(rows, root)
 
 
 @bp.post("/api/images/batch/download")
@@ -1257,42 +1126,197 @@ def batch_download_images():
     if not ids:
         return jsonify({"error": "缺少 image_ids"}), 400
 
-    placeholders = ",".join(["%s"] * len(ids))
-    rows = query(
-        f"""
-        SELECT id, title, stored_path, path
-        FROM images
-        WHERE owner_id=%s AND id IN ({placeholders})
-        """,
-        [g.user_id, *ids],
-    )
-    if not rows:
+    root = os.path.abspath(current_app.config["UPLOAD_DIR"])
+    entries = []
+    for abs_path, arcname in _download_files(g.user_id, ids, root):
+        entry = make_entry(abs_path, arcname)
+        if entry is not None:
+            entries.append(entry)
+    if not entries:
         return jsonify({"error": "没有可下载的图片"}), 400
 
-    buf = BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        root = os.path.abspath(current_app.config["UPLOAD_DIR"])
-        for r in rows:
-            rel = (r.get("stored_path") or r.get("path") or "").strip()
-            if not rel:
-                continue
-            abs_path = os.path.join(root, rel)
-            if not os.path.exists(abs_path):
-                continue
-            base = os.path.basename(rel) or f"image_{r['id']}"
-            # 使用 id 前缀避免重名
-            arcname = f"{r['id']}_{base}"
-            try:
-                zf.write(abs_path, arcname=arcname)
-            except Exception:
-                continue
-    buf.seek(0)
-    return send_file(
-        buf,
+    # 边读边写出 ZIP：已压缩格式不再 deflate，内存占用与打包数量无关
+    headers = {
+        "Content-Disposition": 'attachment; filename="private-picture-shop.zip"',
+        "X-Accel-Buffering": "no",  # 让 Nginx 直接转发，不先缓冲整个文件
+    }
+    total = archive_size(entries)
+    if total is not None:
+        headers["Content-Length"] = str(total)
+    return Response(stream_zip(entries), mimetype="application/zip", headers=headers, direct_passthrough=True)
+
+
+# ===== 异步导出：后台打包成临时 ZIP，完成后支持断点续传下载 =====
+@bp.post("/api/images/export")
+@jwt_required()
+def create_export():
+    """
+    创建导出任务，三选一：
+      {"image_ids": [...]}              指定图片
+      {"filter": {"q": ..., "tags": [...], ...}}   搜索条件（参数同 /api/images/search），导出全部匹配结果
+      {"all": true}                     整个图库
+    """
+    g.user_id = _current_user_id_from_jwt()
+    data = request.get_json(silent=True) or {}
+    root = os.path.abspath(current_app.config["UPLOAD_DIR"])
+    owner_id = g.user_id
+    if data.get("image_ids"):
+        ids = [int(x) for x in data["image_ids"] if str(x).isdigit()]
+        if not ids:
+            return jsonify({"error": "image_ids 无效"}), 400
+        resolve = partial(_download_files, owner_id, ids, root)
+        description = f"{len(ids)} 张图片"
+    elif isinstance(data.get("filter"), dict) or data.get("all"):
+        filters = data.get("filter") if isinstance(data.get("filter"), dict) else {}
+        resolve = partial(_filter_files, owner_id, filters, root)
+        description = "搜索结果" if filters else "全部图片"
+    else:
+        return jsonify({"error": "缺少 image_ids / filter / all"}), 400
+
+    try:
+        job = submit_export(owner_id, resolve, description)
+    except ExportLimitExceeded:
+        return jsonify({"error": "已有导出任务在进行中，请稍后再试"}), 429
+    return jsonify(job_payload(job)), 202
+
+
+@bp.get("/api/images/export/<job_id>")
+@jwt_required()
+def export_status(job_id: str):
+    g.user_id = _current_user_id_from_jwt()
+    sweep_expired()
+    job = get_job(job_id, g.user_id)
+    if job is None:
+        return jsonify({"error": "导出任务不存在或已过期"}), 404
+    return jsonify(job_payload(job))
+
+
+@bp.get("/api/images/export/<job_id>/download")
+@jwt_required()
+def export_download(job_id: str):
+    """发送打包好的归档；conditional=True 时支持 Range / If-Range，下载中断后可续传。"""
+    g.user_id = _current_user_id_from_jwt()
+    job = get_job(job_id, g.user_id)
+    if job is None:
+        return jsonify({"error": "导出任务不存在或已过期"}), 404
+    if job["status"] != "done":
+        return jsonify({"error": "导出尚未完成", "status": job["status"]}), 409
+    path = archive_path(job_id)
+    if not path or not os.path.exists(path):
+        return jsonify({"error": "导出文件已被清理"}), 410
+    resp = send_file(
+        path,
         mimetype="application/zip",
         as_attachment=True,
-        download_name="private-picture-shop.zip",
+        download_name=f"private-picture-shop-{job_id[:8]}.zip",
+        conditional=True,
+        etag=job_id,
+        max_age=0,
+    )
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@bp.delete("/api/images/export/<job_id>")
+@jwt_required()
+def delete_export(job_id: str):
+    g.user_id = _current_user_id_from_jwt()
+    if not cancel_job(job_id, g.user_id):
+        return jsonify({"error": "导出任务不存在或已过期"}), 404
+    return jsonify({"ok": True})
+
+
+# 按颜色检索：colors=blue:0.7,white:0.3 或 #3366ff，也可以 q=蓝天白云 从文字里找颜色词（见 color_index.py）
+@bp.get("/api/images/search/color")
+@jwt_required()
+def search_images_by_color():
+    from server.color_index import search_by_color
+    from server.utils.color_signature import colors_in_text, parse_color, target_histogram
+
+    g.user_id = _current_user_id_from_jwt()
+    limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    min_score = float(request.args.get("min_score", 0.1))
+
+    colors = []
+    for part in filter(None, (request.args.get("colors") or "").split(",")):
+        name, _, weight = part.partition(":")
+        rgb = parse_color(name)
+        if rgb is None:
+            return jsonify({"error": f"无法识别的颜色: {name}"}), 400
+        try:
+            colors.append((rgb, float(weight) if weight else 1.0))
+        except ValueError:
+            return jsonify({"error": f"颜色权重无效: {part}"}), 400
+    if not colors:
+        colors = [(rgb, 1.0) for rgb in colors_in_text(request.args.get("q") or "")]
+    if not colors:
+        return jsonify({"error": "请指定颜色"}), 400
+
+    target = target_histogram(colors)
+    hits = search_by_color(g.user_id, target, limit=limit, min_score=min_score)
+    if not hits:
+        return jsonify({"items": []})
+    ids = [h["image_id"] for h in hits]
+    rows = query(
+        "SELECT id, title, stored_path FROM images WHERE owner_id=%s AND id IN ({})".format(",".join(["%s"] * len(ids))),
+        [g.user_id, *ids],
+    )
+    by_id = {r["id"]: r for r in rows}
+    items = [
+        {
+            "id": h["image_id"],
+            "title": by_id[h["image_id"]]["title"] or "未命名",
+            "url": f"/files/{by_id[h['image_id']]['stored_path']}",
+            "score": h["score"],
+            "palette": h["palette"],
+        }
+        for h in hits
+        if h["image_id"] in by_id
+    ]
+    return jsonify({"items": items})
+
+
+# 相似图片：按感知哈希汉明距离（见 similar_index.py）
+@bp.get("/api/images/<int:image_id>/similar")
+@jwt_required()
+def similar_images(image_id: int):
+    from server.similar_index import find_similar, image_hashes_for
+
+    g.user_id = _current_user_id_from_jwt()
+    radius = max(0, min(int(request.args.get("radius", 10)), 32))
+    limit = max(1, min(int(request.args.get("limit", 20)), 200))
+    row = query(
+        "SELECT id, stored_path, path FROM images WHERE id=%s AND owner_id=%s LIMIT 1",
+        (image_id, g.user_id or 0),
+    )
+    if not row:
+        return jsonify({"error": "图片不存在"}), 404
+    abs_path = _safe_abs_path((row[0].get("stored_path") or row[0].get("path") or "").strip(), _get_upload_root())
+    phash, dhash = image_hashes_for(image_id, g.user_id, abs_path)
+    if phash is None:
+        return jsonify({"error": "无法计算该图片的感知哈希"}), 422
+
+    hits = find_similar(g.user_id, phash, dhash, radius=radius, limit=limit, exclude_id=image_id)
+    if not hits:
+        return jsonify({"items": [], "radius": radius})
+    ids = [h["image_id"] for h in hits]
+    rows = query(
+        "SELECT id, title, stored_path FROM images WHERE owner_id=%s AND id IN ({})".format(",".join(["%s"] * len(ids))),
+        [g.user_id, *ids],
     )
+    by_id = {r["id"]: r for r in rows}
+    items = [
+        {
+            "id": h["image_id"],
+            "title": by_id[h["image_id"]]["title"] or "未命名",
+            "url": f"/files/{by_id[h['image_id']]['stored_path']}",
+            "distance": h["distance"],
+            "dhash_distance": h["dhash_distance"],
+        }
+        for h in hits
+        if h["image_id"] in by_id
+    ]
+    return jsonify({"items": items, "radius": radius})
 
 
 # 详细信息：基础信息/EXIF/标签/派生关系
@@ -1441,6 +1465,7 @@ def image_detail(image_id: int):
 
 @bp.put("/api/images/<int:image_id>")
 @jwt_required()
+@invalidates_owner_cache
 def update_image_meta(image_id: int):
     g.user_id = _current_user_id_from_jwt()
     data = request.get_json(silent=True) or {}
@@ -1553,221 +1578,56 @@ def image_ai_tags(image_id: int):
     return jsonify({"tags": tags})
 
 
-# 简易图像处理：裁剪、旋转、亮度/对比度/饱和度/色温/锐化/缩放
-def _to_float(val):
-    try:
-        return float(val)
-    except Exception:
+def _session_geometry_ops(session: EditSession) -> Optional[List[Tuple[str, object]]]:
+    """会话历史（到当前 idx 为止）是否全部为无损几何操作。"""
+    if len(session.ops) != len(session.versions):
         return None
+    return history_geometry_ops(session.ops, session.idx)
 
 
-def _to_int(val):
-    try:
-        return int(val)
-    except Exception:
+def _safe_abs_path(rel_path: str, upload_root: str) -> Optional[str]:
+    if not rel_path:
         return None
+    base_root = os.path.abspath(upload_root)
+    abs_path = os.path.abspath(os.path.join(upload_root, rel_path))
+    if os.path.commonpath([abs_path, base_root]) != base_root:
+        return None
+    return abs_path
 
 
-def _to_bool(val) -> bool:
-    if isinstance(val, bool):
-        return val
-    if isinstance(val, (int, float)):
-        return bool(val)
-    if isinstance(val, str):
-        return val.strip().lower() in ("1", "true", "yes", "y", "on")
-    return False
-
+def _staging_path(dir_abs: str, ext: str) -> str:
+    """在目标目录下创建临时文件，写完后 os.replace 到最终位置（同一文件系统，替换是原子的）。"""
+    os.makedirs(dir_abs, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=".edit_", suffix=ext, dir=dir_abs)
+    os.close(fd)
+    return path
 
-def apply_rotate(img: Image.Image, params: dict) -> Image.Image:
-    deg_f = _to_float(params.get("deg")) if "deg" in params else _to_float(params.get("rotate"))
-    deg_f = deg_f or 0
-    if deg_f % 360 != 0:
-        fill_rgb = (245, 247, 250)
-        try:
-            img = img.rotate(-deg_f, expand=True, fillcolor=fill_rgb)
-        except TypeError:
-            rotated = img.convert("RGBA").rotate(-deg_f, expand=True)
-            background = Image.new("RGBA", rotated.size, fill_rgb + (255,))
-            background.paste(rotated, (0, 0), rotated)
-            img = background.convert("RGB")
-    return img
-
-
-def apply_crop(img: Image.Image, params: dict) -> Image.Image:
-    crop_rect = params.get("crop_rect") or params.get("cropRect") or {}
-    if not isinstance(crop_rect, dict):
-        return img
-    if not any(k in crop_rect for k in ("x", "y", "w", "h", "width", "height")):
-        return img
-    try:
-        x = _to_float(crop_rect.get("x")) or 0
-        y = _to_float(crop_rect.get("y")) or 0
-        w = _to_float(crop_rect.get("w"))
-        h = _to_float(crop_rect.get("h"))
-        if w is None:
-            w = _to_float(crop_rect.get("width"))
-        if h is None:
-            h = _to_float(crop_rect.get("height"))
-        if not w or not h:
-            return img
-        x2 = min(img.width, x + w)
-        y2 = min(img.height, y + h)
-        x = max(0, x)
-        y = max(0, y)
-        if x2 > x and y2 > y:
-            img = img.crop((x, y, x2, y2))
-    except Exception:
-        pass  # 裁剪异常时忽略
-    return img
+
+def _file_digests(abs_path: str) -> Tuple[str, str, int]:
+    """分块计算 (sha256, md5, 大小)，不把整个文件读进内存。"""
+    sha = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    with open(abs_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), md5.hexdigest(), size
 
 
-def apply_adjust(img: Image.Image, params: dict) -> Image.Image:
-    def _factor(val):
+def _discard_file(abs_path: Optional[str]) -> None:
+    if abs_path and os.path.exists(abs_path):
         try:
-            return 1 + float(val) / 100
+            os.remove(abs_path)
         except Exception:
-            return 1
-
-    b = _factor(params.get("brightness", 0))
-    c = _factor(params.get("contrast", 0))
-    s = _factor(params.get("saturation", 0))
-    if b != 1:
-        img = ImageEnhance.Brightness(img).enhance(b)
-    if c != 1:
-        img = ImageEnhance.Contrast(img).enhance(c)
-    if s != 1:
-        img = ImageEnhance.Color(img).enhance(s)
-
-    warm_v = _to_float(params.get("temperature"))
-    if warm_v is None:
-        warm_v = _to_float(params.get("warmth"))
-    warm_v = warm_v or 0
-    if warm_v != 0 and img.mode == "RGB":
-        warm_v = max(-100.0, min(100.0, warm_v))
-        strength = abs(warm_v) / 100.0
-        boost = 1 + strength * 0.6
-        reduce = 1 - strength * 0.3
-        r_gain = boost if warm_v > 0 else reduce
-        b_gain = boost if warm_v < 0 else reduce
-        r, g_, b_ = img.split()
-        r = r.point(lambda v: max(0, min(255, int(v * r_gain))))
-        b_ = b_.point(lambda v: max(0, min(255, int(v * b_gain))))
-        img = Image.merge("RGB", (r, g_, b_))
-
-    sharp_v = _to_float(params.get("sharpness"))
-    if sharp_v is None:
-        sharp_v = _to_float(params.get("sharpen"))
-    sharp_v = sharp_v or 0
-    if sharp_v > 0:
-        sharp_v = max(0.0, min(100.0, sharp_v))
-        scale = sharp_v / 100.0
-        radius = 1.2 + scale * 1.3
-        percent = int(100 + scale * 300)
-        img = img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=3))
-    return img
-
-
-def apply_scale(img: Image.Image, params: dict) -> Image.Image:
-    # 缩放使用 LANCZOS 重采样，保证像素级缩放质量
-    resample = Image.Resampling.LANCZOS if hasattr(Image, "Resampling") else Image.LANCZOS
-    factor = _to_float(params.get("factor") or params.get("scale"))
-    tw = _to_int(params.get("target_width") or params.get("width"))
-    th = _to_int(params.get("target_height") or params.get("height"))
-    keep_ratio = _to_bool(params.get("keep_ratio") or params.get("keepRatio"))
-    resize_mode = (params.get("resize_mode") or params.get("resizeMode") or "").strip().lower()
-    ratio_w = _to_float(params.get("ratio_width") or params.get("ratioWidth"))
-    ratio_h = _to_float(params.get("ratio_height") or params.get("ratioHeight"))
-
-    if (tw is None and th is None) and factor:
-        factor = max(0.05, min(8.0, factor))
-        tw = int(round(img.width * factor))
-        th = int(round(img.height * factor))
-
-    if tw is not None and tw <= 0:
-        tw = None
-    if th is not None and th <= 0:
-        th = None
-
-    if not (tw or th):
-        return img
-
-    orig_w, orig_h = img.size
-    if keep_ratio:
-        if ratio_w and ratio_h and ratio_h != 0:
-            if tw and not th:
-                th = int(round(tw * (ratio_h / ratio_w)))
-            elif th and not tw:
-                tw = int(round(th * (ratio_w / ratio_h)))
-            elif tw and th:
-                th = int(round(tw * (ratio_h / ratio_w)))
-            else:
-                tw = orig_w
-                th = int(round(orig_w * (ratio_h / ratio_w)))
-        else:
-            if tw and not th:
-                th = int(round(tw * (orig_h / orig_w)))
-            elif th and not tw:
-                tw = int(round(th * (orig_w / orig_h)))
-    else:
-        if tw and not th:
-            th = orig_h
-        elif th and not tw:
-            tw = orig_w
-
-    tw = max(1, int(tw)) if tw else None
-    th = max(1, int(th)) if th else None
-    if not (tw and th):
-        return img
-    try:
-        if not resize_mode:
-            resize_mode = "pad" if keep_ratio else "stretch"
-        if resize_mode in ("fit", "contain"):
-            resize_mode = "pad" if keep_ratio else "stretch"
-        if resize_mode not in ("stretch", "pad"):
-            resize_mode = "pad" if keep_ratio else "stretch"
-        if resize_mode == "pad":
-            img = ImageOps.pad(img, (tw, th), method=resample, color="white")
-        else:
-            img = img.resize((tw, th), resample=resample)
-    except Exception:
-        pass  # 缩放异常时保持原图
-    return img
-
-
-def _apply_edits(img: Image.Image, params: dict) -> Image.Image:
-    img = apply_rotate(img, params)
-    img = apply_crop(img, params)
-    img = apply_adjust(img, params)
-    img = apply_scale(img, params)
-    return img
-
-
-def _flatten_for_save(img: Image.Image) -> Image.Image:
-    if img.mode in ("RGBA", "LA"):
-        bg = Image.new("RGB", img.size, (255, 255, 255))
-        bg.paste(img, mask=img.split()[-1])
-        return bg
-    if img.mode != "RGB":
-        return img.convert("RGB")
-    return img
-
-
-def _safe_abs_path(rel_path: str, upload_root: str) -> Optional[str]:
-    if not rel_path:
-        return None
-    base_root = os.path.abspath(upload_root)
-    abs_path = os.path.abspath(os.path.join(upload_root, rel_path))
-    if os.path.commonpath([abs_path, base_root]) != base_root:
-        return None
-    return abs_path
+            pass
 
 
 @bp.post("/api/images/<int:image_id>/edit/session")
 @jwt_required()
 def create_edit_session(image_id: int):
     g.user_id = _current_user_id_from_jwt()
-    _bootstrap_edit_sessions()
-    cleanup_old_sessions()
     row = query(
         "SELECT id,owner_id,stored_path,path FROM images WHERE id=%s AND owner_id=%s LIMIT 1",
         (image_id, g.user_id or 0),
@@ -1810,10 +1670,9 @@ def create_edit_session(image_id: int):
         idx=0,
         created_at=now,
         updated_at=now,
+        ops=[None],
     )
-    with EDIT_SESSIONS_LOCK:
-        EDIT_SESSIONS[session_id] = session
-    _persist_session(session, upload_root)
+    get_session_store(upload_root).add(session)
     return jsonify(_session_payload(session))
 
 
@@ -1865,28 +1724,30 @@ def apply_edit_session(session_id: str):
         return jsonify({"error": "不支持的编辑操作"}), 400
 
     upload_root = _get_upload_root()
-    with session.lock:
+    with _session_store().locked(session):
         current_rel = session.versions[session.idx]
         abs_in = _session_abs_path(current_rel, upload_root)
         if not os.path.exists(abs_in):
             return jsonify({"error": "会话文件不存在"}), 404
+        next_idx = session.idx + 1
+        session_dir = os.path.join(upload_root, "edit_sessions", session_id)
         try:
-            with Image.open(abs_in) as img:
-                img = img.convert("RGB")
-                if op == "crop":
-                    img = apply_crop(img, params)
-                elif op == "scale":
-                    img = apply_scale(img, params)
-                elif op == "rotate":
-                    img = apply_rotate(img, params)
-                else:
-                    img = apply_adjust(img, params)
+            # 解码、编辑与写出新版本都在进程池里完成（见 server/image_executor.py）
+            filename = run_image_job(session_step_job, abs_in, op, params, session_dir, f"v{next_idx:03d}")
+        except ImageJobTimeout:
+            return jsonify({"error": "编辑超时，请稍后重试"}), 504
+        except ImageTooLarge as exc:
+            return jsonify({"error": str(exc)}), 413
         except Exception as exc:
             return jsonify({"error": f"编辑失败: {exc}"}), 500
+        rel_out = _session_rel_path(session_id, filename)
 
         if session.idx < len(session.versions) - 1:
             stale = session.versions[session.idx + 1 :]
             for rel in stale:
+                if rel == rel_out:
+                    # 新版本可能与被丢弃的重做版本同名，文件已被覆盖，不能删除
+                    continue
                 abs_path = _session_abs_path(rel, upload_root)
                 if os.path.exists(abs_path):
                     try:
@@ -1894,16 +1755,11 @@ def apply_edit_session(session_id: str):
                     except Exception:
                         pass
             session.versions = session.versions[: session.idx + 1]
+            session.ops = session.ops[: session.idx + 1]
 
-        next_idx = session.idx + 1
-        filename = f"v{next_idx:03d}.png"
-        rel_out = _session_rel_path(session_id, filename)
-        abs_out = _session_abs_path(rel_out, upload_root)
-        try:
-            img.save(abs_out, format="PNG")
-        except Exception as exc:
-            return jsonify({"error": f"保存版本失败: {exc}"}), 500
         session.versions.append(rel_out)
+        if len(session.ops) == next_idx:
+            session.ops.append({"op": op, "params": params})
         session.idx = next_idx
         session.updated_at = datetime.utcnow()
         _persist_session(session, upload_root)
@@ -1917,7 +1773,7 @@ def undo_edit_session(session_id: str):
     session = _get_session(session_id, g.user_id or 0)
     if not session:
         return jsonify({"error": "会话不存在或无权限"}), 404
-    with session.lock:
+    with _session_store().locked(session):
         if session.idx > 0:
             session.idx -= 1
             session.updated_at = datetime.utcnow()
@@ -1932,7 +1788,7 @@ def redo_edit_session(session_id: str):
     session = _get_session(session_id, g.user_id or 0)
     if not session:
         return jsonify({"error": "会话不存在或无权限"}), 404
-    with session.lock:
+    with _session_store().locked(session):
         if session.idx < len(session.versions) - 1:
             session.idx += 1
             session.updated_at = datetime.utcnow()
@@ -1942,6 +1798,7 @@ def redo_edit_session(session_id: str):
 
 @bp.post("/api/images/edit/session/<session_id>/commit")
 @jwt_required()
+@invalidates_owner_cache
 def commit_edit_session(session_id: str):
     g.user_id = _current_user_id_from_jwt()
     session = _get_session(session_id, g.user_id or 0)
@@ -1963,150 +1820,169 @@ def commit_edit_session(session_id: str):
         return jsonify({"error": "缺少导出名称"}), 400
 
     upload_root = _get_upload_root()
-    with session.lock:
+    with _session_store().locked(session):
         current_rel = session.versions[session.idx]
         abs_in = _session_abs_path(current_rel, upload_root)
         if not os.path.exists(abs_in):
             return jsonify({"error": "会话文件不存在"}), 404
-        try:
-            with Image.open(abs_in) as img:
-                img = _flatten_for_save(img)
-                orig_ext = session.ext or (os.path.splitext(session.orig_rel_path)[-1] or ".jpg")
-                orig_ext = orig_ext.lower() if orig_ext.startswith(".") else f".{orig_ext}"
-                if mode == "new":
-                    name_ext = os.path.splitext(export_name)[-1].lower()
-                    ext = name_ext if name_ext else orig_ext
-                else:
-                    ext = orig_ext
-                if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-                    ext = ".jpg"
-                fmt = "JPEG" if ext in [".jpg", ".jpeg"] else ext.replace(".", "").upper() or "PNG"
-                buf = BytesIO()
-                if fmt == "JPEG":
-                    img.save(buf, format=fmt, quality=92)
-                else:
-                    img.save(buf, format=fmt)
-                binary = buf.getvalue()
-        except Exception as exc:
-            return jsonify({"error": f"保存失败: {exc}"}), 500
-
-        sha256 = hashlib.sha256(binary).hexdigest()
-        size_bytes = len(binary)
+        orig_ext = session.ext or (os.path.splitext(session.orig_rel_path)[-1] or ".jpg")
+        orig_ext = orig_ext.lower() if orig_ext.startswith(".") else f".{orig_ext}"
+        if mode == "new":
+            name_ext = os.path.splitext(export_name)[-1].lower()
+            ext = name_ext if name_ext else orig_ext
+        else:
+            ext = orig_ext
+        if ext not in (".jpg", ".jpeg", ".png", ".webp"):
+            ext = ".jpg"
+        fmt = "JPEG" if ext in [".jpg", ".jpeg"] else ext.replace(".", "").upper() or "PNG"
 
         if mode == "override":
             rel_out = session.orig_rel_path
             abs_out = _safe_abs_path(rel_out, upload_root)
             if not abs_out:
                 return jsonify({"error": "原图路径异常"}), 400
+            out_dir = os.path.dirname(abs_out)
         else:
             subdir = f"{g.user_id}/{time.strftime('%Y%m')}"
-            os.makedirs(os.path.join(upload_root, subdir), exist_ok=True)
-            fname = f"{int(time.time()*1000)}_{hashlib.md5(binary).hexdigest()[:8]}{ext or '.png'}"
-            abs_out = os.path.join(upload_root, subdir, fname)
-            rel_out = f"{subdir}/{fname}"
+            out_dir = os.path.join(upload_root, subdir)
+        staged = _staging_path(out_dir, ext)
+
+        # 只有旋转/对齐裁剪时直接对原图做 DCT 域无损变换，避免二次 JPEG 压缩。
+        # 源文件用会话自己的 v000 快照：原图可能在会话期间被覆盖，会话里记录的绝对路径也可能因上传目录迁移失效；
+        # 快照缺失时走常规编码
+        binary = None
+        if fmt == "JPEG" and orig_ext in JPEG_EXTS:
+            geometry_ops = _session_geometry_ops(session)
+            snapshot = _session_abs_path(session.versions[0], upload_root)
+            if geometry_ops is not None and os.path.exists(snapshot):
+                binary = lossless_jpeg_transform(snapshot, geometry_ops)
+        try:
+            if binary is not None:
+                with open(staged, "wb") as f:
+                    f.write(binary)
+            else:
+                # 编码结果由子进程直接写入临时文件
+                run_image_job(encode_job, abs_in, fmt, staged)
+        except ImageJobTimeout:
+            _discard_file(staged)
+            return jsonify({"error": "保存超时，请稍后重试"}), 504
+        except ImageTooLarge as exc:
+            _discard_file(staged)
+            return jsonify({"error": str(exc)}), 413
+        except Exception as exc:
+            _discard_file(staged)
+            return jsonify({"error": f"保存失败: {exc}"}), 500
 
-        with open(abs_out, "wb") as f:
-            f.write(binary)
+        sha256, md5_hex, size_bytes = _file_digests(staged)
+        if mode != "override":
+            fname = f"{int(time.time()*1000)}_{md5_hex[:8]}{ext or '.png'}"
+            abs_out = os.path.join(out_dir, fname)
+            rel_out = f"{subdir}/{fname}"
+        os.replace(staged, abs_out)
 
         meta = extract_exif(abs_out)
         width = meta.get("width")
         height = meta.get("height")
         taken_at = meta.get("taken_at")
 
-        if mode == "override":
+        with FacetTracker(g.user_id) as facets:
+            if mode == "override":
+                facets.before([session.image_id])
+                execute(
+                    """
+                    UPDATE images
+                    SET stored_path=%s, path=%s, mime_type=%s,
+                        size_bytes=%s, width=%s, height=%s, sha256=%s,
+                        taken_at=%s, updated_at=NOW(), title=COALESCE(%s,title)
+                    WHERE id=%s AND owner_id=%s
+                    """,
+                    (
+                        rel_out,
+                        rel_out,
+                        f"image/{fmt.lower()}",
+                        size_bytes,
+                        width,
+                        height,
+                        sha256,
+                        taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
+                        export_name or None,
+                        session.image_id,
+                        g.user_id,
+                    ),
+                )
+                target_id = session.image_id
+            else:
+                target_id = execute(
+                    """
+                    INSERT INTO images
+                    (owner_id, parent_id, path, stored_path, mime_type, size_bytes, width, height, sha256,
+                     taken_at, title, description, created_at)
+                    SELECT owner_id, id, %s, %s, %s, %s, %s, %s, %s,
+                           %s, %s, description, NOW()
+                    FROM images WHERE id=%s AND owner_id=%s
+                    """,
+                    (
+                        rel_out,
+                        rel_out,
+                        f"image/{fmt.lower()}",
+                        size_bytes,
+                        width,
+                        height,
+                        sha256,
+                        taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
+                        export_name or (base.get("title") or ""),
+                        session.image_id,
+                        g.user_id,
+                    ),
+                )
+                tag_ids = query("SELECT tag_id FROM image_tags WHERE image_id=%s", (session.image_id,))
+                if tag_ids:
+                    executemany(
+                        "INSERT IGNORE INTO image_tags (image_id,tag_id) VALUES (%s,%s)",
+                        [(target_id, t["tag_id"]) for t in tag_ids],
+                    )
+
+            extra_json = None
+            if meta.get("extra") is not None:
+                try:
+                    extra_json = json.dumps(meta["extra"], ensure_ascii=False)
+                except TypeError:
+                    extra_json = json.dumps(str(meta["extra"]), ensure_ascii=False)
             execute(
                 """
-                UPDATE images
-                SET stored_path=%s, path=%s, mime_type=%s,
-                    size_bytes=%s, width=%s, height=%s, sha256=%s,
-                    taken_at=%s, updated_at=NOW(), title=COALESCE(%s,title)
-                WHERE id=%s AND owner_id=%s
-                """,
-                (
-                    rel_out,
-                    rel_out,
-                    f"image/{fmt.lower()}",
-                    size_bytes,
-                    width,
-                    height,
-                    sha256,
-                    taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
-                    export_name or None,
-                    session.image_id,
-                    g.user_id,
-                ),
-            )
-            target_id = session.image_id
-        else:
-            target_id = execute(
-                """
-                INSERT INTO images
-                (owner_id, parent_id, path, stored_path, mime_type, size_bytes, width, height, sha256,
-                 taken_at, title, description, created_at)
-                SELECT owner_id, id, %s, %s, %s, %s, %s, %s, %s,
-                       %s, %s, description, NOW()
-                FROM images WHERE id=%s AND owner_id=%s
+                INSERT INTO exif
+                  (image_id, camera_make, camera_model,
+                   f_number, exposure_time, iso, focal_length,
+                   taken_at, gps_lat, gps_lng, extra)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                ON DUPLICATE KEY UPDATE
+                  camera_make=VALUES(camera_make),
+                  camera_model=VALUES(camera_model),
+                  f_number=VALUES(f_number),
+                  exposure_time=VALUES(exposure_time),
+                  iso=VALUES(iso),
+                  focal_length=VALUES(focal_length),
+                  taken_at=VALUES(taken_at),
+                  gps_lat=VALUES(gps_lat),
+                  gps_lng=VALUES(gps_lng),
+                  extra=VALUES(extra)
                 """,
                 (
-                    rel_out,
-                    rel_out,
-                    f"image/{fmt.lower()}",
-                    size_bytes,
-                    width,
-                    height,
-                    sha256,
-                    taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
-                    export_name or (base.get("title") or ""),
-                    session.image_id,
-                    g.user_id,
+                    target_id,
+                    meta.get("camera_make"),
+                    meta.get("camera_model"),
+                    meta.get("f_number"),
+                    meta.get("exposure_time"),
+                    meta.get("iso"),
+                    meta.get("focal_length"),
+                    meta.get("taken_at"),
+                    meta.get("gps_lat"),
+                    meta.get("gps_lng"),
+                    extra_json,
                 ),
             )
-            tag_ids = query("SELECT tag_id FROM image_tags WHERE image_id=%s", (session.image_id,))
-            if tag_ids:
-                executemany(
-                    "INSERT IGNORE INTO image_tags (image_id,tag_id) VALUES (%s,%s)",
-                    [(target_id, t["tag_id"]) for t in tag_ids],
-                )
-
-        extra_json = None
-        if meta.get("extra") is not None:
-            try:
-                extra_json = json.dumps(meta["extra"], ensure_ascii=False)
-            except TypeError:
-                extra_json = json.dumps(str(meta["extra"]), ensure_ascii=False)
-        execute(
-            """
-            INSERT INTO exif
-              (image_id, camera_make, camera_model,
-               f_number, exposure_time, iso, focal_length,
-               taken_at, gps_lat, gps_lng, extra)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-            ON DUPLICATE KEY UPDATE
-              camera_make=VALUES(camera_make),
-              camera_model=VALUES(camera_model),
-              f_number=VALUES(f_number),
-              exposure_time=VALUES(exposure_time),
-              iso=VALUES(iso),
-              focal_length=VALUES(focal_length),
-              taken_at=VALUES(taken_at),
-              gps_lat=VALUES(gps_lat),
-              gps_lng=VALUES(gps_lng),
-              extra=VALUES(extra)
-            """,
-            (
-                target_id,
-                meta.get("camera_make"),
-                meta.get("camera_model"),
-                meta.get("f_number"),
-                meta.get("exposure_time"),
-                meta.get("iso"),
-                meta.get("focal_length"),
-                meta.get("taken_at"),
-                meta.get("gps_lat"),
-                meta.get("gps_lng"),
-                extra_json,
-            ),
-        )
+            facets.after([target_id])
+        _store_features(target_id, _file_features(abs_out))
 
     _discard_session(session_id, upload_root)
     resp = {"ok": True, "image_id": target_id, "path": rel_out, "url": f"/files/{rel_out}"}
@@ -2131,15 +2007,28 @@ def discard_edit_session(session_id: str):
     return jsonify({"ok": True})
 
 
-# 预览渲染接口：前端 POST /api/images/<id>/preview
+def _preview_params() -> dict:
+    """GET 从 ?params=<json> 读取编辑参数（可被浏览器缓存），POST 读取 JSON body。"""
+    if request.method == "GET":
+        try:
+            data = json.loads(request.args.get("params") or "{}")
+        except Exception:
+            data = {}
+    else:
+        data = request.get_json(silent=True) or {}
+    return data if isinstance(data, dict) else {}
+
+
+# 预览渲染接口：前端 GET/POST /api/images/<id>/preview
+@bp.get("/api/images/<int:image_id>/preview")
 @bp.post("/api/images/<int:image_id>/preview")
 @jwt_required()
 def preview_image(image_id: int):
     g.user_id = _current_user_id_from_jwt()
-    data = request.get_json(silent=True) or {}
+    data = _preview_params()
 
     base_rows = query(
-        "SELECT id,owner_id,stored_path,path FROM images WHERE id=%s AND owner_id=%s LIMIT 1",
+        "SELECT id,owner_id,stored_path,path,sha256 FROM images WHERE id=%s AND owner_id=%s LIMIT 1",
         (image_id, g.user_id or 0),
     )
     if not base_rows:
@@ -2154,24 +2043,57 @@ def preview_image(image_id: int):
     if not os.path.exists(abs_in):
         return jsonify({"error": "原图文件不存在"}), 404
 
+    # 缓存键：原图内容 + 归一化参数 + 输出规格；缺 sha256 的旧数据退回文件路径 + mtime + 大小
+    source_hash = (base.get("sha256") or "").strip()
+    if not source_hash:
+        st = os.stat(abs_in)
+        source_hash = hashlib.sha1(f"{rel_path}|{st.st_mtime_ns}|{st.st_size}".encode("utf-8")).hexdigest()
     try:
-        with Image.open(abs_in) as img:
-            img = img.convert("RGB")
-            edited = _apply_edits(img, data)
-            buf = BytesIO()
-            edited.save(buf, format="JPEG", quality=90)
-            buf.seek(0)
+        # 超出内存预算的大图按比例缩小渲染，缩放比例也是输出规格的一部分
+        scale = probe_preview_scale(abs_in)
+    except ImageTooLarge as e:
+        return jsonify({"error": str(e)}), 413
     except Exception as e:
         return jsonify({"error": f"预览生成失败: {e}"}), 500
-
-    resp = send_file(buf, mimetype="image/jpeg")
-    resp.headers["Cache-Control"] = "no-store"
+    variant = f"q{PREVIEW_QUALITY}" if scale >= 1.0 else f"q{PREVIEW_QUALITY}-s{scale:.4f}"
+    cache_key = preview_cache_key(source_hash, edit_params_hash(data), variant)
+    if request.if_none_match.contains(cache_key):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(cache_key)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
+    cache = get_preview_cache()
+    binary = cache.get(cache_key)
+    if binary is None:
+        try:
+            # 同一用户同一图片最多一个渲染 + 一个排队，拖动滑块时被覆盖的参数直接作废
+            binary = coalesce_image_job(
+                ("preview", g.user_id, image_id), preview_job, abs_in, data, quality=PREVIEW_QUALITY
+            )
+        except ImageJobCancelled:
+            return "", 204
+        except ImageJobTimeout:
+            return jsonify({"error": "预览生成超时"}), 504
+        except Exception as e:
+            return jsonify({"error": f"预览生成失败: {e}"}), 500
+        cache.put(cache_key, binary)
+
+    resp = send_file(BytesIO(binary), mimetype="image/jpeg")
+    # 内容由 ETag 唯一确定；原图被覆盖后 sha256 变化，浏览器重新验证即可拿到新结果
+    resp.set_etag(cache_key)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    header_scale = preview_header_scale(data, scale)
+    if header_scale < 1.0:
+        # 前端据此把预览尺寸换算回全尺寸渲染的坐标（裁剪框等仍以原图像素为单位）
+        resp.headers["X-Preview-Scale"] = f"{header_scale:.4f}"
     return resp
 
 
 # 裁剪/滤镜编辑接口：前端 POST /api/images/<id>/edit
 @bp.post("/api/images/<int:image_id>/edit")
 @jwt_required()
+@invalidates_owner_cache
 def edit_image(image_id: int):
     g.user_id = _current_user_id_from_jwt()
     data = request.get_json(silent=True) or {}
@@ -2194,133 +2116,148 @@ def edit_image(image_id: int):
     if not os.path.exists(abs_in):
         return jsonify({"error": "原图文件不存在"}), 404
 
-    try:
-        with Image.open(abs_in) as img:
-            img = img.convert("RGB")
-            edited = _apply_edits(img, data)
-            buf = BytesIO()
-            ext = (os.path.splitext(rel_path)[-1] or ".jpg").lower()
-            fmt = "JPEG" if ext in [".jpg", ".jpeg"] else ext.replace(".", "").upper() or "JPEG"
-            edited.save(buf, format=fmt, quality=92)
-            binary = buf.getvalue()
-    except Exception as e:
-        return jsonify({"error": f"处理图片失败: {e}"}), 500
-
-    sha256 = hashlib.sha256(binary).hexdigest()
-    size_bytes = len(binary)
-
+    ext = (os.path.splitext(rel_path)[-1] or ".jpg").lower()
+    fmt = "JPEG" if ext in [".jpg", ".jpeg"] else ext.replace(".", "").upper() or "JPEG"
     if mode == "override":
         abs_out = abs_in
         rel_out = rel_path
+        out_dir = os.path.dirname(abs_in)
     else:
         subdir = f"{g.user_id}/{time.strftime('%Y%m')}"
-        os.makedirs(os.path.join(abs_root, subdir), exist_ok=True)
-        fname = f"{int(time.time()*1000)}_{hashlib.md5(binary).hexdigest()[:8]}{ext or '.jpg'}"
-        abs_out = os.path.join(abs_root, subdir, fname)
-        rel_out = f"{subdir}/{fname}"
+        out_dir = os.path.join(abs_root, subdir)
+    staged = _staging_path(out_dir, ext)
+
+    binary = None
+    if fmt == "JPEG":
+        geometry_ops = geometry_only_ops(data)
+        if geometry_ops is not None:
+            binary = lossless_jpeg_transform(abs_in, geometry_ops)
+    try:
+        if binary is not None:
+            with open(staged, "wb") as f:
+                f.write(binary)
+        else:
+            run_image_job(edit_job, abs_in, data, fmt, staged)
+    except ImageJobTimeout:
+        _discard_file(staged)
+        return jsonify({"error": "处理图片超时，请稍后重试"}), 504
+    except ImageTooLarge as e:
+        _discard_file(staged)
+        return jsonify({"error": str(e)}), 413
+    except Exception as e:
+        _discard_file(staged)
+        return jsonify({"error": f"处理图片失败: {e}"}), 500
 
-    with open(abs_out, "wb") as f:
-        f.write(binary)
+    sha256, md5_hex, size_bytes = _file_digests(staged)
+    if mode != "override":
+        fname = f"{int(time.time()*1000)}_{md5_hex[:8]}{ext or '.jpg'}"
+        abs_out = os.path.join(out_dir, fname)
+        rel_out = f"{subdir}/{fname}"
+    os.replace(staged, abs_out)
 
     meta = extract_exif(abs_out)
     width = meta.get("width")
     height = meta.get("height")
     taken_at = meta.get("taken_at")
 
-    if mode == "override":
+    with FacetTracker(g.user_id) as facets:
+        if mode == "override":
+            facets.before([image_id])
+            execute(
+                """
+                UPDATE images
+                SET stored_path=%s, path=%s, mime_type=%s,
+                    size_bytes=%s, width=%s, height=%s, sha256=%s,
+                    taken_at=%s, updated_at=NOW(), title=COALESCE(%s,title)
+                WHERE id=%s AND owner_id=%s
+                """,
+                (
+                    rel_out,
+                    rel_out,
+                    f"image/{fmt.lower()}",
+                    size_bytes,
+                    width,
+                    height,
+                    sha256,
+                    taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
+                    export_name or None,
+                    image_id,
+                    g.user_id,
+                ),
+            )
+            target_id = image_id
+        else:
+            target_id = execute(
+                """
+                INSERT INTO images
+                (owner_id, parent_id, path, stored_path, mime_type, size_bytes, width, height, sha256,
+                 taken_at, title, description, created_at)
+                SELECT owner_id, id, %s, %s, %s, %s, %s, %s, %s,
+                       %s, %s, description, NOW()
+                FROM images WHERE id=%s AND owner_id=%s
+                """,
+                (
+                    rel_out,
+                    rel_out,
+                    f"image/{fmt.lower()}",
+                    size_bytes,
+                    width,
+                    height,
+                    sha256,
+                    taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
+                    export_name or (base.get("title") or ""),
+                    image_id,
+                    g.user_id,
+                ),
+            )
+            tag_ids = query("SELECT tag_id FROM image_tags WHERE image_id=%s", (image_id,))
+            if tag_ids:
+                executemany(
+                    "INSERT IGNORE INTO image_tags (image_id,tag_id) VALUES (%s,%s)",
+                    [(target_id, t["tag_id"]) for t in tag_ids],
+                )
+
+        extra_json = None
+        if meta.get("extra") is not None:
+            try:
+                extra_json = json.dumps(meta["extra"], ensure_ascii=False)
+            except TypeError:
+                extra_json = json.dumps(str(meta["extra"]), ensure_ascii=False)
         execute(
             """
-            UPDATE images
-            SET stored_path=%s, path=%s, mime_type=%s,
-                size_bytes=%s, width=%s, height=%s, sha256=%s,
-                taken_at=%s, updated_at=NOW(), title=COALESCE(%s,title)
-            WHERE id=%s AND owner_id=%s
-            """,
-            (
-                rel_out,
-                rel_out,
-                f"image/{fmt.lower()}",
-                size_bytes,
-                width,
-                height,
-                sha256,
-                taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
-                export_name or None,
-                image_id,
-                g.user_id,
-            ),
-        )
-        target_id = image_id
-    else:
-        target_id = execute(
-            """
-            INSERT INTO images
-            (owner_id, parent_id, path, stored_path, mime_type, size_bytes, width, height, sha256,
-             taken_at, title, description, created_at)
-            SELECT owner_id, id, %s, %s, %s, %s, %s, %s, %s,
-                   %s, %s, description, NOW()
-            FROM images WHERE id=%s AND owner_id=%s
+            INSERT INTO exif
+              (image_id, camera_make, camera_model,
+               f_number, exposure_time, iso, focal_length,
+               taken_at, gps_lat, gps_lng, extra)
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+            ON DUPLICATE KEY UPDATE
+              camera_make=VALUES(camera_make),
+              camera_model=VALUES(camera_model),
+              f_number=VALUES(f_number),
+              exposure_time=VALUES(exposure_time),
+              iso=VALUES(iso),
+              focal_length=VALUES(focal_length),
+              taken_at=VALUES(taken_at),
+              gps_lat=VALUES(gps_lat),
+              gps_lng=VALUES(gps_lng),
+              extra=VALUES(extra)
             """,
             (
-                rel_out,
-                rel_out,
-                f"image/{fmt.lower()}",
-                size_bytes,
-                width,
-                height,
-                sha256,
-                taken_at.strftime("%Y-%m-%d %H:%M:%S") if taken_at else None,
-                export_name or (base.get("title") or ""),
-                image_id,
-                g.user_id,
+                target_id,
+                meta.get("camera_make"),
+                meta.get("camera_model"),
+                meta.get("f_number"),
+                meta.get("exposure_time"),
+                meta.get("iso"),
+                meta.get("focal_length"),
+                meta.get("taken_at"),
+                meta.get("gps_lat"),
+                meta.get("gps_lng"),
+                extra_json,
             ),
         )
-        tag_ids = query("SELECT tag_id FROM image_tags WHERE image_id=%s", (image_id,))
-        if tag_ids:
-            executemany(
-                "INSERT IGNORE INTO image_tags (image_id,tag_id) VALUES (%s,%s)",
-                [(target_id, t["tag_id"]) for t in tag_ids],
-            )
-
-    extra_json = None
-    if meta.get("extra") is not None:
-        try:
-            extra_json = json.dumps(meta["extra"], ensure_ascii=False)
-        except TypeError:
-            extra_json = json.dumps(str(meta["extra"]), ensure_ascii=False)
-    execute(
-        """
-        INSERT INTO exif
-          (image_id, camera_make, camera_model,
-           f_number, exposure_time, iso, focal_length,
-           taken_at, gps_lat, gps_lng, extra)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        ON DUPLICATE KEY UPDATE
-          camera_make=VALUES(camera_make),
-          camera_model=VALUES(camera_model),
-          f_number=VALUES(f_number),
-          exposure_time=VALUES(exposure_time),
-          iso=VALUES(iso),
-          focal_length=VALUES(focal_length),
-          taken_at=VALUES(taken_at),
-          gps_lat=VALUES(gps_lat),
-          gps_lng=VALUES(gps_lng),
-          extra=VALUES(extra)
-        """,
-        (
-            target_id,
-            meta.get("camera_make"),
-            meta.get("camera_model"),
-            meta.get("f_number"),
-            meta.get("exposure_time"),
-            meta.get("iso"),
-            meta.get("focal_length"),
-            meta.get("taken_at"),
-            meta.get("gps_lat"),
-            meta.get("gps_lng"),
-            extra_json,
-        ),
-    )
+        facets.after([target_id])
+    _store_features(target_id, _file_features(abs_out))
 
     resp = {"ok": True, "image_id": target_id, "url": f"/files/{rel_out}", "mode": mode}
     stamp_row = query(
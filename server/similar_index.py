@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+相似图片索引：按感知哈希（server/utils/image_hash.py）做汉明半径查询，用于查找近似重复与相似图片。
+
+- 存储：images.phash / images.dhash（有符号 BIGINT），上传与编辑导出时计算；
+  旧图片用 `python -m server.tools.backfill_image_features` 补算
+- 索引：每个用户一份多索引哈希（multi-index hashing）。pHash 切成 4 段 16 位，每段按值排序；
+  距离 <= r 的两张图至少有一段距离 <= r // 4（抽屉原理），只需在各段里查这些邻近值，
+  候选集再用 NumPy 逐位计数精确过滤。几十万张图单次查询也只碰到很少的候选
+- 半径超过 PHASH_MIH_MAX_RADIUS 或图片数少于 PHASH_SCAN_MAX 时直接向量化全量比较，结果相同
+- 失效：索引记录构建时的用户数据版本号（result_cache.owner_generation），
+  版本变化后先继续用旧索引，同时后台重建（版本号表不可用时每 5 分钟重建）
+
+环境变量：
+  PHASH_DUP_RADIUS       上传时提示近似重复的汉明距离（默认 6，0 表示关闭提示）
+  PHASH_SCAN_MAX         小于该图片数时直接全量比较（默认 4096）
+  PHASH_MIH_MAX_RADIUS   多索引查询支持的最大半径（默认 11）
+  PHASH_MEM_OWNERS       进程内缓存的用户索引数（默认 16）
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from server.db import execute, query
+from server.owner_index_cache import OwnerIndexCache
+from server.result_cache import owner_generation
+from server.utils.env import env_int
+from server.utils.image_hash import file_hashes, to_signed64, to_unsigned64
+
+_CHUNKS = 4
+_CHUNK_BITS = 16
+_STALE_SECONDS = 300
+_HAS_COLUMNS: Optional[bool] = None
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values).astype(np.int64)
+else:
+    _BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return _BYTE_BITS[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+_MASKS: Dict[int, np.ndarray] = {}
+
+
+def _flip_masks(radius: int) -> np.ndarray:
+    """16 位内翻转不超过 radius 位的全部掩码。"""
+    if radius not in _MASKS:
+        allv = np.arange(1 << _CHUNK_BITS, dtype=np.uint32)
+        _MASKS[radius] = allv[_popcount(allv.astype(np.uint64)) <= radius]
+    return _MASKS[radius]
+
+
+class HashIndex:
+    def __init__(self, ids: np.ndarray, phashes: np.ndarray, dhashes: np.ndarray, gen: Optional[int]):
+        self.ids = ids.astype(np.int64)
+        self.phash = phashes.astype(np.uint64)
+        self.dhash = dhashes.astype(np.uint64)
+        self.gen = gen
+        self.built_at = time.time()
+        self.tables = []
+        for c in range(_CHUNKS):
+            values = ((self.phash >> np.uint64(c * _CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint32)
+            order = np.argsort(values, kind="stable")
+            self.tables.append((values[order], order))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows: List[Dict[str, Any]], gen: Optional[int]) -> "HashIndex":
+        rows = [r for r in rows if r.get("phash") is not None]
+        ids = np.fromiter((r["id"] for r in rows), dtype=np.int64, count=len(rows))
+        ph = np.fromiter((to_unsigned64(int(r["phash"])) for r in rows), dtype=np.uint64, count=len(rows))
+        dh = np.fromiter(
+            (to_unsigned64(int(r["dhash"] or 0)) for r in rows), dtype=np.uint64, count=len(rows)
+        )
+        return cls(ids, ph, dh, gen)
+
+    def _candidates(self, target: int, radius: int) -> np.ndarray:
+        masks = _flip_masks(radius // _CHUNKS)
+        found = []
+        for c, (values, order) in enumerate(self.tables):
+            probes = np.uint32((target >> (c * _CHUNK_BITS)) & 0xFFFF) ^ masks
+            lo = np.searchsorted(values, probes, side="left")
+            hi = np.searchsorted(values, probes, side="right")
+            hit = hi > lo
+            found.extend(order[a:b] for a, b in zip(lo[hit], hi[hit]))
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def search(
+        self,
+        phash: int,
+        radius: int,
+        dhash: Optional[int] = None,
+        dhash_radius: Optional[int] = None,
+        limit: int = 50,
+        exclude_id: Optional[int] = None,
+    ) -> List[Dict[str, int]]:
+        """
+        返回 pHash 距离 <= radius 的图片，按 (pHash 距离, dHash 距离) 升序。
+        给出 dhash_radius 时还要求 dHash 距离也在范围内（两种哈希都认为相近，误报更少）。
+        """
+        if not len(self):
+            return []
+        if len(self) < env_int("PHASH_SCAN_MAX", 4096) or radius > env_int("PHASH_MIH_MAX_RADIUS", 11):
+            pos = np.arange(len(self))
+        else:
+            pos = self._candidates(phash, radius)
+        pdist = _popcount(self.phash[pos] ^ np.uint64(phash))
+        keep = pdist <= radius
+        pos, pdist = pos[keep], pdist[keep]
+        if dhash is not None:
+            ddist = _popcount(self.dhash[pos] ^ np.uint64(dhash))
+        else:
+            ddist = np.zeros_like(pdist)
+        if dhash is not None and dhash_radius is not None:
+            keep = ddist <= dhash_radius
+            pos, pdist, ddist = pos[keep], pdist[keep], ddist[keep]
+        if exclude_id is not None:
+            keep = self.ids[pos] != exclude_id
+            pos, pdist, ddist = pos[keep], pdist[keep], ddist[keep]
+        order = np.lexsort((self.ids[pos], ddist, pdist))[:limit]
+        return [
+            {"image_id": int(self.ids[pos[i]]), "distance": int(pdist[i]), "dhash_distance": int(ddist[i])}
+            for i in order
+        ]
+
+
+def has_hash_columns() -> bool:
+    global _HAS_COLUMNS
+    if _HAS_COLUMNS is None:
+        try:
+            rows = query(
+                """
+                SELECT COUNT(*) AS c FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='images' AND COLUMN_NAME IN ('phash','dhash')
+                """
+            )
+            _HAS_COLUMNS = bool(rows) and int(rows[0]["c"]) == 2
+        except Exception:
+            return False
+    return _HAS_COLUMNS
+
+
+def build_hash_index(owner_id: Any) -> HashIndex:
+    gen = owner_generation(owner_id)
+    rows = query(
+        "SELECT id, phash, dhash FROM images WHERE owner_id=%s AND phash IS NOT NULL",
+        (owner_id,),
+    )
+    return HashIndex.from_rows(rows, gen)
+
+
+_CACHE = OwnerIndexCache("similar_index", build_hash_index, lambda: env_int("PHASH_MEM_OWNERS", 16), _STALE_SECONDS)
+
+
+def get_hash_index(owner_id: Any) -> HashIndex:
+    """取该用户的索引；已有索引但数据版本变了时，先返回旧索引，后台重建。"""
+    return _CACHE.get(owner_id)
+
+
+def store_hashes(image_id: int, phash: Optional[int], dhash: Optional[int]) -> None:
+    if phash is None or not has_hash_columns():
+        return
+    try:
+        execute(
+            "UPDATE images SET phash=%s, dhash=%s WHERE id=%s",
+            (to_signed64(phash), to_signed64(dhash), image_id),
+        )
+    except Exception as exc:
+        print(f"[similar_index] store hashes failed: {exc}")
+
+
+def image_hashes_for(image_id: int, owner_id: Any, abs_path: Optional[str]):
+    """读出图片的 (phash, dhash)；库里没有时现算并回写。"""
+    if has_hash_columns():
+        rows = query("SELECT phash, dhash FROM images WHERE id=%s AND owner_id=%s", (image_id, owner_id))
+        if rows and rows[0].get("phash") is not None:
+            return to_unsigned64(int(rows[0]["phash"])), to_unsigned64(int(rows[0]["dhash"] or 0))
+    if not abs_path:
+        return None, None
+    phash, dhash = file_hashes(abs_path)
+    store_hashes(image_id, phash, dhash)
+    return phash, dhash
+
+
+def find_similar(
+    owner_id: Any,
+    phash: int,
+    dhash: Optional[int] = None,
+    radius: int = 10,
+    limit: int = 50,
+    exclude_id: Optional[int] = None,
+) -> List[Dict[str, int]]:
+    if not has_hash_columns():
+        return []
+    return get_hash_index(owner_id).search(phash, radius, dhash=dhash, limit=limit, exclude_id=exclude_id)
+
+
+def near_duplicates(owner_id: Any, phash: Optional[int], dhash: Optional[int]) -> List[Dict[str, int]]:
+    """上传时的近似重复提示：pHash 与 dHash 都在 PHASH_DUP_RADIUS 以内。失败时返回空列表。"""
+    radius = env_int("PHASH_DUP_RADIUS", 6)
+    if radius <= 0 or phash is None or not has_hash_columns():
+        return []
+    try:
+        return get_hash_index(owner_id).search(phash, radius, dhash=dhash, dhash_radius=radius, limit=5)
+    except Exception as exc:
+        print(f"[similar_index] near-duplicate lookup failed: {exc}")
+        return []
@@ -0,0 +1,3 @@
+"""
+运维/调试用的命令行小工具（python -m server.tools.<name>）。
+"""
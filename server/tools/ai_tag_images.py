@@ -0,0 +1,49 @@
+"""
+批量为已有图片生成 AI 标签（server/ai_tagger.py），写入 kind='system' 的标签；中断后重跑从剩下的图片继续。
+离线调试可先启动 python -m server.tools.dashscope_stub，并设置 DASHSCOPE_HTTP_BASE_URL 指向它。
+
+用法：python -m server.tools.ai_tag_images [--limit N] [--upload-dir DIR] [用户ID ...]   # 不带用户ID时处理所有待标注用户
+"""
+
+import argparse
+import os
+import sys
+
+from server.ai_tagger import has_progress_column, run_lock, tag_all
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="批量生成 AI 标签")
+    parser.add_argument("owner_ids", nargs="*", type=int)
+    parser.add_argument("--limit", type=int, default=None, help="每个用户本次最多处理多少张")
+    parser.add_argument(
+        "--upload-dir",
+        default=os.path.abspath(os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "..", "uploads"))),
+    )
+    opts = parser.parse_args(argv)
+
+    if not has_progress_column():
+        print("images 表缺少 ai_tagged_at 列，请先执行 database/migrations/20261019_add_images_ai_tagged_at.sql")
+        return 1
+    with run_lock() as ok:
+        if not ok:
+            print("已有其他进程在批量标注，稍后再试")
+            return 1
+        try:
+            results = tag_all(
+                opts.upload_dir,
+                opts.owner_ids or None,
+                opts.limit,
+                on_batch=lambda owner_id, stats: print(f"  owner {owner_id}: {stats.line()}", flush=True),
+            )
+        except KeyboardInterrupt:
+            print("已中断，已完成的批次不会重复处理")
+            return 130
+    total = sum(s.images for s in results.values())
+    stopped = next((s.stopped_reason for s in results.values() if s.stopped_reason), "")
+    print(f"完成：{len(results)} 个用户，{total} 张图片" + (f"（提前停止：{stopped}）" if stopped else ""))
+    return 2 if stopped == "ai_unavailable" else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
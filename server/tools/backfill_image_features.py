@@ -0,0 +1,77 @@
+"""
+为上传时还没有计算的旧图片补算图片特征（感知哈希 phash/dhash、颜色签名 color_sig），按 id 分批，可中断后重跑。
+
+用法：python -m server.tools.backfill_image_features [--batch N] [--workers N] [--upload-dir DIR] [用户ID ...]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from server.color_index import has_color_column
+from server.db import executemany, query
+from server.facet_counters import all_owner_ids
+from server.result_cache import bump_owner_generation
+from server.similar_index import has_hash_columns
+from server.utils.image_features import file_features
+from server.utils.image_hash import to_signed64
+
+
+def _backfill_owner(owner_id: int, root: str, batch: int, pool: ThreadPoolExecutor, columns: List[str]) -> int:
+    missing = " OR ".join(f"{c} IS NULL" for c in columns)
+    done = 0
+    last_id = 0
+    while True:
+        rows = query(
+            "SELECT id, COALESCE(NULLIF(stored_path,''), path) AS rel FROM images "
+            f"WHERE owner_id=%s AND ({missing}) AND id>%s ORDER BY id LIMIT %s",
+            (owner_id, last_id, batch),
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        paths = [os.path.join(root, (r["rel"] or "").strip()) for r in rows]
+        hash_updates, color_updates = [], []
+        for r, feats in zip(rows, pool.map(file_features, paths)):
+            if "phash" in columns and feats["phash"] is not None:
+                hash_updates.append((to_signed64(feats["phash"]), to_signed64(feats["dhash"]), r["id"]))
+            if "color_sig" in columns and feats["color_sig"]:
+                color_updates.append((feats["color_sig"], r["id"]))
+        if hash_updates:
+            executemany("UPDATE images SET phash=%s, dhash=%s WHERE id=%s", hash_updates)
+        if color_updates:
+            executemany("UPDATE images SET color_sig=%s WHERE id=%s", color_updates)
+        done += max(len(hash_updates), len(color_updates))
+    if done:
+        bump_owner_generation(owner_id)
+    return done
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="补算图片特征")
+    parser.add_argument("owner_ids", nargs="*", type=int)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument(
+        "--upload-dir",
+        default=os.path.abspath(os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "..", "uploads"))),
+    )
+    opts = parser.parse_args(argv)
+
+    columns = (["phash"] if has_hash_columns() else []) + (["color_sig"] if has_color_column() else [])
+    if not columns:
+        print("images 表缺少特征列，请先执行 database/migrations/20261019_add_image_phash.sql / 20261019_add_image_color_sig.sql")
+        return 1
+    with ThreadPoolExecutor(max_workers=max(1, opts.workers)) as pool:
+        for owner_id in opts.owner_ids or all_owner_ids():
+            t0 = time.time()
+            n = _backfill_owner(owner_id, opts.upload_dir, opts.batch, pool, columns)
+            print(f"  owner {owner_id}: 补算 {n} 张图片，耗时 {time.time() - t0:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
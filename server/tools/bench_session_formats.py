@@ -0,0 +1,25 @@
+"""
+编辑会话中间格式基准：对比各格式的编码/解码耗时与磁盘占用。
+
+用法：python -m server.tools.bench_session_formats <图片路径> [...]
+"""
+
+import sys
+
+from server.utils.session_codec import benchmark
+
+
+def main(argv) -> int:
+    if not argv:
+        print("用法: python -m server.tools.bench_session_formats <图片路径> [...]")
+        return 1
+    for name, rows in benchmark(argv).items():
+        print(name)
+        print(f"  {'format':<12}{'encode(s)':>10}{'decode(s)':>10}{'size(KB)':>12}")
+        for fmt, r in rows.items():
+            print(f"  {fmt:<12}{r['encode_s']:>10}{r['decode_s']:>10}{r['size_kb']:>12}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,36 @@
+"""
+构建本地内容检索索引（server/content_index.py），可选先为缺少内容描述的图片跑一次 AI 分析。
+
+用法：python -m server.tools.build_content_index [--caption] [--limit N] [用户ID ...]   # 不带用户ID时处理所有用户
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from server.content_index import build_owner_index, caption_images
+from server.facet_counters import all_owner_ids
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="构建本地内容检索索引")
+    parser.add_argument("owner_ids", nargs="*", type=int)
+    parser.add_argument("--caption", action="store_true", help="先为没有内容描述的图片调用 AI 生成描述与标签")
+    parser.add_argument("--limit", type=int, default=None, help="每个用户最多生成多少条描述")
+    parser.add_argument(
+        "--upload-dir",
+        default=os.path.abspath(os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "..", "uploads"))),
+    )
+    opts = parser.parse_args(argv)
+
+    for owner_id in opts.owner_ids or all_owner_ids():
+        t0 = time.time()
+        captioned = caption_images(owner_id, opts.upload_dir, opts.limit) if opts.caption else 0
+        index = build_owner_index(owner_id)
+        print(f"  owner {owner_id}: 新增描述 {captioned} 条，索引 {len(index)} 张图片，耗时 {time.time() - t0:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
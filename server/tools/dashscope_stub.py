@@ -0,0 +1,144 @@
+"""
+本地 DashScope 桩服务：模拟多模态对话接口与本地图片上传，用来离线验证 server.ai_client 的
+并发、限流、超时、重试与熔断行为，不消耗真实额度。
+
+用法：python -m server.tools.dashscope_stub [--port 8089] [--latency 0.3] [--fail-rate 0.2] [--fail-status 503]
+然后以 DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:8089/api/v1 DASHSCOPE_API_KEY=stub 启动后端。
+
+返回内容按提示词猜测接口：包含 match_score 的返回检索评分，包含 explanation 的返回讲解，其余返回标题/描述/标签。
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+_STATS = {"requests": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0}
+_STATS_LOCK = threading.Lock()
+
+
+def _reply_text(prompt: str) -> str:
+    if "match_score" in prompt:
+        return json.dumps(
+            {"match_score": round(random.random(), 2), "suggested_tags": ["风景", "天空"], "short_caption": "桩服务返回的描述"},
+            ensure_ascii=False,
+        )
+    if "explanation" in prompt:
+        return json.dumps(
+            {"title": "桩服务讲解", "explanation": "这是一张用于离线测试的图片。", "highlights": ["要点一", "要点二"], "tags": ["测试"]},
+            ensure_ascii=False,
+        )
+    return json.dumps({"title": "桩服务标题", "description": "离线测试描述", "tags": ["测试", "风景"]}, ensure_ascii=False)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "DashScopeStub/1.0"
+    options = None  # 由 main 注入 argparse 结果
+
+    def log_message(self, fmt, *args):  # 默认日志太吵，只保留错误
+        pass
+
+    def _json(self, code: int, payload) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.endswith("/uploads"):
+            host = f"http://{self.headers.get('Host')}"
+            self._json(200, {
+                "request_id": uuid.uuid4().hex,
+                "data": {
+                    "policy": "stub", "signature": "stub", "upload_dir": "stub",
+                    "upload_host": f"{host}/oss", "expire_in_seconds": 300,
+                    "max_file_size_mb": 100, "capacity_limit_mb": 1000,
+                    "oss_access_key_id": "stub", "x_oss_object_acl": "private",
+                    "x_oss_forbid_overwrite": "true",
+                },
+            })
+            return
+        if path == "/stats":
+            with _STATS_LOCK:
+                self._json(200, dict(_STATS))
+            return
+        self._json(404, {"code": "NotFound", "message": path})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        if path == "/oss":
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if not path.endswith("/multimodal-generation/generation"):
+            self._json(404, {"code": "NotFound", "message": path})
+            return
+
+        opts = self.options
+        with _STATS_LOCK:
+            _STATS["requests"] += 1
+            _STATS["in_flight"] += 1
+            _STATS["max_in_flight"] = max(_STATS["max_in_flight"], _STATS["in_flight"])
+        try:
+            time.sleep(max(0.0, random.gauss(opts.latency, opts.latency / 4)))
+            if random.random() < opts.fail_rate:
+                with _STATS_LOCK:
+                    _STATS["failed"] += 1
+                self._json(opts.fail_status, {"code": "StubFailure", "message": "模拟的服务端错误", "request_id": uuid.uuid4().hex})
+                return
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                payload = {}
+            prompt = ""
+            for msg in (payload.get("input") or {}).get("messages") or []:
+                for part in msg.get("content") or []:
+                    if isinstance(part, dict) and part.get("text"):
+                        prompt += part["text"]
+            self._json(200, {
+                "request_id": uuid.uuid4().hex,
+                "output": {"choices": [{
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": [{"text": _reply_text(prompt)}]},
+                }]},
+                "usage": {"input_tokens": 10, "output_tokens": 10},
+            })
+        finally:
+            with _STATS_LOCK:
+                _STATS["in_flight"] -= 1
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="DashScope 多模态接口桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.3, help="平均响应耗时（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="返回错误的比例 0~1")
+    parser.add_argument("--fail-status", type=int, default=503, help="模拟错误时的 HTTP 状态码")
+    opts = parser.parse_args(argv)
+    _Handler.options = opts
+    server = ThreadingHTTPServer((opts.host, opts.port), _Handler)
+    print(f"DashScope stub listening on http://{opts.host}:{opts.port}/api/v1 (GET /stats 查看计数)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""
+导入耗时报告：在子进程里用 python -X importtime 导入目标模块，按累计耗时排序输出。
+用于检查 worker 启动时是否又引入了重量级依赖。
+
+用法：python -m server.tools.import_profile [模块名，默认 server.app] [--top N]
+"""
+
+import re
+import subprocess
+import sys
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def profile(module: str):
+    """返回 (总耗时 us, [(累计 us, 自身 us, 模块名, 层级), ...])。"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            self_us, cum_us, indent, name = m.groups()
+            rows.append((int(cum_us), int(self_us), name, (len(indent) - 1) // 2))
+    total = sum(r[0] for r in rows if r[3] == 0)
+    return total, rows
+
+
+def main(argv) -> int:
+    top = 25
+    if "--top" in argv:
+        i = argv.index("--top")
+        top = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    module = argv[0] if argv else "server.app"
+    try:
+        total, rows = profile(module)
+    except RuntimeError as exc:
+        print(f"导入 {module} 失败: {exc}")
+        return 1
+    print(f"import {module}: {total / 1000:.1f} ms")
+    print(f"  {'cumulative(ms)':>14}{'self(ms)':>10}  module")
+    for cum_us, self_us, name, _level in sorted(rows, reverse=True)[:top]:
+        print(f"  {cum_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
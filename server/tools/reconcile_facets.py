@@ -0,0 +1,29 @@
+"""
+从 images/exif 原表重建聚合计数（owner_facet_counts），修正增量更新的偏差。
+可放进 cron 定期执行。
+
+用法：python -m server.tools.reconcile_facets [用户ID ...]   # 不带参数时重建所有用户
+"""
+
+import sys
+import time
+
+from server.facet_counters import reconcile_all
+
+
+def main(argv) -> int:
+    try:
+        owner_ids = [int(x) for x in argv]
+    except ValueError:
+        print("用法: python -m server.tools.reconcile_facets [用户ID ...]")
+        return 1
+    t0 = time.time()
+    result = reconcile_all(owner_ids or None)
+    for owner_id, images in result.items():
+        print(f"  owner {owner_id}: {images} 张图片")
+    print(f"重建完成：{len(result)} 个用户，耗时 {time.time() - t0:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
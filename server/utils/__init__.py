@@ -4,3 +4,10 @@ Utility package placeholder.
 
 from .device_classifier import classify_device  # noqa: F401
 from .image_resize import resize_image_with_pad, resize_with_pad  # noqa: F401
+from .jpeg_lossless import JPEG_EXTS, lossless_jpeg_transform  # noqa: F401
+from .session_codec import (  # noqa: F401
+    choose_session_format,
+    forget_session_version,
+    open_session_version,
+    save_session_version,
+)
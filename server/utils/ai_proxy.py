@@ -0,0 +1,193 @@
+"""
+发给多模态模型的缩小副本：长边不超过 AI_PROXY_MAX_EDGE 的 JPEG，按原图 sha256 缓存在磁盘上。
+
+模型看 1024px 的图与看 4000px 的原图结果几乎一样，但 SDK 每次调用都要读取并上传整张原图；
+换成几百 KB 的副本后上传量与延迟都明显下降。同一内容只生成一次，多个 worker 共享。
+所有 AI 入口（analyze_image / analyze_image_explain / _call_match_model / 批量标注）都只发送副本；
+HEIC/HEIF 在这里统一转成 JPEG（需要 pillow-heif），只转一次。
+
+副本只是缓存：复用时刷新 mtime，生成新副本后（至多每 10 分钟一次）由后台线程删除
+超过保留天数的副本，目录仍超出上限时再按 mtime 从旧到新删除；删掉的副本下次用到时重新生成。
+
+环境变量：
+  AI_PROXY_DIR        副本目录（默认系统临时目录下 bs_ai_proxy）
+  AI_PROXY_MAX_EDGE   长边像素上限（默认 1024）
+  AI_PROXY_QUALITY    JPEG 质量（默认 85）
+  AI_PROXY_TTL_DAYS   副本保留天数（默认 30，0 表示不按时间清理）
+  AI_PROXY_DISK_MB    副本目录上限（默认 1024，0 表示不限）
+"""
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+from PIL import Image, ImageOps
+
+from .env import env_float, env_int
+
+try:
+    from pillow_heif import register_heif_opener
+
+    register_heif_opener()
+except Exception:  # 没装 pillow-heif 时 HEIC 生成副本失败，退回发送原图
+    pass
+
+_STATS: Dict[str, int] = {"built": 0, "reused": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0, "pruned": 0}
+_STATS_LOCK = threading.Lock()
+_LOCAL = threading.local()  # 本线程实际放进模型消息的字节数（见 take_sent_bytes）
+_SWEEP_INTERVAL = 600
+_TMP_MAX_AGE = 3600
+_LAST_SWEEP = 0.0
+_SWEEP_LOCK = threading.Lock()
+
+
+def proxy_dir() -> str:
+    return os.path.abspath(os.getenv("AI_PROXY_DIR") or os.path.join(tempfile.gettempdir(), "bs_ai_proxy"))
+
+
+def proxy_cache_path(sha256: str) -> str:
+    max_edge = env_int("AI_PROXY_MAX_EDGE", 1024)
+    quality = env_int("AI_PROXY_QUALITY", 85)
+    return os.path.join(proxy_dir(), sha256[:2], f"{sha256}_{max_edge}_q{quality}.jpg")
+
+
+def _write_proxy(src_path: str, dst_path: str, max_edge: int, quality: int) -> None:
+    with Image.open(src_path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            bg = Image.new("RGB", img.size, (255, 255, 255))
+            bg.paste(img, mask=img.getchannel("A"))
+            img = bg
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        tmp = f"{dst_path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            img.save(tmp, "JPEG", quality=quality, optimize=True)
+            os.replace(tmp, dst_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def ai_proxy_path(src_path: str, sha256: Optional[str]) -> str:
+    """
+    返回可直接发给模型的文件路径：已有副本直接返回，否则生成一份。
+    没有 sha256 或生成失败时退回原图，不影响调用。
+    """
+    if not sha256:
+        return src_path
+    dst = proxy_cache_path(sha256)
+    if os.path.exists(dst):
+        try:
+            os.utime(dst)  # 刷新 mtime，作为清理时的 LRU 依据
+        except OSError:
+            pass
+        _bump(reused=1)
+        return dst
+    try:
+        _write_proxy(src_path, dst, env_int("AI_PROXY_MAX_EDGE", 1024), env_int("AI_PROXY_QUALITY", 85))
+    except Exception as exc:
+        print(f"[ai_proxy] build proxy for {src_path} failed: {exc}")
+        _bump(failed=1)
+        return src_path
+    _bump(built=1, bytes_in=os.path.getsize(src_path), bytes_out=os.path.getsize(dst))
+    _maybe_sweep()
+    return dst
+
+
+def proxy_image_url(src_path: str, sha256: Optional[str]) -> str:
+    """多模态消息里的 image 字段。"""
+    path = ai_proxy_path(src_path, sha256)
+    try:
+        _LOCAL.sent = getattr(_LOCAL, "sent", 0) + os.path.getsize(path)
+    except OSError:
+        pass
+    return f"file://{path}"
+
+
+def take_sent_bytes() -> int:
+    """本线程自上次调用以来发给模型的图片字节数并清零；AI 结果命中缓存时没有发送，为 0。"""
+    sent = getattr(_LOCAL, "sent", 0)
+    _LOCAL.sent = 0
+    return sent
+
+
+def sweep_proxies() -> int:
+    """删除过期副本与中断残留的临时文件，目录超出上限时按 mtime 从旧到新继续删除，返回删除数量。"""
+    root = proxy_dir()
+    if not os.path.isdir(root):
+        return 0
+    now = time.time()
+    ttl = env_float("AI_PROXY_TTL_DAYS", 30) * 86400
+    entries = []
+    removed = 0
+    for sub in os.listdir(root):
+        sub_dir = os.path.join(root, sub)
+        if not os.path.isdir(sub_dir):
+            continue
+        for name in os.listdir(sub_dir):
+            path = os.path.join(sub_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            age = now - st.st_mtime
+            if (name.endswith(".tmp") and age > _TMP_MAX_AGE) or (ttl > 0 and age > ttl):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            elif not name.endswith(".tmp"):
+                entries.append((st.st_mtime, st.st_size, path))
+    limit = env_float("AI_PROXY_DISK_MB", 1024) * 1024 * 1024
+    total = sum(size for _, size, _ in entries)
+    if limit > 0 and total > limit:
+        target = limit * 0.9
+        for _mtime, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+                total -= size
+            except OSError:
+                pass
+    _bump(pruned=removed)
+    return removed
+
+
+def _maybe_sweep() -> None:
+    global _LAST_SWEEP
+    with _SWEEP_LOCK:
+        now = time.time()
+        if now - _LAST_SWEEP < _SWEEP_INTERVAL:
+            return
+        _LAST_SWEEP = now
+
+    def _run():
+        try:
+            sweep_proxies()
+        except Exception as exc:
+            print(f"[ai_proxy] sweep failed: {exc}")
+
+    threading.Thread(target=_run, name="ai-proxy-sweep", daemon=True).start()
+
+
+def _bump(**delta: int) -> None:
+    with _STATS_LOCK:
+        for key, value in delta.items():
+            _STATS[key] += value
+
+
+def ai_proxy_stats() -> Dict[str, int]:
+    with _STATS_LOCK:
+        return dict(_STATS)
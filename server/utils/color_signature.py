@@ -0,0 +1,206 @@
+"""
+颜色签名：64 格 HSV 直方图 + 5 个主色（k-means），打包成 85 字节存进 images.color_sig。
+
+格式（版本 1）：
+  [0]       版本号
+  [1:65]    直方图，每格占比 * 255 取整（uint8）
+  [65:85]   5 个主色，每个 (R, G, B, 占比 * 255)，按占比降序
+
+直方图分格：饱和度或亮度过低的像素按亮度归入 16 个灰阶格，其余按 12 个色相 x 2 档饱和度 x 2 档亮度。
+检索时把每张图的直方图乘上格间相似度矩阵（相邻色相、深浅相近的格子互相“借”一点占比），
+再与目标颜色分布求直方图交集，得分约等于“图里有多大比例是这种颜色”。
+"""
+
+import colorsys
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+SIG_VERSION = 1
+HIST_BINS = 64
+PALETTE_SIZE = 5
+SIG_BYTES = 1 + HIST_BINS + PALETTE_SIZE * 4
+THUMB_SIZE = 64
+
+_HUES = 12
+_GREYS = 16
+_MIN_SAT = 40
+_MIN_VAL = 40
+
+
+def _bin_index(h: np.ndarray, s: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """h/s/v 取值 0~255（PIL 的 HSV 模式），返回每个像素的格号。"""
+    h = h.astype(np.int32)
+    s = s.astype(np.int32)
+    v = v.astype(np.int32)
+    hue = ((h * _HUES + 128) // 256) % _HUES  # 第 0 格以红色为中心
+    chroma = hue * 4 + (s >= 128) * 2 + (v >= 150)
+    grey = _HUES * 4 + np.minimum(_GREYS - 1, v * _GREYS // 256)
+    return np.where((s < _MIN_SAT) | (v < _MIN_VAL), grey, chroma)
+
+
+def _bin_centers() -> np.ndarray:
+    """每格中心在 HSV 圆锥里的坐标 (s*v*cos h, s*v*sin h, v)，取值 0~1。"""
+    centers = []
+    for b in range(HIST_BINS):
+        if b < _HUES * 4:
+            hue, sat_hi, val_hi = b // 4, (b // 2) % 2, b % 2
+            h = hue / _HUES * 2 * np.pi
+            s = 0.75 if sat_hi else 0.33
+            v = 0.8 if val_hi else 0.4
+        else:
+            h, s, v = 0.0, 0.0, (b - _HUES * 4 + 0.5) / _GREYS
+        centers.append((s * v * np.cos(h), s * v * np.sin(h), v))
+    return np.array(centers)
+
+
+def _similarity_matrix() -> np.ndarray:
+    c = _bin_centers()
+    dist = np.linalg.norm(c[:, None, :] - c[None, :, :], axis=2)
+    sim = np.exp(-((dist / 0.2) ** 2))
+    sim[sim < 0.05] = 0.0
+    return sim.astype(np.float32)
+
+
+BIN_SIMILARITY = _similarity_matrix()
+
+
+def _palette(pixels: np.ndarray, thumb: Image.Image) -> List[Tuple[int, int, int, float]]:
+    """k-means 主色：中位切分的结果作初值，再迭代几轮。"""
+    quant = thumb.quantize(colors=PALETTE_SIZE, method=Image.Quantize.MEDIANCUT)
+    init = np.array(quant.getpalette()[: PALETTE_SIZE * 3], dtype=np.float32).reshape(-1, 3)
+    centers = init[: max(1, len(quant.getcolors() or []))]
+    data = pixels.reshape(-1, 3).astype(np.float32)
+    for _ in range(6):
+        dist = ((data[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        label = dist.argmin(axis=1)
+        counts = np.bincount(label, minlength=len(centers))
+        sums = np.zeros_like(centers)
+        np.add.at(sums, label, data)
+        moved = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.allclose(moved, centers, atol=0.5):
+            centers = moved
+            break
+        centers = moved
+    label = ((data[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+    counts = np.bincount(label, minlength=len(centers)) / max(1, len(data))
+    order = np.argsort(-counts)
+    return [
+        (int(round(centers[i][0])), int(round(centers[i][1])), int(round(centers[i][2])), float(counts[i]))
+        for i in order
+        if counts[i] > 0
+    ]
+
+
+def color_signature(img: Image.Image) -> bytes:
+    """从已打开的图片计算颜色签名；只在 64x64 缩略图上计算。"""
+    thumb = img.convert("RGB")
+    thumb.thumbnail((THUMB_SIZE, THUMB_SIZE), Image.BILINEAR)
+    hsv = np.asarray(thumb.convert("HSV"))
+    bins = _bin_index(hsv[..., 0], hsv[..., 1], hsv[..., 2]).ravel()
+    hist = np.bincount(bins, minlength=HIST_BINS) / max(1, bins.size)
+    palette = _palette(np.asarray(thumb), thumb)
+
+    out = bytearray(SIG_BYTES)
+    out[0] = SIG_VERSION
+    out[1 : 1 + HIST_BINS] = np.round(hist * 255).astype(np.uint8).tobytes()
+    for i, (r, g, b, share) in enumerate(palette[:PALETTE_SIZE]):
+        base = 1 + HIST_BINS + i * 4
+        out[base : base + 4] = bytes((r, g, b, int(round(share * 255))))
+    return bytes(out)
+
+
+def unpack_histograms(blobs: Sequence[bytes]) -> np.ndarray:
+    """多个签名 -> (N, 64) float32 直方图（每行和约为 1）。"""
+    if not blobs:
+        return np.zeros((0, HIST_BINS), dtype=np.float32)
+    raw = np.frombuffer(b"".join(bytes(b)[1 : 1 + HIST_BINS] for b in blobs), dtype=np.uint8)
+    return raw.reshape(-1, HIST_BINS).astype(np.float32) / 255.0
+
+
+def unpack_palette(blob: bytes) -> List[Dict[str, object]]:
+    blob = bytes(blob)
+    out = []
+    for i in range(PALETTE_SIZE):
+        r, g, b, share = blob[1 + HIST_BINS + i * 4 : 1 + HIST_BINS + i * 4 + 4]
+        if share:
+            out.append({"hex": f"#{r:02x}{g:02x}{b:02x}", "ratio": round(share / 255, 3)})
+    return out
+
+
+def valid_signature(blob: Optional[bytes]) -> bool:
+    return bool(blob) and len(blob) == SIG_BYTES and blob[0] == SIG_VERSION
+
+
+# ===== 目标颜色 =====
+
+COLOR_NAMES: Dict[str, Tuple[int, int, int]] = {
+    "红": (220, 30, 30), "red": (220, 30, 30),
+    "橙": (245, 140, 20), "orange": (245, 140, 20),
+    "黄": (240, 210, 30), "yellow": (240, 210, 30),
+    "绿": (40, 170, 60), "green": (40, 170, 60),
+    "青": (20, 190, 190), "cyan": (20, 190, 190),
+    "蓝": (40, 100, 220), "blue": (40, 100, 220),
+    "紫": (140, 60, 190), "purple": (140, 60, 190),
+    "粉": (245, 140, 180), "pink": (245, 140, 180),
+    "棕": (130, 80, 40), "褐": (130, 80, 40), "brown": (130, 80, 40),
+    "黑": (15, 15, 15), "black": (15, 15, 15),
+    "白": (245, 245, 245), "white": (245, 245, 245),
+    "灰": (128, 128, 128), "gray": (128, 128, 128), "grey": (128, 128, 128),
+}
+# "蓝天""天空" 这类词本身就带颜色
+COLOR_WORDS: Dict[str, str] = {"天空": "蓝", "sky": "blue", "草地": "绿", "森林": "绿", "夕阳": "橙", "雪": "白", "sunset": "orange"}
+
+_HEX_RE = re.compile(r"^#?([0-9a-fA-F]{6})$")
+_LATIN_RE = re.compile(r"[a-z]+")
+
+
+def parse_color(text: str) -> Optional[Tuple[int, int, int]]:
+    text = (text or "").strip().lower()
+    m = _HEX_RE.match(text)
+    if m:
+        v = int(m.group(1), 16)
+        return (v >> 16) & 255, (v >> 8) & 255, v & 255
+    if text in COLOR_NAMES:
+        return COLOR_NAMES[text]
+    for name, rgb in COLOR_NAMES.items():
+        if not name.isascii() and name in text:
+            return rgb
+    return None
+
+
+def colors_in_text(text: str) -> List[Tuple[int, int, int]]:
+    """从自然语言里找颜色词（“蓝天白云”“mostly red”），按出现顺序去重。"""
+    text = (text or "").lower()
+    found: List[Tuple[int, Tuple[int, int, int]]] = []
+    for word, name in COLOR_WORDS.items():
+        pos = text.find(word)
+        if pos >= 0:
+            found.append((pos, COLOR_NAMES[name]))
+    for name, rgb in COLOR_NAMES.items():
+        if name.isascii():
+            for m in _LATIN_RE.finditer(text):
+                if m.group(0) == name:
+                    found.append((m.start(), rgb))
+        else:
+            pos = text.find(name)
+            if pos >= 0:
+                found.append((pos, rgb))
+    out: List[Tuple[int, int, int]] = []
+    for _, rgb in sorted(found):
+        if rgb not in out:
+            out.append(rgb)
+    return out
+
+
+def target_histogram(colors: Sequence[Tuple[Tuple[int, int, int], float]]) -> np.ndarray:
+    """[(RGB, 权重), ...] -> 64 格目标分布（权重归一化）。"""
+    target = np.zeros(HIST_BINS, dtype=np.float32)
+    for (r, g, b), weight in colors:
+        h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+        idx = _bin_index(np.array([round(h * 255)]), np.array([round(s * 255)]), np.array([round(v * 255)]))[0]
+        target[idx] += max(0.0, float(weight))
+    total = target.sum()
+    return target / total if total > 0 else target
@@ -0,0 +1,19 @@
+"""
+读取数值型环境变量：未设置或格式不对时返回默认值。
+"""
+
+import os
+
+
+def env_int(key: str, default: int) -> int:
+    try:
+        return int(os.getenv(key, default))
+    except Exception:
+        return default
+
+
+def env_float(key: str, default: float) -> float:
+    try:
+        return float(os.getenv(key, default))
+    except Exception:
+        return default
@@ -0,0 +1,28 @@
+"""
+上传时一次解码算出全部内容特征：感知哈希（image_hash.py）与颜色签名（color_signature.py）。
+JPEG 用 draft 按 1/2~1/8 解码，大图也只需解码一小块；EXIF 仍由 util_exif.extract_exif 读取。
+"""
+
+from typing import Any, Dict
+
+from PIL import Image
+
+from .color_signature import color_signature
+from .image_hash import image_hashes
+
+_DRAFT_SIZE = 128
+
+
+def file_features(path: str) -> Dict[str, Any]:
+    """返回 {"phash", "dhash", "color_sig"}；读取失败时各项为 None，不影响上传。"""
+    out: Dict[str, Any] = {"phash": None, "dhash": None, "color_sig": None}
+    try:
+        with Image.open(path) as img:
+            if img.format == "JPEG":
+                img.draft("RGB", (_DRAFT_SIZE, _DRAFT_SIZE))
+            img.load()
+            out["phash"], out["dhash"] = image_hashes(img)
+            out["color_sig"] = color_signature(img)
+    except Exception as exc:
+        print(f"[image_features] failed for {path}: {exc}")
+    return out
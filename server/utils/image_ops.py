@@ -0,0 +1,389 @@
+"""
+简易图像处理：裁剪、旋转、亮度/对比度/饱和度/色温/锐化/缩放。
+
+只依赖 Pillow，不依赖 Flask / 数据库，既在请求线程里直接调用，
+也会被 server.image_executor 的子进程导入执行。
+"""
+
+import hashlib
+import json
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+
+def _to_float(val):
+    try:
+        return float(val)
+    except Exception:
+        return None
+
+
+def _to_int(val):
+    try:
+        return int(val)
+    except Exception:
+        return None
+
+
+def _to_bool(val) -> bool:
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, (int, float)):
+        return bool(val)
+    if isinstance(val, str):
+        return val.strip().lower() in ("1", "true", "yes", "y", "on")
+    return False
+
+
+def apply_rotate(img: Image.Image, params: dict) -> Image.Image:
+    deg_f = _to_float(params.get("deg")) if "deg" in params else _to_float(params.get("rotate"))
+    deg_f = deg_f or 0
+    if deg_f % 360 != 0:
+        fill_rgb = (245, 247, 250)
+        try:
+            img = img.rotate(-deg_f, expand=True, fillcolor=fill_rgb)
+        except TypeError:
+            rotated = img.convert("RGBA").rotate(-deg_f, expand=True)
+            background = Image.new("RGBA", rotated.size, fill_rgb + (255,))
+            background.paste(rotated, (0, 0), rotated)
+            img = background.convert("RGB")
+    return img
+
+
+def apply_crop(img: Image.Image, params: dict) -> Image.Image:
+    crop_rect = params.get("crop_rect") or params.get("cropRect") or {}
+    if not isinstance(crop_rect, dict):
+        return img
+    if not any(k in crop_rect for k in ("x", "y", "w", "h", "width", "height")):
+        return img
+    try:
+        x = _to_float(crop_rect.get("x")) or 0
+        y = _to_float(crop_rect.get("y")) or 0
+        w = _to_float(crop_rect.get("w"))
+        h = _to_float(crop_rect.get("h"))
+        if w is None:
+            w = _to_float(crop_rect.get("width"))
+        if h is None:
+            h = _to_float(crop_rect.get("height"))
+        if not w or not h:
+            return img
+        x2 = min(img.width, x + w)
+        y2 = min(img.height, y + h)
+        x = max(0, x)
+        y = max(0, y)
+        if x2 > x and y2 > y:
+            img = img.crop((x, y, x2, y2))
+    except Exception:
+        pass  # 裁剪异常时忽略
+    return img
+
+
+def _factor(val) -> float:
+    try:
+        return 1 + float(val) / 100
+    except Exception:
+        return 1
+
+
+def brightness_factor(params: dict) -> float:
+    return _factor(params.get("brightness", 0))
+
+
+def contrast_factor(params: dict) -> float:
+    return _factor(params.get("contrast", 0))
+
+
+def _sharpen_scale(params: dict) -> Optional[float]:
+    sharp_v = _to_float(params.get("sharpness"))
+    if sharp_v is None:
+        sharp_v = _to_float(params.get("sharpen"))
+    sharp_v = sharp_v or 0
+    if sharp_v <= 0:
+        return None
+    return min(100.0, sharp_v) / 100.0
+
+
+def sharpen_radius(params: dict) -> Optional[float]:
+    """锐化的模糊半径；不需要锐化时返回 None。"""
+    scale = _sharpen_scale(params)
+    return None if scale is None else 1.2 + scale * 1.3
+
+
+def adjust_colour(img: Image.Image, params: dict, contrast_mean: Optional[int] = None) -> Image.Image:
+    """
+    逐像素的颜色调整：亮度、对比度、饱和度、色温。
+    contrast_mean 为对比度参照的灰度均值，默认取 img 自身（分块处理时由调用方传入全图均值）。
+    """
+    b = brightness_factor(params)
+    c = contrast_factor(params)
+    s = _factor(params.get("saturation", 0))
+    if b != 1:
+        img = ImageEnhance.Brightness(img).enhance(b)
+    if c != 1:
+        if contrast_mean is None:
+            img = ImageEnhance.Contrast(img).enhance(c)
+        else:
+            degenerate = Image.new("L", img.size, contrast_mean).convert(img.mode)
+            img = Image.blend(degenerate, img, c)
+    if s != 1:
+        img = ImageEnhance.Color(img).enhance(s)
+
+    warm_v = _to_float(params.get("temperature"))
+    if warm_v is None:
+        warm_v = _to_float(params.get("warmth"))
+    warm_v = warm_v or 0
+    if warm_v != 0 and img.mode == "RGB":
+        warm_v = max(-100.0, min(100.0, warm_v))
+        strength = abs(warm_v) / 100.0
+        boost = 1 + strength * 0.6
+        reduce = 1 - strength * 0.3
+        r_gain = boost if warm_v > 0 else reduce
+        b_gain = boost if warm_v < 0 else reduce
+        r, g_, b_ = img.split()
+        r = r.point(lambda v: max(0, min(255, int(v * r_gain))))
+        b_ = b_.point(lambda v: max(0, min(255, int(v * b_gain))))
+        img = Image.merge("RGB", (r, g_, b_))
+    return img
+
+
+def adjust_sharpen(img: Image.Image, params: dict) -> Image.Image:
+    scale = _sharpen_scale(params)
+    if scale is None:
+        return img
+    radius = 1.2 + scale * 1.3
+    percent = int(100 + scale * 300)
+    return img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=3))
+
+
+def apply_adjust(img: Image.Image, params: dict) -> Image.Image:
+    return adjust_sharpen(adjust_colour(img, params), params)
+
+
+def apply_scale(img: Image.Image, params: dict) -> Image.Image:
+    # 缩放使用 LANCZOS 重采样，保证像素级缩放质量
+    resample = Image.Resampling.LANCZOS if hasattr(Image, "Resampling") else Image.LANCZOS
+    factor = _to_float(params.get("factor") or params.get("scale"))
+    tw = _to_int(params.get("target_width") or params.get("width"))
+    th = _to_int(params.get("target_height") or params.get("height"))
+    keep_ratio = _to_bool(params.get("keep_ratio") or params.get("keepRatio"))
+    resize_mode = (params.get("resize_mode") or params.get("resizeMode") or "").strip().lower()
+    ratio_w = _to_float(params.get("ratio_width") or params.get("ratioWidth"))
+    ratio_h = _to_float(params.get("ratio_height") or params.get("ratioHeight"))
+
+    if (tw is None and th is None) and factor:
+        factor = max(0.05, min(8.0, factor))
+        tw = int(round(img.width * factor))
+        th = int(round(img.height * factor))
+
+    if tw is not None and tw <= 0:
+        tw = None
+    if th is not None and th <= 0:
+        th = None
+
+    if not (tw or th):
+        return img
+
+    orig_w, orig_h = img.size
+    if keep_ratio:
+        if ratio_w and ratio_h and ratio_h != 0:
+            if tw and not th:
+                th = int(round(tw * (ratio_h / ratio_w)))
+            elif th and not tw:
+                tw = int(round(th * (ratio_w / ratio_h)))
+            elif tw and th:
+                th = int(round(tw * (ratio_h / ratio_w)))
+            else:
+                tw = orig_w
+                th = int(round(orig_w * (ratio_h / ratio_w)))
+        else:
+            if tw and not th:
+                th = int(round(tw * (orig_h / orig_w)))
+            elif th and not tw:
+                tw = int(round(th * (orig_w / orig_h)))
+    else:
+        if tw and not th:
+            th = orig_h
+        elif th and not tw:
+            tw = orig_w
+
+    tw = max(1, int(tw)) if tw else None
+    th = max(1, int(th)) if th else None
+    if not (tw and th):
+        return img
+    try:
+        if not resize_mode:
+            resize_mode = "pad" if keep_ratio else "stretch"
+        if resize_mode in ("fit", "contain"):
+            resize_mode = "pad" if keep_ratio else "stretch"
+        if resize_mode not in ("stretch", "pad"):
+            resize_mode = "pad" if keep_ratio else "stretch"
+        if resize_mode == "pad":
+            img = ImageOps.pad(img, (tw, th), method=resample, color="white")
+        else:
+            img = img.resize((tw, th), resample=resample)
+    except Exception:
+        pass  # 缩放异常时保持原图
+    return img
+
+
+def apply_edits(img: Image.Image, params: dict) -> Image.Image:
+    img = apply_rotate(img, params)
+    img = apply_crop(img, params)
+    img = apply_adjust(img, params)
+    img = apply_scale(img, params)
+    return img
+
+
+_ROTATE_KEYS = ("deg", "rotate")
+_CROP_KEYS = ("crop_rect", "cropRect")
+_ADJUST_KEYS = ("brightness", "contrast", "saturation", "temperature", "warmth", "sharpness", "sharpen")
+_SCALE_KEYS = ("factor", "scale", "target_width", "width", "target_height", "height")
+
+
+def geometry_only_ops(params: dict) -> Optional[List[Tuple[str, object]]]:
+    """
+    判断编辑参数是否只包含 90° 整数倍旋转和整数像素裁剪（按 apply_edits 的顺序：先旋转后裁剪），
+    是则返回可交给 lossless_jpeg_transform 的操作列表，否则返回 None。
+    """
+    for key in ("brightness", "contrast", "saturation"):
+        if _to_float(params.get(key, 0)) not in (0, None):
+            return None
+    for key in ("temperature", "warmth", "sharpness", "sharpen"):
+        if _to_float(params.get(key)):
+            return None
+    if any(_to_float(params.get(key)) for key in _SCALE_KEYS):
+        return None
+
+    ops: List[Tuple[str, object]] = []
+    deg_f = _to_float(params.get("deg")) if "deg" in params else _to_float(params.get("rotate"))
+    deg_f = deg_f or 0
+    if deg_f % 360 != 0:
+        if deg_f % 90 != 0:
+            return None
+        ops.append(("rotate", int(deg_f % 360)))
+
+    crop_rect = params.get("crop_rect") or params.get("cropRect") or {}
+    if isinstance(crop_rect, dict) and any(k in crop_rect for k in ("x", "y", "w", "h", "width", "height")):
+        x = _to_float(crop_rect.get("x")) or 0
+        y = _to_float(crop_rect.get("y")) or 0
+        w = _to_float(crop_rect.get("w"))
+        h = _to_float(crop_rect.get("h"))
+        if w is None:
+            w = _to_float(crop_rect.get("width"))
+        if h is None:
+            h = _to_float(crop_rect.get("height"))
+        if w and h:
+            if any(v != int(v) for v in (x, y, w, h)):
+                return None
+            ops.append(("crop", (int(x), int(y), int(w), int(h))))
+    return ops
+
+
+def history_geometry_ops(history: List[Optional[Dict]], idx: int) -> Optional[List[Tuple[str, object]]]:
+    """
+    编辑会话历史（history[1..idx]，每项 {"op":..., "params":...}）是否全部为无损几何操作。
+    history[0] 对应原图，不参与判断。
+    """
+    ops: List[Tuple[str, object]] = []
+    for entry in history[1 : idx + 1]:
+        if not isinstance(entry, dict):
+            return None
+        op = entry.get("op")
+        params = entry.get("params") or {}
+        if op == "rotate":
+            subset = {k: params[k] for k in _ROTATE_KEYS if k in params}
+        elif op == "crop":
+            subset = {k: params[k] for k in _CROP_KEYS if k in params}
+        elif op == "adjust":
+            subset = {k: params[k] for k in _ADJUST_KEYS if k in params}
+        else:
+            subset = {k: params[k] for k in _SCALE_KEYS if k in params}
+        step = geometry_only_ops(subset)
+        if step is None:
+            return None
+        ops.extend(step)
+    return ops
+
+
+def flatten_for_save(img: Image.Image) -> Image.Image:
+    if img.mode in ("RGBA", "LA"):
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        bg.paste(img, mask=img.split()[-1])
+        return bg
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def _num(val) -> Optional[float]:
+    """统一数值表示：10、"10"、10.0 视为同一个值。"""
+    f = _to_float(val)
+    if f is None or f != f:  # NaN
+        return None
+    return float(f)
+
+
+def canonical_edit_params(params: dict) -> Dict[str, object]:
+    """
+    把编辑参数归一化为与渲染结果一一对应的最小字典：
+    合并别名（deg/rotate、crop_rect/cropRect、temperature/warmth、sharpness/sharpen 等），
+    按 apply_* 的取值规则解析，去掉不产生效果的项。渲染结果相同的参数得到相同的字典。
+    """
+    if not isinstance(params, dict):
+        return {}
+    out: Dict[str, object] = {}
+
+    deg = _num(params.get("deg")) if "deg" in params else _num(params.get("rotate"))
+    if deg and deg % 360 != 0:
+        out["rotate"] = deg
+
+    crop_rect = params.get("crop_rect") or params.get("cropRect") or {}
+    if isinstance(crop_rect, dict) and any(k in crop_rect for k in ("x", "y", "w", "h", "width", "height")):
+        w = _num(crop_rect.get("w"))
+        h = _num(crop_rect.get("h"))
+        if w is None:
+            w = _num(crop_rect.get("width"))
+        if h is None:
+            h = _num(crop_rect.get("height"))
+        if w and h:
+            out["crop"] = [_num(crop_rect.get("x")) or 0.0, _num(crop_rect.get("y")) or 0.0, w, h]
+
+    for key in ("brightness", "contrast", "saturation"):
+        v = _num(params.get(key, 0))
+        if v:
+            out[key] = v
+    warm = _num(params.get("temperature"))
+    if warm is None:
+        warm = _num(params.get("warmth"))
+    if warm:
+        out["temperature"] = max(-100.0, min(100.0, warm))
+    sharp = _num(params.get("sharpness"))
+    if sharp is None:
+        sharp = _num(params.get("sharpen"))
+    if sharp and sharp > 0:
+        out["sharpness"] = min(100.0, sharp)
+
+    factor = _num(params.get("factor") or params.get("scale"))
+    tw = _to_int(params.get("target_width") or params.get("width"))
+    th = _to_int(params.get("target_height") or params.get("height"))
+    tw = tw if tw and tw > 0 else None
+    th = th if th and th > 0 else None
+    if tw or th or factor:
+        keep_ratio = _to_bool(params.get("keep_ratio") or params.get("keepRatio"))
+        out["scale"] = {
+            "factor": None if (tw or th) else max(0.05, min(8.0, factor)),
+            "w": tw,
+            "h": th,
+            "keep_ratio": keep_ratio,
+            "mode": str(params.get("resize_mode") or params.get("resizeMode") or "").strip().lower(),
+            "ratio": [_num(params.get("ratio_width") or params.get("ratioWidth")),
+                      _num(params.get("ratio_height") or params.get("ratioHeight"))] if keep_ratio else None,
+        }
+    return out
+
+
+def edit_params_hash(params: dict) -> str:
+    """归一化参数的稳定哈希（用作预览缓存键 / ETag 的一部分）。"""
+    payload = json.dumps(canonical_edit_params(params), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:20]
@@ -0,0 +1,156 @@
+"""
+JPEG 无损几何变换：只有 90° 整数倍旋转 / 按 MCU 对齐的裁剪时，
+直接在 DCT 系数层面变换（jpegtran），跳过解码 + 重新编码，画质零损失，EXIF 原样保留。
+编辑是在原始像素方向上做的（与 Pillow 流程一致），输出里的 EXIF Orientation 统一改成 1，
+否则查看器会按原来的方向标记再转一次。
+
+依赖系统里的 jpegtran（Debian: libjpeg-turbo-progs）；找不到或变换失败时返回 None，
+调用方继续走原来的 Pillow 解码/编码流程。
+
+环境变量：
+  JPEGTRAN_BIN        jpegtran 路径（默认从 PATH 查找）
+  EDIT_LOSSLESS_JPEG  设为 0 可关闭该快速路径
+"""
+
+import os
+import shutil
+import struct
+import subprocess
+from typing import List, Optional, Sequence, Tuple
+
+from PIL import Image, JpegImagePlugin
+
+JPEG_EXTS = (".jpg", ".jpeg")
+_TIMEOUT_SECONDS = 30
+
+# (op, value)：("rotate", 90|180|270) 或 ("crop", (x, y, w, h))
+GeometryOp = Tuple[str, object]
+
+
+def jpegtran_path() -> Optional[str]:
+    if os.getenv("EDIT_LOSSLESS_JPEG", "1").strip().lower() in ("0", "false", "no", "off"):
+        return None
+    return os.getenv("JPEGTRAN_BIN") or shutil.which("jpegtran")
+
+
+def _mcu_size(img: Image.Image) -> Tuple[int, int]:
+    """根据色度采样推算 MCU 尺寸：4:4:4 → 8x8，4:2:2 → 16x8，4:2:0 → 16x16。"""
+    try:
+        sampling = JpegImagePlugin.get_sampling(img)
+    except Exception:
+        sampling = -1
+    if sampling == 1:
+        return 16, 8
+    if sampling == 2:
+        return 16, 16
+    return 8, 8
+
+
+def _plan(abs_path: str, ops: Sequence[GeometryOp]) -> Optional[List[List[str]]]:
+    """把几何操作换算成 jpegtran 参数序列；裁剪起点未对齐 MCU 时返回 None。"""
+    try:
+        with Image.open(abs_path) as img:
+            if img.format != "JPEG":
+                return None
+            width, height = img.size
+            mcu_w, mcu_h = _mcu_size(img)
+    except Exception:
+        return None
+
+    steps: List[List[str]] = []
+    for op, value in ops:
+        if op == "rotate":
+            deg = int(value) % 360
+            if deg == 0:
+                continue
+            if deg not in (90, 180, 270):
+                return None
+            steps.append(["-rotate", str(deg)])
+            if deg in (90, 270):
+                width, height = height, width
+                mcu_w, mcu_h = mcu_h, mcu_w
+        elif op == "crop":
+            x, y, w, h = value
+            # 与 apply_crop 相同的边界裁剪规则
+            x2 = min(width, x + w)
+            y2 = min(height, y + h)
+            x = max(0, x)
+            y = max(0, y)
+            if x2 <= x or y2 <= y:
+                continue
+            if x % mcu_w or y % mcu_h:
+                return None
+            w, h = x2 - x, y2 - y
+            if (x, y, w, h) == (0, 0, width, height):
+                continue
+            steps.append(["-crop", f"{w}x{h}+{x}+{y}"])
+            width, height = w, h
+        else:
+            return None
+    return steps
+
+
+def _reset_orientation(data: bytes) -> bytes:
+    """把 APP1 Exif 里 IFD0 的 Orientation（0x0112）原地改成 1；没有该标记或结构异常时原样返回。"""
+    buf = bytearray(data)
+    pos = 2
+    while pos + 4 <= len(buf) and buf[pos] == 0xFF:
+        marker = buf[pos + 1]
+        if marker in (0xD9, 0xDA):  # EOI / SOS 之后是图像数据
+            break
+        seg_len = struct.unpack(">H", bytes(buf[pos + 2 : pos + 4]))[0]
+        body = pos + 4
+        if marker == 0xE1 and buf[body : body + 6] == b"Exif\x00\x00":
+            tiff = body + 6
+            end = pos + 2 + seg_len
+            order = {b"II": "<", b"MM": ">"}.get(bytes(buf[tiff : tiff + 2]))
+            if order is None or tiff + 8 > end:
+                return data
+            ifd = tiff + struct.unpack(order + "I", bytes(buf[tiff + 4 : tiff + 8]))[0]
+            if ifd + 2 > end:
+                return data
+            count = struct.unpack(order + "H", bytes(buf[ifd : ifd + 2]))[0]
+            for i in range(count):
+                entry = ifd + 2 + i * 12
+                if entry + 12 > end:
+                    return data
+                tag, typ = struct.unpack(order + "HH", bytes(buf[entry : entry + 4]))
+                if tag == 0x0112 and typ == 3:  # SHORT，值直接存放在条目里
+                    buf[entry + 8 : entry + 10] = struct.pack(order + "H", 1)
+                    return bytes(buf)
+            return data
+        pos += 2 + seg_len
+    return data
+
+
+def lossless_jpeg_transform(abs_path: str, ops: Sequence[GeometryOp]) -> Optional[bytes]:
+    """
+    对 JPEG 文件按顺序执行几何操作，返回新的 JPEG 字节；不满足无损条件时返回 None。
+    没有任何实际几何变化时也返回 None，保持原流程（另存为新图时内容必须与原图不同）。
+    """
+    if not abs_path.lower().endswith(JPEG_EXTS):
+        return None
+    binary = jpegtran_path()
+    if not binary:
+        return None
+    steps = _plan(abs_path, ops)
+    if not steps:
+        return None
+    with open(abs_path, "rb") as f:
+        data = f.read()
+    for args in steps:
+        try:
+            proc = subprocess.run(
+                [binary, "-copy", "all", "-perfect", *args],
+                input=data,
+                capture_output=True,
+                timeout=_TIMEOUT_SECONDS,
+                check=False,
+            )
+        except Exception:
+            return None
+        # -perfect：边缘存在无法无损变换的半个 MCU 时 jpegtran 直接失败，交给常规流程
+        if proc.returncode != 0 or not proc.stdout:
+            return None
+        data = proc.stdout
+    return _reset_orientation(data)
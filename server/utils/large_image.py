@@ -0,0 +1,227 @@
+"""
+超大图片处理策略：按单任务内存预算决定怎么解码、怎么处理。
+
+- 像素上限：超过 IMAGE_MAX_PIXELS_MP 的图片直接拒绝（同时设置 Image.MAX_IMAGE_PIXELS）
+- 预览：位图超预算时按比例缩小解码；JPEG 用 draft() 在 DCT 阶段直接 1/2、1/4、1/8 解码
+- 编辑：位图超预算时，颜色调整按条带原地处理（对比度先统计全图均值，锐化带重叠边），
+  不再为每一步增强生成整图副本
+- 输出：直接编码写入目标文件，编码器按块写出，不在内存里保留整份编码结果
+
+环境变量：
+  IMAGE_MAX_PIXELS_MP   允许处理的最大像素量（百万像素，默认 200）
+  IMAGE_MEM_BUDGET_MB   单个任务的位图内存预算（默认 512MB）
+"""
+
+import math
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from .env import env_float
+from .image_ops import (
+    adjust_colour,
+    adjust_sharpen,
+    apply_adjust,
+    apply_crop,
+    apply_edits,
+    apply_rotate,
+    apply_scale,
+    brightness_factor,
+    contrast_factor,
+    sharpen_radius,
+)
+
+# 整图流水线同时存在的位图份数（原图 + 增强结果 + 中间临时图）
+_PIPELINE_COPIES = 3
+_BYTES_PER_PIXEL = 3
+_MIN_STRIP_ROWS = 64
+
+
+class ImageTooLarge(ValueError):
+    """图片像素量超过允许上限。"""
+
+
+def max_pixels() -> int:
+    return int(env_float("IMAGE_MAX_PIXELS_MP", 200) * 1_000_000)
+
+
+def memory_budget() -> int:
+    return max(16, int(env_float("IMAGE_MEM_BUDGET_MB", 512))) * 1024 * 1024
+
+
+def apply_pixel_limit() -> None:
+    # Pillow 超过 MAX_IMAGE_PIXELS 只告警，超过 2 倍才报错；这里的上限由 check_pixels 严格执行
+    Image.MAX_IMAGE_PIXELS = max_pixels()
+
+
+def check_pixels(width: int, height: int) -> None:
+    if width * height > max_pixels():
+        raise ImageTooLarge(f"图片过大（{width}x{height}），超过 {max_pixels() // 1_000_000} 百万像素上限")
+
+
+def pipeline_bytes(width: int, height: int) -> int:
+    return width * height * _BYTES_PER_PIXEL * _PIPELINE_COPIES
+
+
+def needs_tiling(width: int, height: int) -> bool:
+    return pipeline_bytes(width, height) > memory_budget()
+
+
+def preview_scale(width: int, height: int) -> float:
+    """预览的缩小比例：整图流水线放得进预算时为 1。"""
+    need = pipeline_bytes(width, height)
+    budget = memory_budget()
+    if need <= budget:
+        return 1.0
+    return math.sqrt(budget / need)
+
+
+def probe_preview_scale(abs_path: str) -> float:
+    """只读文件头得到预览缩放比例，供调用方在渲染前计算缓存键。"""
+    with Image.open(abs_path) as img:
+        check_pixels(*img.size)
+        return preview_scale(*img.size)
+
+
+def open_rgb(abs_path: str) -> Image.Image:
+    """按像素上限检查后完整解码为 RGB；原图已是 RGB 时不再额外复制一份。"""
+    img = Image.open(abs_path)
+    try:
+        check_pixels(*img.size)
+        img.load()
+        if img.mode == "RGB":
+            return img
+        converted = img.convert("RGB")
+    except BaseException:
+        img.close()
+        raise
+    img.close()  # 转换得到的是新图像，原图的文件句柄在这里释放
+    return converted
+
+
+def open_preview(abs_path: str) -> Tuple[Image.Image, float]:
+    """
+    打开用于预览的 RGB 图像，返回 (图像, 缩放比例)。
+    超预算时缩小到预算内：JPEG 先用 draft() 低分辨率解码，再精确缩放到目标尺寸。
+    """
+    src = Image.open(abs_path)
+    try:
+        width, height = src.size
+        check_pixels(width, height)
+        scale = preview_scale(width, height)
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+        if scale < 1.0 and src.format == "JPEG":
+            src.draft("RGB", target)
+        src.load()
+        img = src if src.mode == "RGB" else src.convert("RGB")
+        if scale < 1.0 and img.size != target:
+            img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    except BaseException:
+        src.close()
+        raise
+    if img is not src:
+        src.close()
+    return img, scale
+
+
+def scale_params(params: dict, scale: float) -> dict:
+    """把以原图像素为单位的裁剪框换算到缩小后的预览上；目标尺寸类参数本身是绝对值，保持不变。"""
+    if scale >= 1.0:
+        return params
+    out = dict(params)
+    for key in ("crop_rect", "cropRect"):
+        rect = out.get(key)
+        if isinstance(rect, dict):
+            scaled = {}
+            for k, v in rect.items():
+                try:
+                    scaled[k] = float(v) * scale if k in ("x", "y", "w", "h", "width", "height") else v
+                except (TypeError, ValueError):
+                    scaled[k] = v
+            out[key] = scaled
+    return out
+
+
+def preview_header_scale(params: dict, scale: float) -> float:
+    """
+    预览相对于全尺寸渲染的比例（X-Preview-Scale）。按倍数缩放时两者同比例变化，仍为 scale；
+    指定了目标宽高时输出尺寸与全尺寸渲染相同，为 1。
+    """
+    if scale >= 1.0:
+        return 1.0
+    for keys in (("target_width", "width"), ("target_height", "height")):
+        try:
+            if int(params.get(keys[0]) or params.get(keys[1]) or 0) > 0:
+                return 1.0
+        except (TypeError, ValueError):
+            continue
+    return scale
+
+
+def strip_rows(width: int) -> int:
+    """每个条带的行数：条带（含处理时的临时副本）控制在预算的 1/8 以内。"""
+    per_row = max(1, width * _BYTES_PER_PIXEL * _PIPELINE_COPIES)
+    return max(_MIN_STRIP_ROWS, memory_budget() // 8 // per_row)
+
+
+def _global_mean(img: Image.Image, params: dict, rows: int) -> int:
+    """与 ImageEnhance.Contrast 一致：亮度调整后的灰度均值，按条带累加直方图得到。"""
+    b = brightness_factor(params)
+    width, height = img.size
+    total = 0
+    for y0 in range(0, height, rows):
+        strip = img.crop((0, y0, width, min(height, y0 + rows)))
+        if b != 1:
+            strip = adjust_colour(strip, {"brightness": params.get("brightness", 0)})
+        hist = strip.convert("L").histogram()
+        total += sum(i * n for i, n in enumerate(hist))
+    return int(total / float(width * height) + 0.5)
+
+
+def apply_adjust_tiled(img: Image.Image, params: dict, rows: Optional[int] = None) -> Image.Image:
+    """
+    按条带原地执行 apply_adjust，结果与整图处理一致。
+    锐化需要邻域像素：每个条带上下各多取一段原始像素，处理后只写回中间部分。
+    注意会修改传入的 img。
+    """
+    if img.mode != "RGB":
+        return apply_adjust(img, params)
+    width, height = img.size
+    rows = rows or strip_rows(width)
+    mean = _global_mean(img, params, rows) if contrast_factor(params) != 1 else None
+    radius = sharpen_radius(params)
+    margin = int(radius * 4) + 4 if radius else 0
+    rows = max(rows, margin)
+
+    carry = None  # 上一条带底部 margin 行的原始像素（已被写回覆盖前保存）
+    for y0 in range(0, height, rows):
+        y1 = min(height, y0 + rows)
+        bottom = min(height, y1 + margin)
+        raw = img.crop((0, y0, width, bottom))
+        top = y0
+        if carry is not None:
+            top = y0 - carry.height
+            joined = Image.new("RGB", (width, bottom - top))
+            joined.paste(carry, (0, 0))
+            joined.paste(raw, (0, carry.height))
+            raw = joined
+        carry = img.crop((0, y1 - margin, width, y1)) if margin and y1 < height else None
+
+        out = adjust_colour(raw, params, contrast_mean=mean)
+        if radius:
+            out = adjust_sharpen(out, params)
+        img.paste(out.crop((0, y0 - top, width, y0 - top + (y1 - y0))), (0, y0))
+    return img
+
+
+def render_edits(img: Image.Image, params: dict) -> Image.Image:
+    """apply_edits 的大图版本：位图超预算时颜色调整改为条带处理（可能原地修改 img）。"""
+    if not needs_tiling(img.width, img.height):
+        return apply_edits(img, params)
+    img = apply_rotate(img, params)
+    img = apply_crop(img, params)
+    img = apply_adjust_tiled(img, params)
+    return apply_scale(img, params)
+
+
+apply_pixel_limit()
@@ -0,0 +1,149 @@
+"""
+预览渲染缓存：按 (原图 sha256, 归一化编辑参数哈希, 输出规格) 做内容寻址。
+
+两级 LRU：
+- 内存：按字节数限流，进程内共享
+- 磁盘：按文件 mtime 近似 LRU，多个 gunicorn worker 共享同一目录；写入用临时文件 + rename
+
+环境变量：
+  PREVIEW_CACHE_DIR      磁盘缓存目录（默认系统临时目录下 bs_preview_cache）
+  PREVIEW_CACHE_MEM_MB   内存缓存上限（默认 64MB，0 表示关闭）
+  PREVIEW_CACHE_DISK_MB  磁盘缓存上限（默认 512MB，0 表示关闭）
+"""
+
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from .env import env_float
+
+_KEY_RE = re.compile(r"^[0-9A-Za-z_.-]{1,200}$")
+
+
+def preview_cache_key(source_hash: str, params_hash: str, variant: str) -> str:
+    """缓存键同时用作磁盘文件名与 ETag，只包含安全字符。"""
+    return f"{source_hash}-{params_hash}-{variant}"
+
+
+class PreviewCache:
+    def __init__(self, cache_dir: str, mem_bytes: int, disk_bytes: int):
+        self.cache_dir = cache_dir
+        self.mem_bytes = mem_bytes
+        self.disk_bytes = disk_bytes
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_used = 0
+        self._disk_used: Optional[int] = None  # 首次写入时扫描目录得到
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key: str) -> Optional[str]:
+        if not _KEY_RE.match(key):
+            return None
+        # 按前两位分目录，避免单目录文件过多
+        return os.path.join(self.cache_dir, key[:2], key + ".jpg")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                return data
+        if self.disk_bytes <= 0:
+            return None
+        path = self._disk_path(key)
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # 刷新 mtime，作为 LRU 依据
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        self._remember(key, data)
+        if self.disk_bytes <= 0 or len(data) > self.disk_bytes:
+            return
+        path = self._disk_path(key)
+        if not path or os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = self._scan()[1]
+            else:
+                self._disk_used += len(data)
+            over = self._disk_used > self.disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if self.mem_bytes <= 0 or len(data) > self.mem_bytes:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_used -= len(old)
+            self._mem[key] = data
+            self._mem_used += len(data)
+            while self._mem_used > self.mem_bytes and self._mem:
+                _, dropped = self._mem.popitem(last=False)
+                self._mem_used -= len(dropped)
+
+    def _scan(self):
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def _evict_disk(self) -> None:
+        """删除最久未访问的文件，直到降到上限的 90%（其他 worker 写入的文件也一并计算）。"""
+        entries, total = self._scan()
+        target = int(self.disk_bytes * 0.9)
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        with self._lock:
+            self._disk_used = total
+
+
+_CACHE: Optional[PreviewCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_preview_cache() -> PreviewCache:
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = PreviewCache(
+                    os.getenv("PREVIEW_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "bs_preview_cache"),
+                    int(env_float("PREVIEW_CACHE_MEM_MB", 64) * 1024 * 1024),
+                    int(env_float("PREVIEW_CACHE_DISK_MB", 512) * 1024 * 1024),
+                )
+    return _CACHE
@@ -0,0 +1,211 @@
+"""
+编辑会话中间版本的编码策略。
+
+每次 apply 都会落一张中间图（vNNN.*），默认 PNG(zlib 6) 编码是大图编辑最慢的一步。
+这里按图片尺寸选择更快的无损格式，并缓存最近解码的版本，下一步编辑可直接复用：
+- png:  PNG compress_level=1，实测 12MP 照片编码约为默认 PNG 的 1/3~1/4
+- webp: 无损 WebP，method=0，耗时与 png 接近，体积小约 20%~30%
+- raw:  未压缩 BMP（浏览器可直接显示），编码几乎零开销，但体积约为 PNG 的 5 倍
+
+auto 策略：像素量不超过 EDIT_SESSION_RAW_MIN_MP 用 png，超过则用 raw。
+版本文件同时作为前端预览的 current_url，所以只选浏览器能直接显示的格式。
+
+环境变量：
+  EDIT_SESSION_FORMAT      auto / png / webp / raw（默认 auto）
+  EDIT_SESSION_RAW_MIN_MP  auto 模式下超过该像素量（百万像素）改用 raw（默认 24）
+  EDIT_SESSION_CACHE_MB    每个 gunicorn worker 的解码缓存总量（默认 128MB，0 表示关闭）；
+                           解码在图片处理子进程里进行，由各子进程平分（见 image_executor）
+
+基准测试：python -m server.tools.bench_session_formats <图片路径> [...]
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, features
+
+from .env import env_float
+
+SESSION_FORMATS = ("png", "webp", "raw")
+WEBP_MAX_EDGE = 16383  # libwebp 单边上限
+
+_FORMAT_EXT = {"webp": ".webp", "png": ".png", "raw": ".bmp"}
+
+
+def _webp_available() -> bool:
+    try:
+        return bool(features.check("webp"))
+    except Exception:
+        return False
+
+
+def choose_session_format(width: int, height: int, preferred: Optional[str] = None) -> str:
+    """按尺寸选择中间格式；显式配置优先，WebP 不可用或超出尺寸上限时退回。"""
+    fmt = (preferred or os.getenv("EDIT_SESSION_FORMAT") or "auto").strip().lower()
+    webp_ok = _webp_available() and max(width, height) <= WEBP_MAX_EDGE
+    if fmt in SESSION_FORMATS:
+        if fmt == "webp" and not webp_ok:
+            return "png"
+        return fmt
+    raw_min = env_float("EDIT_SESSION_RAW_MIN_MP", 24.0) * 1_000_000
+    if width * height >= raw_min:
+        return "raw"
+    return "png"
+
+
+def session_ext(fmt: str) -> str:
+    return _FORMAT_EXT.get(fmt, ".png")
+
+
+def encode_session_image(img: Image.Image, fp, fmt: str) -> None:
+    """按中间格式写出图片；fp 可以是路径或文件对象。"""
+    if fmt == "webp":
+        img.save(fp, format="WEBP", lossless=True, quality=0, method=0)
+    elif fmt == "raw":
+        img.save(fp, format="BMP")
+    else:
+        img.save(fp, format="PNG", compress_level=1)
+
+
+def save_session_version(img: Image.Image, abs_dir: str, stem: str, fmt: Optional[str] = None) -> str:
+    """
+    保存一个会话版本，返回文件名（含扩展名）。
+    写入成功后把 img 放入解码缓存，下一次编辑读取同一版本时无需重新解码。
+    """
+    fmt = fmt or choose_session_format(img.width, img.height)
+    filename = f"{stem}{session_ext(fmt)}"
+    abs_path = os.path.join(abs_dir, filename)
+    encode_session_image(img, abs_path, fmt)
+    _DECODED_CACHE.put(abs_path, img)
+    return filename
+
+
+def open_session_version(abs_path: str) -> Image.Image:
+    """
+    读取会话版本（RGB）。命中缓存时直接返回已解码的图像。
+    返回值视为只读：现有的 apply_* 都会生成新图像，不会原地修改。
+    """
+    cached = _DECODED_CACHE.get(abs_path)
+    if cached is not None:
+        return cached
+    with Image.open(abs_path) as img:
+        decoded = img.convert("RGB")
+    _DECODED_CACHE.put(abs_path, decoded)
+    return decoded
+
+
+def forget_session_version(abs_path: str) -> None:
+    _DECODED_CACHE.discard(abs_path)
+
+
+def set_session_cache_limit(max_bytes: int) -> None:
+    """调整本进程的解码缓存上限（图片处理子进程启动时按池大小平分总预算）。"""
+    _DECODED_CACHE.resize(max_bytes)
+
+
+class _DecodedCache:
+    """按字节数限流的 LRU，键为 (路径, mtime_ns, 文件大小)，文件被改写后自动失效。"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[Tuple[int, int], Image.Image, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(abs_path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _cost(img: Image.Image) -> int:
+        return img.width * img.height * max(1, len(img.getbands()))
+
+    def get(self, abs_path: str) -> Optional[Image.Image]:
+        if self.max_bytes <= 0:
+            return None
+        stamp = self._stamp(abs_path)
+        with self._lock:
+            item = self._items.get(abs_path)
+            if not item:
+                return None
+            if item[0] != stamp:
+                self._drop(abs_path)
+                return None
+            self._items.move_to_end(abs_path)
+            return item[1]
+
+    def put(self, abs_path: str, img: Image.Image) -> None:
+        if self.max_bytes <= 0:
+            return
+        cost = self._cost(img)
+        if cost > self.max_bytes:
+            return
+        stamp = self._stamp(abs_path)
+        if stamp is None:
+            return
+        with self._lock:
+            self._drop(abs_path)
+            self._items[abs_path] = (stamp, img, cost)
+            self._bytes += cost
+            while self._bytes > self.max_bytes and self._items:
+                oldest = next(iter(self._items))
+                self._drop(oldest)
+
+    def resize(self, max_bytes: int) -> None:
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._bytes > max(0, max_bytes) and self._items:
+                self._drop(next(iter(self._items)))
+
+    def discard(self, abs_path: str) -> None:
+        with self._lock:
+            self._drop(abs_path)
+
+    def _drop(self, abs_path: str) -> None:
+        item = self._items.pop(abs_path, None)
+        if item:
+            self._bytes -= item[2]
+
+
+def session_cache_budget() -> int:
+    return int(env_float("EDIT_SESSION_CACHE_MB", 128) * 1024 * 1024)
+
+
+_DECODED_CACHE = _DecodedCache(session_cache_budget())
+
+
+def benchmark(paths, formats=("png-default",) + SESSION_FORMATS) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """对每张图片测量各格式的编码/解码耗时（秒）与体积（KB）。"""
+    report: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for path in paths:
+        with Image.open(path) as src:
+            img = src.convert("RGB")
+        rows = {}
+        for fmt in formats:
+            if fmt == "webp" and choose_session_format(img.width, img.height, "webp") != "webp":
+                continue
+            buf = BytesIO()
+            t0 = time.perf_counter()
+            if fmt == "png-default":
+                img.save(buf, format="PNG")
+            else:
+                encode_session_image(img, buf, fmt)
+            enc = time.perf_counter() - t0
+            size = buf.tell()
+            buf.seek(0)
+            t0 = time.perf_counter()
+            with Image.open(buf) as decoded:
+                decoded.load()
+            dec = time.perf_counter() - t0
+            rows[fmt] = {"encode_s": round(enc, 4), "decode_s": round(dec, 4), "size_kb": round(size / 1024, 1)}
+        report[f"{path} ({img.width}x{img.height})"] = rows
+    return report
+
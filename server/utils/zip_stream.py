@@ -0,0 +1,181 @@
+"""
+流式 ZIP 打包：边读文件边输出，内存占用与文件数量/大小无关。
+
+- JPEG/PNG/WEBP/HEIC 等已压缩格式用 STORED（不再浪费 CPU 做 deflate），其他格式 DEFLATED
+- 每个条目写 data descriptor（CRC 与大小在数据之后给出），不需要回写本地文件头
+- 单文件或总大小超过 4GB、条目超过 65535 个时自动使用 zip64
+- 全部条目都是 STORED 时，归档总字节数可以提前算出（archive_size），用于 Content-Length
+"""
+
+import os
+import struct
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional
+
+STORED_EXTS = {"jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "avif", "zip", "gz", "mp4", "mov"}
+
+_CHUNK = 1024 * 1024
+_ZIP32_MAX = 0xFFFFFFFF
+_ZIP32_MAX_ENTRIES = 0xFFFF
+# deflate 后大小可能略大于原文件，留出余量提前切到 zip64
+_ZIP64_FILE_LIMIT = _ZIP32_MAX - (64 << 20)
+
+_FLAG_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+
+@dataclass
+class ZipEntry:
+    abs_path: str
+    arcname: str
+    size: int
+    mtime: float
+    method: int  # 0 = STORED, 8 = DEFLATED
+
+    @property
+    def zip64(self) -> bool:
+        return self.size >= _ZIP64_FILE_LIMIT
+
+
+def make_entry(abs_path: str, arcname: str) -> Optional[ZipEntry]:
+    """按文件扩展名选择压缩方式；文件不存在时返回 None。"""
+    try:
+        st = os.stat(abs_path)
+    except OSError:
+        return None
+    ext = arcname.rsplit(".", 1)[-1].lower() if "." in arcname else ""
+    method = 0 if ext in STORED_EXTS else 8
+    return ZipEntry(abs_path, arcname, st.st_size, st.st_mtime, method)
+
+
+def _dos_time(mtime: float):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def _version(zip64: bool) -> int:
+    return 45 if zip64 else 20
+
+
+def _local_header(e: ZipEntry) -> bytes:
+    name = e.arcname.encode("utf-8")
+    dos_time, dos_date = _dos_time(e.mtime)
+    extra = b""
+    size_field = 0
+    if e.zip64:
+        # 大小在 data descriptor 里给出，这里的 zip64 extra 只是声明使用 8 字节大小
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+        size_field = _ZIP32_MAX
+    return struct.pack(
+        "<IHHHHHIIIHH",
+        0x04034B50, _version(e.zip64), _FLAG_DESCRIPTOR | _FLAG_UTF8, e.method,
+        dos_time, dos_date, 0, size_field, size_field, len(name), len(extra),
+    ) + name + extra
+
+
+def _descriptor(e: ZipEntry, crc: int, compressed: int) -> bytes:
+    if e.zip64:
+        return struct.pack("<IIQQ", 0x08074B50, crc, compressed, e.size)
+    return struct.pack("<IIII", 0x08074B50, crc, compressed, e.size)
+
+
+def _central_header(e: ZipEntry, crc: int, compressed: int, offset: int) -> bytes:
+    name = e.arcname.encode("utf-8")
+    dos_time, dos_date = _dos_time(e.mtime)
+    fields = []
+    usize, csize, off = e.size, compressed, offset
+    if e.zip64 or usize >= _ZIP32_MAX:
+        fields.append(usize)
+        usize = _ZIP32_MAX
+    if e.zip64 or csize >= _ZIP32_MAX:
+        fields.append(csize)
+        csize = _ZIP32_MAX
+    if off >= _ZIP32_MAX:
+        fields.append(off)
+        off = _ZIP32_MAX
+    extra = struct.pack("<HH", 0x0001, 8 * len(fields)) + struct.pack(f"<{len(fields)}Q", *fields) if fields else b""
+    zip64 = bool(fields)
+    return struct.pack(
+        "<IHHHHHHIIIHHHHHII",
+        0x02014B50, (3 << 8) | _version(zip64), _version(zip64), _FLAG_DESCRIPTOR | _FLAG_UTF8, e.method,
+        dos_time, dos_date, crc, csize, usize, len(name), len(extra), 0, 0, 0,
+        (0o100644 << 16), off,
+    ) + name + extra
+
+
+def _end_records(count: int, cd_offset: int, cd_size: int) -> bytes:
+    out = b""
+    if count >= _ZIP32_MAX_ENTRIES or cd_offset >= _ZIP32_MAX or cd_size >= _ZIP32_MAX:
+        zip64_offset = cd_offset + cd_size
+        out += struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        out += struct.pack("<IIQI", 0x07064B50, 0, zip64_offset, 1)
+    out += struct.pack(
+        "<IHHHHIIH",
+        0x06054B50, 0, 0,
+        min(count, _ZIP32_MAX_ENTRIES), min(count, _ZIP32_MAX_ENTRIES),
+        min(cd_size, _ZIP32_MAX), min(cd_offset, _ZIP32_MAX), 0,
+    )
+    return out
+
+
+def archive_size(entries: List[ZipEntry]) -> Optional[int]:
+    """全部为 STORED 时返回归档的准确字节数，否则返回 None（压缩后大小未知）。"""
+    if any(e.method != 0 for e in entries):
+        return None
+    offset = 0
+    cd_size = 0
+    for e in entries:
+        local = len(_local_header(e)) + e.size + len(_descriptor(e, 0, e.size))
+        cd_size += len(_central_header(e, 0, e.size, offset))
+        offset += local
+    return offset + cd_size + len(_end_records(len(entries), offset, cd_size))
+
+
+def stream_zip(entries: Iterable[ZipEntry], chunk_size: int = _CHUNK) -> Iterator[bytes]:
+    """
+    逐块产出 ZIP 数据。
+    文件在打包期间大小发生变化会抛 IOError 中止输出（已声明的 Content-Length 不能再满足）。
+    """
+    central: List[bytes] = []
+    offset = 0
+    for e in entries:
+        header = _local_header(e)
+        yield header
+        crc = 0
+        read = 0
+        compressed = 0
+        comp = zlib.compressobj(6, zlib.DEFLATED, -15) if e.method == 8 else None
+        with open(e.abs_path, "rb") as f:
+            while True:
+                block = f.read(chunk_size)
+                if not block:
+                    break
+                read += len(block)
+                crc = zlib.crc32(block, crc)
+                if comp is not None:
+                    block = comp.compress(block)
+                    if not block:
+                        continue
+                compressed += len(block)
+                yield block
+        if read != e.size:
+            raise IOError(f"{e.arcname} 在打包过程中被修改")
+        if comp is not None:
+            tail = comp.flush()
+            compressed += len(tail)
+            yield tail
+        yield _descriptor(e, crc, compressed)
+        central.append(_central_header(e, crc, compressed, offset))
+        offset += len(header) + compressed + len(_descriptor(e, crc, compressed))
+
+    cd_size = 0
+    for record in central:
+        cd_size += len(record)
+        yield record
+    yield _end_records(len(central), offset, cd_size)